@@ -0,0 +1,68 @@
+"""Benchmark annotate_points: one bulk state update against appending the points one at a time.
+
+The previous annotate_points walked the dataframe with iterrows and appended one PointAnnotation
+per point inside the viewer transaction (it is only run up to --legacy-max points). No browser is
+needed, the annotations are only added to the state of a local viewer.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_annotate.py [--points 1000 10000 100000]
+"""
+
+import argparse
+import time
+
+import neuroglancer
+import numpy as np
+import pandas as pd
+
+from pyroglancer.points import annotate_points
+
+
+def legacy_annotate_points(ngviewer, dimensions, pointscolor, points_df, layer_name, layer_scale):
+    """The per point annotate_points used before (without its in place division of the dataframe)."""
+    pointname = points_df['description']
+    with ngviewer.txn() as s:
+        s.layers.append(
+            name=layer_name,
+            layer=neuroglancer.LocalAnnotationLayer(
+                dimensions=dimensions,
+                annotation_properties=[
+                    neuroglancer.AnnotationPropertySpec(id='color', type='rgb', default='blue')],
+            ))
+        for index, indivpoints in points_df.iterrows():
+            s.layers[layer_name].annotations.append(
+                neuroglancer.PointAnnotation(
+                    id=str(index),
+                    point=[indivpoints.x/1000*layer_scale[0], indivpoints.y/1000*layer_scale[1],
+                           indivpoints.z/1000*layer_scale[2]],
+                    props=[pointscolor],
+                    description=pointname[index]
+                )
+            )
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--legacy-max', type=int, default=10000, help='largest size to run the old loop on')
+    args = parser.parse_args()
+
+    dimensions = neuroglancer.CoordinateSpace(names=['x', 'y', 'z'], units='nm', scales=[4, 4, 40])
+    print('%10s %-10s %10s' % ('points', 'method', 'time (s)'))
+    for n_points in args.points:
+        points = pd.DataFrame(np.random.rand(n_points, 3) * 1e8, columns=['x', 'y', 'z'])
+        points['description'] = 'benchmark'
+        methods = [('bulk', annotate_points)]
+        if n_points <= args.legacy_max:
+            methods.append(('iterrows', legacy_annotate_points))
+        for name, method in methods:
+            ngviewer = neuroglancer.Viewer()
+            tic = time.perf_counter()
+            method(ngviewer, dimensions, '#ff0000', points, 'points', [4, 4, 40])
+            elapsed = time.perf_counter() - tic
+            assert len(ngviewer.state.layers['points'].annotations) == n_points
+            print('%10d %-10s %10.3f' % (n_points, name, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark serving a layer from a single archive instead of a folder of small files.
+
+The benchmark writes a fake point layer with one by_id file per point, then compares copying the
+folder against copying its zip/tar archive, the time to mount the archives, and request rates for
+the folder and the mounted archives.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_archive.py [--points 20000] [--requests 2000]
+"""
+
+import argparse
+import http.client
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+from threading import Thread
+
+from pyroglancer.localserver import ArchiveStore, Server
+from pyroglancer.utils import pack_precomputed
+
+
+def make_layer(layerpath, n_points):
+    """Write a fake point layer with one by_id file per point."""
+    os.makedirs(os.path.join(layerpath, 'by_id'))
+    with open(os.path.join(layerpath, 'info'), 'w') as f:
+        f.write('{"@type": "neuroglancer_annotations_v1"}')
+    for idx in range(n_points):
+        with open(os.path.join(layerpath, 'by_id', str(idx)), 'wb') as f:
+            f.write(struct.pack('<3f', *[random.random() for _ in range(3)]))
+
+
+def timeit(func):
+    """Return the seconds func() takes."""
+    tic = time.perf_counter()
+    func()
+    return time.perf_counter() - tic
+
+
+def request_rate(port, prefix, n_points, n_requests):
+    """Return requests/s for random by_id requests over one connection per request."""
+    tic = time.perf_counter()
+    for _ in range(n_requests):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '%s/by_id/%d' % (prefix, random.randrange(n_points)))
+        conn.getresponse().read()
+        conn.close()
+    return n_requests / (time.perf_counter() - tic)
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=20000, help='by_id files in the layer')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per source')
+    parser.add_argument('--port', type=int, default=8095)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        layerpath = os.path.join(tmpdir, 'precomputed', 'points')
+        make_layer(layerpath, args.points)
+        os.chdir(tmpdir)
+        server = Server(('127.0.0.1', args.port))
+        server.RequestHandlerClass.log_message = lambda *args: None
+        server.archives = {}
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        print('%8s %12s %12s %10s' % ('source', 'copy (s)', 'mount (s)', 'req/s'))
+        copytime = timeit(lambda: shutil.copytree(layerpath, os.path.join(tmpdir, 'copy')))
+        rps = request_rate(args.port, '/precomputed/points', args.points, args.requests)
+        print('%8s %12.3f %12s %10.1f' % ('folder', copytime, '-', rps))
+        for archiveformat in ['zip', 'tar']:
+            archivepath = pack_precomputed(layerpath, archiveformat=archiveformat)
+            copytime = timeit(lambda: shutil.copy(archivepath, archivepath + '.copy'))
+            tic = time.perf_counter()
+            archive = ArchiveStore(archivepath, os.path.join(tmpdir, archiveformat))
+            mounttime = time.perf_counter() - tic
+            server.archives = {archive.mountpath: archive}
+            rps = request_rate(args.port, '/' + archiveformat, args.points, args.requests)
+            print('%8s %12.3f %12.3f %10.1f' % (archiveformat, copytime, mounttime, rps))
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
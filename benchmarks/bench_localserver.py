@@ -0,0 +1,151 @@
+"""Benchmark the local dataserver: requests/second and tail latency for concurrent clients.
+
+The benchmark writes a fake precomputed layer (small info files plus a few shard sized files)
+into a temporary directory, serves it with the dataserver and then hammers it from 1, 4 and 16
+concurrent client processes issuing a mix of full and range requests (like neuroglancer does).
+
+Usage:  python benchmarks/bench_localserver.py [--requests 200] [--workers 1 8] [--engines threaded asyncio]
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pyroglancer.localserver import AsyncServer, RequestHandler, Server, ThreadPoolServer
+
+
+def make_dataset(directory, n_small=200, n_shards=4, shard_size=8 * 1024 * 1024):
+    """Write a fake precomputed layer and return the paths to request."""
+    layerdir = os.path.join(directory, 'precomputed', 'bench')
+    os.makedirs(os.path.join(layerdir, 'skeletons'))
+    paths = []
+    for idx in range(n_small):
+        filename = os.path.join('skeletons', str(idx))
+        with open(os.path.join(layerdir, filename), 'wb') as f:
+            f.write(os.urandom(random.randint(512, 64 * 1024)))
+        paths.append(('/precomputed/bench/' + filename, None))
+    for idx in range(n_shards):
+        filename = os.path.join('skeletons', '%d.shard' % idx)
+        with open(os.path.join(layerdir, filename), 'wb') as f:
+            f.write(os.urandom(shard_size))
+        for _ in range(n_small // n_shards):
+            start = random.randint(0, shard_size - 64 * 1024)
+            paths.append(('/precomputed/bench/' + filename, (start, start + random.randint(16, 64 * 1024))))
+    return paths
+
+
+def _serve(directory, port, workers, handleroptions, engine):
+    os.chdir(directory)
+    for option, value in handleroptions.items():
+        setattr(RequestHandler, option, value)
+    sys.stderr = open(os.devnull, 'w')  # drop the per request log lines..
+    if engine == 'asyncio':
+        server = AsyncServer(('127.0.0.1', port))
+    elif workers > 1:
+        server = ThreadPoolServer(('127.0.0.1', port), workers=workers)
+    else:
+        server = Server(('127.0.0.1', port))
+    server.serve_forever()
+
+
+def start_server(directory, port, workers, handleroptions={}, engine='threaded'):
+    """Start a dataserver in a separate process, so the clients don't compete with it for the GIL.
+
+    handleroptions are set as RequestHandler class attributes in the server process.
+    """
+    serverprocess = multiprocessing.Process(target=_serve,
+                                            args=(directory, port, workers, handleroptions, engine))
+    serverprocess.daemon = True
+    serverprocess.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return serverprocess
+
+
+def _client(port, paths, n_requests, startbarrier, results):
+    latencies = []
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    startbarrier.wait()
+    for _ in range(n_requests):
+        path, byterange = random.choice(paths)
+        headers = {}
+        if byterange is not None:
+            headers['Range'] = 'bytes=%d-%d' % byterange
+        tic = time.perf_counter()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - tic)
+    conn.close()
+    results.put((time.perf_counter(), latencies))
+
+
+def run_load(port, paths, clients, n_requests):
+    """Run `clients` concurrent client processes, each issuing `n_requests` requests.
+
+    Returns
+    -------
+    rps : float
+        requests per second over the whole run.
+    p50, p99 : float
+        median and 99th percentile latency in milliseconds.
+    """
+    startbarrier = multiprocessing.Barrier(clients + 1)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_client, args=(port, paths, n_requests, startbarrier, results))
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+    startbarrier.wait()
+    tic = time.perf_counter()
+    finished, latencies = [], []
+    for _ in processes:
+        toc, clientlatencies = results.get()
+        finished.append(toc)
+        latencies.extend(clientlatencies)
+    for process in processes:
+        process.join()
+    elapsed = max(finished) - tic
+    latencies = np.array(latencies) * 1000
+    return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    """Run the benchmark matrix and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8], help='server worker counts')
+    parser.add_argument('--engines', nargs='+', default=['threaded'], help='server engines (threaded, asyncio)')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients')
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = make_dataset(tmpdir)
+        print('%9s %8s %8s %12s %10s %10s' % ('engine', 'workers', 'clients', 'req/s', 'p50 (ms)', 'p99 (ms)'))
+        # the asyncio engine has no workers setting, run it once..
+        configs = [(engine, workers) for engine in args.engines
+                   for workers in (args.workers if engine == 'threaded' else [1])]
+        for port, (engine, workers) in enumerate(configs, start=args.port):
+            serverprocess = start_server(tmpdir, port, workers, engine=engine)
+            for clients in args.clients:
+                rps, p50, p99 = run_load(port, paths, clients, args.requests)
+                print('%9s %8d %8d %12.1f %10.2f %10.2f' % (engine, workers, clients, rps, p50, p99))
+            serverprocess.terminate()
+            serverprocess.join()
+
+
+if __name__ == '__main__':
+    main()
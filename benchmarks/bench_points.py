@@ -0,0 +1,75 @@
+"""Benchmark encoding point annotations: time and peak memory of the spatial chunk encoder.
+
+The NumPy encoder (points.encode_points) is compared against the previous per point struct.pack
+loop, which grows a bytes buffer with += and so is quadratic in the number of points (it is only
+run up to --legacy-max points). The whole put_pointfile writer (chunk plus one by_id file per
+point) is timed up to --writer-max points.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_points.py [--points 10000 1000000 10000000]
+"""
+
+import argparse
+import struct
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from pyroglancer.points import encode_points, put_pointfile
+
+
+def legacy_encode_points(pointlocs, pointsscale):
+    """The per point encoder put_pointfile used before."""
+    total_points = len(pointlocs)
+    buffer = struct.pack('<Q', total_points)
+    for (x, y, z) in pointlocs:
+        x = x*pointsscale[0]
+        y = y*pointsscale[1]
+        z = z*pointsscale[2]
+        annotpoint = struct.pack('<3f', x, y, z)
+        buffer += annotpoint
+    pointid_buffer = struct.pack('<%sQ' % len(pointlocs), *range(len(pointlocs)))
+    buffer += pointid_buffer
+    return buffer
+
+
+def measure(func):
+    """Return the seconds and the peak traced memory (MB) of func()."""
+    tracemalloc.start()
+    tic = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - tic
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    parser.add_argument('--legacy-max', type=int, default=100000, help='largest size to run the old encoder on')
+    parser.add_argument('--writer-max', type=int, default=10000, help='largest size to run put_pointfile on')
+    args = parser.parse_args()
+
+    pointsscale = [4, 4, 40]
+    print('%10s %-14s %10s %12s' % ('points', 'method', 'time (s)', 'peak (MB)'))
+    for n_points in args.points:
+        pointlocs = np.random.rand(n_points, 3) * 1e5
+        scaled = pointlocs * np.asarray(pointsscale)
+        elapsed, peak = measure(lambda: encode_points(scaled))
+        print('%10d %-14s %10.3f %12.1f' % (n_points, 'numpy', elapsed, peak))
+        if n_points <= args.legacy_max:
+            elapsed, peak = measure(lambda: legacy_encode_points(pointlocs, pointsscale))
+            print('%10d %-14s %10.3f %12.1f' % (n_points, 'struct loop', elapsed, peak))
+        if n_points <= args.writer_max:
+            points = pd.DataFrame(pointlocs * 1000, columns=['x', 'y', 'z'])
+            with tempfile.TemporaryDirectory() as tmpdir:
+                elapsed, peak = measure(lambda: put_pointfile(tmpdir, 'bench', points, pointsscale, None))
+            print('%10d %-14s %10.3f %12.1f' % (n_points, 'put_pointfile', elapsed, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark peak memory of uploading points from a Parquet file, streamed against loaded at once.
+
+upload_pointtable reads the file in batches of rows, while the DataFrame path reads the whole file
+with pandas and passes it to upload_points. Both write a sharded by_id index. Each run is done in a
+fresh process, so the maximum resident set size of the process (which also counts the buffers of
+pyarrow) is its peak memory.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_pointtable.py [--points 1000000 4000000] [--batch-size 250000]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import neuroglancer
+import numpy as np
+import pandas as pd
+
+from pyroglancer.annotations import annotation_shardingspec
+from pyroglancer.points import create_pointinfo, upload_points, upload_pointtable
+
+
+def run(method, tablefile, batch_size):
+    """Upload the points of tablefile with one method and return (seconds, peak MB)."""
+    dimensions = neuroglancer.CoordinateSpace(names=['x', 'y', 'z'], units='nm', scales=[1, 1, 1])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tic = time.perf_counter()
+        if method == 'stream':
+            create_pointinfo(dimensions, tmpdir, 'bench')
+            upload_pointtable(tablefile, tmpdir, 'bench', [1, 1, 1], sharding=True, batch_size=batch_size)
+        else:
+            points = pd.read_parquet(tablefile)
+            points['description'] = ''
+            sharding = annotation_shardingspec(len(points))
+            create_pointinfo(dimensions, tmpdir, 'bench', sharding)
+            upload_points(points, tmpdir, 'bench', [1, 1, 1], sharding=sharding)
+        elapsed = time.perf_counter() - tic
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[1000000, 4000000])
+    parser.add_argument('--batch-size', type=int, default=250000, help='rows per batch of upload_pointtable')
+    parser.add_argument('--run', nargs=2, metavar=('METHOD', 'FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        sys.stdout = open(os.devnull, 'w')
+        result = run(args.run[0], args.run[1], args.batch_size)
+        sys.stdout = sys.__stdout__
+        print(json.dumps(result))
+        return
+
+    print('%10s %-10s %10s %12s %12s' % ('points', 'method', 'time (s)', 'peak (MB)', 'file (MB)'))
+    for n_points in args.points:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tablefile = os.path.join(tmpdir, 'points.parquet')
+            points = pd.DataFrame(np.random.rand(n_points, 3) * 1e9, columns=['x', 'y', 'z'])
+            points.to_parquet(tablefile)
+            del points
+            filesize = os.path.getsize(tablefile) / 1024 / 1024
+            for method in ['stream', 'dataframe']:
+                output = subprocess.run([sys.executable, __file__, '--batch-size', str(args.batch_size),
+                                         '--run', method, tablefile], capture_output=True, text=True, check=True)
+                elapsed, peak = json.loads(output.stdout.splitlines()[-1])
+                print('%10d %-10s %10.2f %12.1f %12.1f' % (n_points, method, elapsed, peak, filesize))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark the dataserver body copy: os.sendfile (zero-copy) vs the python copy loop.
+
+A 100 MB shard file is served twice, once with RequestHandler.use_sendfile enabled and once
+with it disabled (the copy_byte_range/shutil loop), and fetched both as a whole and as a
+series of 1 MB range requests (similar to neuroglancer reading fragments out of a shard).
+
+Usage:  python benchmarks/bench_sendfile.py [--size 100] [--repeats 3]
+"""
+
+import argparse
+import http.client
+import os
+import tempfile
+import time
+
+from bench_localserver import start_server
+
+
+def fetch(port, path, byteranges):
+    """Fetch the file (or the given ranges of it) and return the number of bytes received."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    received = 0
+    for byterange in byteranges:
+        headers = {}
+        if byterange is not None:
+            headers['Range'] = 'bytes=%d-%d' % byterange
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        while True:
+            buf = response.read(1024 * 1024)
+            if not buf:
+                break
+            received += len(buf)
+        conn.close()
+    return received
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100, help='shard file size in MB')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8095)
+    args = parser.parse_args()
+
+    filesize = args.size * 1024 * 1024
+    chunk = 1024 * 1024
+    modes = {'full': [None],
+             'range 1MB': [(start, start + chunk - 1) for start in range(0, filesize, chunk)]}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, '0.shard'), 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(chunk))
+
+        print('%10s %10s %12s' % ('copy', 'request', 'MB/s'))
+        for port, use_sendfile in enumerate([False, True], start=args.port):
+            serverprocess = start_server(tmpdir, port, 1, handleroptions={'use_sendfile': use_sendfile})
+            for mode, byteranges in modes.items():
+                tic = time.perf_counter()
+                for _ in range(args.repeats):
+                    received = fetch(port, '/0.shard', byteranges)
+                elapsed = time.perf_counter() - tic
+                throughput = args.repeats * received / elapsed / 2**20
+                print('%10s %10s %12.1f' % ('sendfile' if use_sendfile else 'loop', mode, throughput))
+            serverprocess.terminate()
+            serverprocess.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark peak memory of writing sharded skeletons, one shard at a time against all shards at once.
+
+The previous uploadshardedskeletons encoded every skeleton into a dict and built every shard file
+with ShardingSpecification.synthesize_shards before writing any of them, put_shardedskeletons
+encodes and writes one shard at a time. Random skeletons of --vertices vertices are used, with the
+identity hash as the murmurhash of cloudvolume overflows for half of the ids with recent numpy.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_shardedskeletons.py [--skeletons 1000 10000] [--vertices 2000]
+"""
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from cloudvolume import Skeleton
+from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
+
+from pyroglancer.skeletons import _encode_shardedskeleton, put_shardedskeletons
+
+
+def legacy_put_shardedskeletons(skelsource, shardedfilepath, spec):
+    """The sharded writer uploadshardedskeletons used before."""
+    precomputedskels = {}
+    for skeleton in skelsource:
+        precomputedskels[int(skeleton.id)] = _encode_shardedskeleton(skeleton)
+    shardfiles = spec.synthesize_shards(precomputedskels)
+    for fname in shardfiles.keys():
+        with open(shardedfilepath + '/' + fname, 'wb') as f:
+            f.write(shardfiles[fname])
+
+
+def measure(func):
+    """Return the seconds and the peak traced memory (MB) of func()."""
+    tracemalloc.start()
+    tic = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - tic
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--skeletons', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--vertices', type=int, default=2000, help='vertices per skeleton')
+    args = parser.parse_args()
+
+    spec = ShardingSpecification('neuroglancer_uint64_sharded_v1', preshift_bits=0, hash='identity',
+                                 minishard_bits=6, shard_bits=6, minishard_index_encoding='raw',
+                                 data_encoding='raw')
+    vertices = np.random.rand(args.vertices, 3).astype('float32') * 1e5
+    edges = np.stack([np.arange(1, args.vertices), np.arange(args.vertices - 1)], axis=1).astype('uint32')
+    print('%10s %-10s %10s %12s' % ('skeletons', 'method', 'time (s)', 'peak (MB)'))
+    for n_skeletons in args.skeletons:
+        skelsource = [Skeleton(vertices, edges=edges, segid=segid) for segid in range(1, n_skeletons + 1)]
+        for name, method in [('streaming', put_shardedskeletons), ('legacy', legacy_put_shardedskeletons)]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                elapsed, peak = measure(lambda: method(skelsource, tmpdir, spec))
+            print('%10d %-10s %10.2f %12.1f' % (n_skeletons, name, elapsed, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark _generate_skeleton and the worker processes of to_ngskeletons.
+
+The example neurons of navis are resampled to a finer node spacing to get neurons of about
+--nodes nodes, the array based _generate_skeleton is compared against the previous per node pandas
+lookups (both versions are checked to give identical skeletons). Then to_ngskeletons converts a
+neuronlist of --neurons copies of the example neurons with each number of --workers (1 converts in
+this process), the speedup is bounded by the number of cores of the machine.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_skeletons.py [--nodes 10000 100000] [--repeat 3]
+                                                          [--neurons 2000] [--workers 1 4 16]
+"""
+
+import argparse
+import os
+import time
+
+import navis
+import numpy as np
+from cloudvolume import Skeleton
+
+from pyroglancer.skeletons import _generate_skeleton, to_ngskeletons
+
+
+def legacy_generate_skeleton(x, min_radius=0):
+    """The _generate_skeleton used before."""
+    nodes_ordered = [n for seg in x.segments for n in seg[::-1]]
+    this_tn = x.nodes.set_index('node_id').loc[nodes_ordered]
+    this_tn = this_tn[~this_tn.index.duplicated(keep='first')]
+    this_tn['index'] = list(range(1, this_tn.shape[0] + 1))
+    tn2ix = this_tn['index'].to_dict()
+    this_tn['parent_ix'] = this_tn.parent_id.map(lambda x: tn2ix.get(x, -1))
+    vertices = np.array(this_tn[['x', 'y', 'z']].values.tolist(), dtype="float32")
+    edges = np.array(this_tn[['index', 'parent_ix']].values[1:] - 1, dtype="uint32")
+    skeleton = Skeleton(segid=x.id, vertices=vertices, edges=edges)
+    min_radius = 0
+    if not isinstance(min_radius, type(None)):
+        this_tn.loc[this_tn.radius < min_radius, 'radius'] = min_radius
+    skeleton.radius = np.array(this_tn['radius'].values, dtype="float32")
+    this_tn['label'] = 0
+    this_tn.loc[this_tn.type == 'branch', 'label'] = 5
+    this_tn.loc[this_tn.type == 'end', 'label'] = 6
+    if x.soma is not None:
+        this_tn.loc[x.soma, 'label'] = 1
+    skeleton.vertex_types = this_tn.label
+    return skeleton
+
+
+def best_of(func, repeat):
+    """Return the fastest of repeat runs of func() in seconds."""
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - tic)
+    return min(times)
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--neurons', type=int, default=2000, help='neurons converted by to_ngskeletons')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    neuron = navis.example_neurons(1, kind='skeleton')
+    print('%10s %12s %12s %8s' % ('nodes', 'legacy (s)', 'numpy (s)', 'speedup'))
+    for n_nodes in args.nodes:
+        resolution = neuron.cable_length / n_nodes
+        x = navis.resample_skeleton(neuron, resample_to=resolution)
+        x.segments  # cached by navis, not part of the timing
+
+        legacy, new = legacy_generate_skeleton(x), _generate_skeleton(x)
+        assert np.array_equal(legacy.vertices, new.vertices) and np.array_equal(legacy.edges, new.edges)
+        assert np.array_equal(legacy.radius, new.radius, equal_nan=True)
+        assert np.array_equal(np.asarray(legacy.vertex_types), new.vertex_types)
+
+        legacytime = best_of(lambda: legacy_generate_skeleton(x), args.repeat)
+        newtime = best_of(lambda: _generate_skeleton(x), args.repeat)
+        print('%10d %12.4f %12.4f %8.1f' % (len(x.nodes), legacytime, newtime, legacytime / newtime))
+
+    examples = navis.example_neurons(kind='skeleton')
+    neuronlist = navis.NeuronList([examples[idx % len(examples)].copy() for idx in range(args.neurons)])
+    for idx, neuron in enumerate(neuronlist):
+        neuron.id = idx
+    print('\n%8s %10s %12s %8s   (%d cores)' % ('workers', 'neurons', 'time (s)', 'speedup', os.cpu_count()))
+    reference = None
+    for n_workers in args.workers:
+        for neuron in neuronlist:
+            neuron._clear_temp_attr()  # navis caches the segments, every run computes them again
+        tic = time.perf_counter()
+        skeletons, segids, _ = to_ngskeletons(neuronlist, n_workers=n_workers)
+        elapsed = time.perf_counter() - tic
+        if reference is None:
+            reference = (elapsed, segids, skeletons[-1].to_precomputed())
+        assert segids == reference[1] and skeletons[-1].to_precomputed() == reference[2]
+        print('%8d %10d %12.2f %8.1f' % (n_workers, len(neuronlist), elapsed, reference[0] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark uploading the synapse files of a large neuronlist.
+
+The bulk writer (synapses.get_synapsetable and put_synapsefiles) concatenates the connector tables
+once and groups them by neuron id, it is compared against the previous per neuron loop, which
+packed every synapse with struct.pack into a growing bytes buffer (only run up to --legacy-max
+neurons). Synthetic neurons with --synapses pre and postsynapses each are used.
+
+The extraction of the synapses from navis neurons (synapses.get_synapsetables) is then timed in
+this process and with each of --workers worker processes.
+
+Usage:  PYTHONPATH=. python benchmarks/bench_synapses.py [--neurons 1000 10000] [--synapses 200]
+                                                         [--workers 2 4]
+"""
+
+import argparse
+import os
+import struct
+import tempfile
+import time
+from types import SimpleNamespace
+
+import navis
+import numpy as np
+import pandas as pd
+
+from pyroglancer.synapses import get_synapsetable, get_synapsetables, put_synapsefiles
+
+
+def make_neurons(n_neurons, n_synapses):
+    """Return fake neurons with random pre and postsynapses."""
+    rng = np.random.default_rng(0)
+    neurons = []
+    for neuronid in range(1, n_neurons + 1):
+        neurons.append(SimpleNamespace(
+            id=neuronid,
+            presynapses=pd.DataFrame(rng.random((n_synapses, 3)) * 1e6, columns=['x', 'y', 'z']),
+            postsynapses=pd.DataFrame(rng.random((n_synapses, 3)) * 1e6, columns=['x', 'y', 'z'])))
+    return neurons
+
+
+def make_treeneurons(n_neurons, n_synapses):
+    """Return navis neurons with a small skeleton and a connector table of random synapses."""
+    rng = np.random.default_rng(0)
+    nodes = pd.DataFrame({'node_id': np.arange(1, 11), 'parent_id': np.arange(0, 10), 'x': np.arange(10.0),
+                          'y': np.zeros(10), 'z': np.zeros(10)})
+    nodes.loc[0, 'parent_id'] = -1
+    neurons = []
+    for neuronid in range(1, n_neurons + 1):
+        neuron = navis.TreeNeuron(nodes, id=neuronid)
+        connectors = pd.DataFrame(rng.random((2 * n_synapses, 3)) * 1e6, columns=['x', 'y', 'z'])
+        connectors['type'] = np.repeat(['pre', 'post'], n_synapses)
+        connectors['node_id'] = 1
+        connectors['connector_id'] = np.arange(2 * n_synapses)
+        neuron.connectors = connectors
+        neurons.append(neuron)
+    return navis.NeuronList(neurons)
+
+
+def legacy_upload(neurons, path):
+    """The per neuron and per synapse writer upload_synapses used before."""
+    for neuron in neurons:
+        for synapsetype in ['presynapses', 'postsynapses']:
+            synapsefilepath = os.path.join(path, synapsetype, synapsetype + '_cell')
+            os.makedirs(synapsefilepath, exist_ok=True)
+            synapselocs = getattr(neuron, synapsetype)[['x', 'y', 'z']].values/1000
+            buffer = struct.pack('<Q', len(synapselocs))
+            for (x, y, z) in synapselocs:
+                buffer += struct.pack('<3f', x, y, z)
+            buffer += struct.pack('<%sQ' % len(synapselocs), *range(len(synapselocs)))
+            with open(os.path.join(synapsefilepath, str(neuron.id)), 'wb') as f:
+                f.write(buffer)
+
+
+def bulk_upload(neurons, path):
+    """The bulk writer of upload_synapses."""
+    neuronids = [neuron.id for neuron in neurons]
+    for synapsetype in ['presynapses', 'postsynapses']:
+        synapselocs, segmentids, _ = get_synapsetable(neurons, synapsetype)
+        put_synapsefiles(path, synapsetype, synapselocs, segmentids, neuronids)
+
+
+def timeit(func, neurons):
+    """Return the seconds func(neurons, tmpdir) takes."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tic = time.perf_counter()
+        func(neurons, tmpdir)
+        return time.perf_counter() - tic
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--neurons', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--synapses', type=int, default=200, help='pre and postsynapses per neuron')
+    parser.add_argument('--legacy-max', type=int, default=1000, help='largest size to run the old writer on')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4], help='worker processes to extract with')
+    args = parser.parse_args()
+
+    print('%10s %-12s %10s' % ('neurons', 'method', 'time (s)'))
+    for n_neurons in args.neurons:
+        neurons = make_neurons(n_neurons, args.synapses)
+        print('%10d %-12s %10.3f' % (n_neurons, 'bulk', timeit(bulk_upload, neurons)))
+        if n_neurons <= args.legacy_max:
+            print('%10d %-12s %10.3f' % (n_neurons, 'per neuron', timeit(legacy_upload, neurons)))
+
+    print('\n%10s %-12s %10s' % ('neurons', 'extract', 'time (s)'))
+    for n_neurons in args.neurons:
+        neurons = make_treeneurons(n_neurons, args.synapses)
+        for n_workers in [None] + args.workers:
+            tic = time.perf_counter()
+            get_synapsetables(neurons, n_workers)
+            label = '%d workers' % n_workers if n_workers else 'serial'
+            print('%10d %-12s %10.3f' % (n_neurons, label, time.perf_counter() - tic))
+
+
+if __name__ == '__main__':
+    main()
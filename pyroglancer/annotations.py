@@ -0,0 +1,563 @@
+#    This script is part of pyroglancer (https://github.com/SridharJagannathan/pyroglancer).
+#    Copyright (C) 2020 Sridhar Jagannathan
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Module contains functions shared by the precomputed annotation (points, synapses) layers."""
+
+from cloudvolume.datasource.precomputed import mmh3
+from cloudvolume.datasource.precomputed.sharding import ShardingSpecification, compute_shard_params_for_hashed
+import gzip
+import json
+from .localserver import get_memorystore
+import numpy as np
+import os
+import pandas as pd
+import re
+from tqdm import tqdm
+from .utils import layerfile_exists, makelayerdirs, open_layerfile
+import webcolors
+
+
+def annotation_shardingspec(num_keys, hash='identity'):
+    """Create the sharding specification for an annotation index (by_id or relationship).
+
+    The shard and minishard bits are sized for the number of keys (annotation or segment ids), so
+    millions of annotations end up in a few shard files. The identity hash spreads consecutive keys
+    (the annotation ids of a by_id index) evenly over the minishards and shards, sparse keys such as
+    the segment ids of a relationship index have to be hashed with 'murmurhash3_x86_128' instead.
+
+    Parameters
+    ----------
+    num_keys : int
+        number of keys (annotation ids or segment ids) in the index.
+    hash : str
+        hash applied to the keys, 'identity' or 'murmurhash3_x86_128'.
+
+    Returns
+    -------
+    sharding : dict
+        sharding specification, as written in the info file.
+    """
+    shard_bits, minishard_bits, preshift_bits = [int(bits) for bits in compute_shard_params_for_hashed(num_keys)]
+    return {'@type': 'neuroglancer_uint64_sharded_v1',
+            'preshift_bits': preshift_bits,
+            'hash': hash,
+            'minishard_bits': minishard_bits,
+            'shard_bits': shard_bits,
+            'minishard_index_encoding': 'gzip',
+            'data_encoding': 'raw'}
+
+
+PROPERTY_TYPES = {'uint32': ('<u4', 1), 'int32': ('<i4', 1), 'float32': ('<f4', 1),
+                  'uint16': ('<u2', 1), 'int16': ('<i2', 1),
+                  'uint8': ('u1', 1), 'int8': ('i1', 1), 'rgb': ('u1', 3), 'rgba': ('u1', 4)}
+
+
+def encode_properties(properties, values, count):
+    """Encode per-annotation property values in the binary layout of the annotation files.
+
+    Properties are written with the 4 byte types first, then the 2 byte types and then the 1 byte
+    types (each group in the order of the info file), padded to a multiple of 4 bytes.
+
+    Parameters
+    ----------
+    properties : list
+        property specifications as written in the info file, dicts with 'id' and 'type'.
+    values : dict
+        property id to (N,) values, or (N, 3) | (N, 4) values for 'rgb' | 'rgba'.
+    count : int
+        number of annotations N.
+
+    Returns
+    -------
+    encoded : numpy.ndarray
+        (N, nbytes) uint8 array, the encoded properties of each annotation.
+    """
+    for prop in properties:
+        if prop['type'] not in PROPERTY_TYPES:
+            raise ValueError('Unknown property type "{0}". Please use either: {1}'.format(
+                prop['type'], list(PROPERTY_TYPES.keys())))
+    ordered = sorted(properties, key=lambda prop: -np.dtype(PROPERTY_TYPES[prop['type']][0]).itemsize)
+    fields = [(prop['id'], PROPERTY_TYPES[prop['type']][0], (PROPERTY_TYPES[prop['type']][1],))
+              for prop in ordered]
+    size = sum(np.dtype(dtype).itemsize * width for _, dtype, (width,) in fields)
+    records = np.zeros(count, dtype=np.dtype({'names': [field[0] for field in fields],
+                                              'formats': [(field[1], field[2]) for field in fields],
+                                              'itemsize': -(-size // 4) * 4}))
+    for prop in ordered:
+        records[prop['id']] = np.asarray(values[prop['id']]).reshape(count, -1)
+    return records.view('u1').reshape(count, -1)
+
+
+def _get_propertytype(prop_id, values):
+    """Infer the property type of values: the smallest integer type, float32 or rgb(a) for colors."""
+    values = pd.Series(values)
+    if values.dtype == object:
+        try:
+            values = pd.to_numeric(values)
+        except (TypeError, ValueError):
+            pass
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        for proptype in ['uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32']:
+            info = np.iinfo(PROPERTY_TYPES[proptype][0])
+            if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+                return proptype
+        raise ValueError('Values of property "{0}" do not fit in a 32 bit integer'.format(prop_id))
+    if pd.api.types.is_float_dtype(values):
+        return 'float32'
+    if any((isinstance(value, str) and len(value) == 9) or (not isinstance(value, str) and len(value) == 4)
+           for value in values):
+        return 'rgba'
+    return 'rgb'
+
+
+def _get_colors(values, width):
+    """Convert colors (css names, '#rrggbb[aa]' hex or tuples) to an (N, 3) | (N, 4) uint8 array."""
+    codes, uniques = pd.factorize(pd.Series([value if isinstance(value, str) else tuple(value)
+                                             for value in values], dtype=object))
+    colors = np.zeros((len(uniques), width), dtype='u1')
+    for idx, color in enumerate(uniques):
+        if isinstance(color, str):
+            if not color.startswith('#'):
+                color = webcolors.name_to_hex(color)
+            if len(color) == 4:
+                color = webcolors.normalize_hex(color)
+            color = [int(color[pos:pos + 2], 16) for pos in range(1, len(color), 2)]
+        color = list(color) + [255] * (width - len(color))
+        colors[idx] = color[:width]
+    return colors[codes].reshape(len(values), width)
+
+
+def get_annotationproperties(table, properties):
+    """Get typed annotation properties from the columns of a table.
+
+    Parameters
+    ----------
+    table : dataframe | dict
+        columns of per-annotation values, colors ('rgb'/'rgba') as css names, hex strings or tuples.
+    properties : list
+        column names, whose type is inferred from the values, or property specifications (dicts with
+        the column name as 'id', a 'type' out of PROPERTY_TYPES and optionally 'description',
+        'enum_values' and 'enum_labels').
+
+    Returns
+    -------
+    specs : list
+        property specifications, as written in the info file.
+    encoded : numpy.ndarray
+        (N, nbytes) encoded properties (see encode_properties), None if there are no properties.
+    """
+    specs = []
+    values = {}
+    for prop in properties or []:
+        spec = dict(prop) if isinstance(prop, dict) else {'id': prop}
+        if not re.match(r'^[a-z][a-zA-Z0-9_]*$', spec['id']):
+            raise ValueError('Invalid property id "{0}". Ids have to start with a lowercase letter '
+                             'followed by letters, digits or underscores'.format(spec['id']))
+        column = np.asarray(table[spec['id']])
+        spec.setdefault('type', _get_propertytype(spec['id'], column))
+        if spec['type'] in ['rgb', 'rgba']:
+            column = _get_colors(column, PROPERTY_TYPES[spec['type']][1])
+        elif column.dtype == object:
+            column = pd.to_numeric(pd.Series(column)).values
+        specs.append(spec)
+        values[spec['id']] = column
+
+    if not specs:
+        return specs, None
+    count = len(next(iter(values.values())))
+    return specs, encode_properties(specs, values, count)
+
+
+def encode_byid(positions, relatedids=(), properties=None):
+    """Encode the by_id entries of point annotations.
+
+    Each entry holds the position ('<3f'), the encoded properties if any and, for every relationship,
+    the number of related segments ('<I') and the segment id ('<Q'). A segment id of 0 means the
+    annotation has no related segment for that relationship.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray
+        (N, 3) positions of the annotations.
+    relatedids : list
+        one (N,) array of segment ids per relationship of the layer.
+    properties : numpy.ndarray
+        (N, nbytes) encoded properties of the annotations (see encode_properties).
+
+    Returns
+    -------
+    entries : list
+        N encoded entries (bytes).
+    """
+    positions = np.asarray(positions).reshape(-1, 3)
+    relatedids = [np.asarray(segmentids, dtype='<u8') for segmentids in relatedids]
+    propertysize = 0 if properties is None else properties.shape[1]
+    if relatedids:
+        present = np.stack([segmentids != 0 for segmentids in relatedids], axis=1)
+    else:
+        present = np.zeros((len(positions), 0), dtype=bool)
+
+    entries = [None] * len(positions)
+    # one fixed size record layout per combination of present relationships..
+    patterns, inverse = np.unique(present, axis=0, return_inverse=True)
+    for patternidx, pattern in enumerate(patterns):
+        selected = np.flatnonzero(inverse.reshape(-1) == patternidx)
+        fields = [('position', '<f4', (3,))]
+        if propertysize:
+            fields += [('properties', 'u1', (propertysize,))]
+        for relidx, related in enumerate(pattern):
+            fields += [('count%d' % relidx, '<u4')]
+            if related:
+                fields += [('segment%d' % relidx, '<u8')]
+        records = np.zeros(len(selected), dtype=np.dtype(fields))
+        records['position'] = positions[selected]
+        if propertysize:
+            records['properties'] = properties[selected]
+        for relidx, related in enumerate(pattern):
+            if related:
+                records['count%d' % relidx] = 1
+                records['segment%d' % relidx] = relatedids[relidx][selected]
+
+        itemsize = records.dtype.itemsize
+        data = records.tobytes()
+        for recordidx, annotationidx in enumerate(selected):
+            entries[annotationidx] = data[recordidx * itemsize:(recordidx + 1) * itemsize]
+    return entries
+
+
+def put_shardedindex(indexpath, sharding, entries, progress=False):
+    """Write an annotation index (by_id or relationship) as shard files.
+
+    Parameters
+    ----------
+    indexpath : str
+        local path of the folder of the index, e.g. '<layer>/by_id'.
+    sharding : dict | ShardingSpecification
+        sharding specification, as written in the info file.
+    entries : dict
+        key (annotation or segment id) to encoded bytes.
+    progress : bool
+        progress bar for sharding operation
+
+    Returns
+    -------
+    shardfiles : list
+        names of the written shard files.
+    """
+    if isinstance(sharding, dict):
+        sharding = ShardingSpecification.from_dict(sharding)
+    # grouped with shard_locations, synthesize_shards overflows for murmurhash keys..
+    keys = list(entries.keys())
+    shards, minishards = shard_locations(sharding, np.array(keys, dtype=np.uint64))
+    shardgroups = {}
+    for key, shard, minishard in zip(keys, shards.tolist(), minishards.tolist()):
+        shardgroups.setdefault(shard, {}).setdefault(minishard, {})[key] = entries[key]
+
+    makelayerdirs(indexpath)
+    shardfiles = []
+    for shard, minishardgroups in tqdm(shardgroups.items(), desc='Writing Shard Files', disable=not progress):
+        fname = shard_filename(sharding, shard)
+        with open_layerfile(indexpath + '/' + fname, 'wb') as f:
+            f.write(sharding.synthesize_shard(minishardgroups, presorted=True))
+        shardfiles.append(fname)
+    print('written %d entries into %d shards at: %s' % (len(entries), len(shardfiles), indexpath))
+    return shardfiles
+
+
+def read_shardfile(data, sharding):
+    """Decode the entries of a shard file of an annotation index.
+
+    Parameters
+    ----------
+    data : bytes
+        content of the shard file.
+    sharding : dict | ShardingSpecification
+        sharding specification the shard file was written with.
+
+    Returns
+    -------
+    entries : dict
+        key (annotation or segment id) to encoded bytes.
+    """
+    if isinstance(sharding, dict):
+        sharding = ShardingSpecification.from_dict(sharding)
+    indexlength = sharding.index_length()
+    shardindex = np.frombuffer(data, dtype='<u8', count=indexlength // 8).reshape(-1, 2)
+    entries = {}
+    for start, end in shardindex:
+        if start == end:
+            continue
+        minishard = data[indexlength + int(start):indexlength + int(end)]
+        if sharding.minishard_index_encoding == 'gzip':
+            minishard = gzip.decompress(minishard)
+        # keys and offsets are delta encoded, offsets relative to the end of the previous entry..
+        keys, offsets, sizes = np.frombuffer(minishard, dtype='<u8').reshape(3, -1)
+        keys = np.cumsum(keys)
+        starts = np.cumsum(offsets + np.concatenate([[0], sizes[:-1]]).astype('<u8'))
+        for key, offset, size in zip(keys, starts, sizes):
+            entry = data[indexlength + int(offset):indexlength + int(offset + size)]
+            if sharding.data_encoding == 'gzip':
+                entry = gzip.decompress(entry)
+            entries[int(key)] = entry
+    return entries
+
+
+def shard_locations(sharding, keys):
+    """Compute the shard and minishard every key of a sharded index is written to.
+
+    The murmurhash is computed here on the unsigned 64 bit value of the hash, ShardingSpecification's
+    own compute_shard_location overflows for keys whose hash is negative as a signed integer.
+
+    Parameters
+    ----------
+    sharding : dict | ShardingSpecification
+        sharding specification, as written in the info file.
+    keys : numpy.ndarray
+        (N,) annotation, segment or skeleton ids.
+
+    Returns
+    -------
+    shards : numpy.ndarray
+        (N,) shard numbers of the keys.
+    minishards : numpy.ndarray
+        (N,) minishard numbers of the keys (inside their shard).
+    """
+    if isinstance(sharding, dict):
+        sharding = ShardingSpecification.from_dict(sharding)
+    chunkids = np.asarray(keys, dtype=np.uint64) >> np.uint64(sharding.preshift_bits)
+    if sharding.hash == 'murmurhash3_x86_128':
+        chunkids = np.array([mmh3.hash64(chunkid.tobytes(), x64arch=False)[0] & 0xFFFFFFFFFFFFFFFF
+                             for chunkid in chunkids], dtype=np.uint64).reshape(chunkids.shape)
+    minishards = chunkids & np.uint64(sharding.minishard_mask)
+    shards = (chunkids & np.uint64(sharding.shard_mask)) >> np.uint64(sharding.minishard_bits)
+    return shards, minishards
+
+
+def shard_filename(sharding, shard):
+    """Return the name of the file of a shard ('<hex shard number>.shard')."""
+    return format(int(shard), 'x').zfill(int(np.ceil(int(sharding.shard_bits) / 4.0))) + '.shard'
+
+
+def update_shardedindex(indexpath, sharding, entries, progress=False):
+    """Add or replace entries of an annotation index written as shard files.
+
+    Only the shard files the keys of the entries fall in are read, merged and written again.
+
+    Parameters
+    ----------
+    indexpath : str
+        local path of the folder of the index, e.g. '<layer>/by_id'.
+    sharding : dict | ShardingSpecification
+        sharding specification, as written in the info file.
+    entries : dict
+        key (annotation or segment id) to encoded bytes.
+    progress : bool
+        progress bar for sharding operation
+
+    Returns
+    -------
+    shardfiles : list
+        names of the written shard files.
+    """
+    if isinstance(sharding, dict):
+        sharding = ShardingSpecification.from_dict(sharding)
+    shards, _ = shard_locations(sharding, np.array(list(entries.keys()), dtype=np.uint64))
+    shardnames = set(shard_filename(sharding, shard) for shard in np.unique(shards))
+    merged = {}
+    for shardname in shardnames:
+        shardfile = indexpath + '/' + shardname
+        if layerfile_exists(shardfile):
+            with open_layerfile(shardfile, 'rb') as f:
+                merged.update(read_shardfile(f.read(), sharding))
+    merged.update(entries)
+    return put_shardedindex(indexpath, sharding, merged, progress)
+
+
+def annotation_bounds(positions):
+    """Compute the lower and upper bound of the annotation positions.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray
+        (N, 3) positions of the annotations.
+
+    Returns
+    -------
+    lower_bound, upper_bound : list
+        integer bounds, every position p satisfies lower_bound <= p < upper_bound.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    if len(positions) == 0:
+        return [0, 0, 0], [1, 1, 1]
+    lower_bound = np.floor(positions.min(axis=0))
+    upper_bound = np.floor(positions.max(axis=0)) + 1
+    return lower_bound.astype(int).tolist(), upper_bound.astype(int).tolist()
+
+
+def spatial_levels(lower_bound, upper_bound, limit=10000, max_levels=8):
+    """Compute the levels of a multi-level spatial index covering the bounds.
+
+    Level 0 is a single chunk, every next level halves the chunks along their longer axes.
+
+    Returns
+    -------
+    spatial : list
+        max_levels levels of the spatial index, as written in the info file.
+    """
+    lower_bound = np.asarray(lower_bound, dtype=float)
+    extent = np.asarray(upper_bound, dtype=float) - lower_bound
+    chunk_size = extent.copy()
+    spatial = []
+    for level in range(max_levels):
+        grid_shape = np.maximum(np.ceil(extent / chunk_size - 1e-9), 1).astype(int)
+        spatial.append({'key': 'spatial' + str(level),
+                        'grid_shape': grid_shape.tolist(),
+                        'chunk_size': chunk_size.tolist(),
+                        'limit': int(limit)})
+        chunk_size = np.where(chunk_size >= chunk_size.max() / 2, chunk_size / 2, chunk_size)
+    return spatial
+
+
+def build_spatialindex(positions, lower_bound, upper_bound, limit=10000, max_levels=8):
+    """Split annotations into a multi-level spatial index.
+
+    Level 0 is a single chunk covering the bounds, every next level halves the chunks along their
+    longer axes (an octree for isotropic bounds). Each chunk keeps a random subsample of at most
+    limit of the annotations that fall in it, the rest are passed on to the next level, so every
+    annotation is written once and neuroglancer can show the coarse levels first. The last level
+    keeps all annotations that are still left.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray
+        (N, 3) positions of the annotations.
+    lower_bound : list
+        lower bound of the positions (see annotation_bounds).
+    upper_bound : list
+        upper bound of the positions (see annotation_bounds).
+    limit : int
+        maximum number of annotations per chunk.
+    max_levels : int
+        maximum number of levels.
+
+    Returns
+    -------
+    spatial : list
+        levels of the spatial index, as written in the info file.
+    chunks : list
+        for every level, a dict of chunk name ('x_y_z') to the indices of its annotations.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    lower_bound = np.asarray(lower_bound, dtype=float)
+    # shuffled once, the stable sorts below keep every chunk a random subsample..
+    remaining = np.random.default_rng(0).permutation(len(positions))
+
+    spatial = []
+    chunks = []
+    levels = spatial_levels(lower_bound, upper_bound, limit, max_levels)
+    for levelidx, level in enumerate(levels):
+        grid_shape = np.asarray(level['grid_shape'])
+        cells = np.floor((positions[remaining] - lower_bound) / np.asarray(level['chunk_size'])).astype(np.int64)
+        cells = np.clip(cells, 0, grid_shape - 1)
+        cellkeys = np.ravel_multi_index(cells.T, grid_shape)
+        order = np.argsort(cellkeys, kind='stable')
+        cellkeys, starts, counts = np.unique(cellkeys[order], return_index=True, return_counts=True)
+
+        if levelidx == len(levels) - 1:
+            kept = counts
+        else:
+            kept = np.minimum(counts, limit)
+        levelchunks = {}
+        for cellkey, start, numkept in zip(cellkeys, starts, kept):
+            chunkname = '_'.join(str(cell) for cell in np.unravel_index(cellkey, grid_shape))
+            levelchunks[chunkname] = remaining[order[start:start + numkept]]
+        rank = np.arange(len(order)) - np.repeat(starts, counts)
+        passed = order[rank >= np.repeat(kept, counts)]
+
+        spatial.append(level)
+        chunks.append(levelchunks)
+        remaining = remaining[passed]
+        if len(remaining) == 0:
+            break
+
+    return spatial, chunks
+
+
+def place_annotations(positions, spatial, lower_bound, counts):
+    """Assign new annotations to chunks of an already written spatial index.
+
+    Each annotation goes to the coarsest level whose chunk around it holds less than limit annotations,
+    or else to the finest level, so the existing chunks can be extended without building the index again.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray
+        (N, 3) positions of the new annotations, inside the bounds of the index.
+    spatial : list
+        levels of the spatial index, as written in the info file.
+    lower_bound : list
+        lower bound of the index, as written in the info file.
+    counts : dict
+        chunk key ('spatial<level>/x_y_z') to the number of annotations it already holds.
+
+    Returns
+    -------
+    placed : dict
+        chunk key to the indices of the new annotations written to it.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    lower_bound = np.asarray(lower_bound, dtype=float)
+    remaining = np.random.default_rng(0).permutation(len(positions))
+    placed = {}
+    for levelidx, level in enumerate(spatial):
+        if len(remaining) == 0:
+            break
+        grid_shape = np.asarray(level['grid_shape'])
+        cells = np.floor((positions[remaining] - lower_bound) / np.asarray(level['chunk_size'])).astype(np.int64)
+        cells = np.clip(cells, 0, grid_shape - 1)
+        cellkeys = np.ravel_multi_index(cells.T, grid_shape)
+        order = np.argsort(cellkeys, kind='stable')
+        cellkeys, starts, numcells = np.unique(cellkeys[order], return_index=True, return_counts=True)
+
+        passed = []
+        for cellkey, start, numcell in zip(cellkeys, starts, numcells):
+            chunkname = '_'.join(str(cell) for cell in np.unravel_index(cellkey, grid_shape))
+            chunkkey = level['key'] + '/' + chunkname
+            if levelidx == len(spatial) - 1:
+                room = numcell
+            else:
+                room = min(max(level['limit'] - counts.get(chunkkey, 0), 0), numcell)
+            if room:
+                placed[chunkkey] = remaining[order[start:start + room]]
+            passed.append(order[start + room:start + numcell])
+        remaining = remaining[np.concatenate(passed)]
+    return placed
+
+
+def update_annotationinfo(infofile, **fields):
+    """Update fields (e.g. bounds, spatial levels) of an already written annotation info file.
+
+    On disk the info is written to a temporary file first and then moved in place, so the dataserver
+    never serves a partially written info (files of a MemoryStore are only stored once complete).
+    """
+    with open_layerfile(infofile, 'r') as f:
+        info = json.load(f)
+    info.update(fields)
+    if get_memorystore(infofile) is not None:
+        with open_layerfile(infofile, 'w') as f:
+            json.dump(info, f)
+        return info
+    with open(infofile + '.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(infofile + '.tmp', infofile)
+    return info
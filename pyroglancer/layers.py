@@ -13,19 +13,29 @@
 
 """Module contains functions to handle different types of neuroglancer layers."""
 
+from .annotations import annotation_shardingspec
 from .loadconfig import getconfigdata
+from .localserver import get_memorystore, invalidate_cache
 from .ngviewer import openviewer
 from .points import annotate_points
+from .points import append_points
 from .points import create_pointinfo
+from .points import POINT_MANIFEST
 from .points import upload_points
+from .points import upload_pointtable
 from .skeletons import to_ngskeletons
 from .skeletons import uploadshardedskeletons
 from .skeletons import uploadskeletons
+from .synapses import create_combinedsynapseinfo
 from .synapses import create_synapseinfo
+from .synapses import synapse_relationshipspec
+from .synapses import synapse_shardingspec
+from .synapses import upload_combinedsynapses
 from .synapses import upload_synapses
 from .utils import get_alphavalue
 from .utils import get_annotationstatetype
 from .utils import get_hexcolor
+from .utils import layerfile_exists
 from .utils import get_scalevalue
 from .volumes import to_ngmesh
 from .volumes import uploadsingleresmeshes
@@ -113,14 +123,16 @@ def add_precomputed(layer_kws):
         layer_serverdir, layer_host = get_ngserver()
         flush_precomputed(layer_serverdir, layer_name)
 
-        skelsource, skelseglist, skelsegnamelist = to_ngskeletons(layer_source)
+        skelsource, skelseglist, skelsegnamelist = to_ngskeletons(layer_source, layer_kws.get('n_workers', None))
         layer_shard = layer_kws.get('sharding', False)
+        layer_precompress = layer_kws.get('precompress', None)
         if layer_shard:
             shardprogress = layer_kws.get('progress', False)
             uploadshardedskeletons(skelsource, skelseglist, skelsegnamelist,
-                                   layer_serverdir, layer_name, shardprogress)
+                                   layer_serverdir, layer_name, shardprogress, layer_precompress)
         else:
-            uploadskeletons(skelsource, skelseglist, skelsegnamelist, layer_serverdir, layer_name)
+            uploadskeletons(skelsource, skelseglist, skelsegnamelist, layer_serverdir, layer_name,
+                            layer_precompress)
 
         return skelseglist, layer_host
     elif layer_type == 'volumes':
@@ -132,34 +144,57 @@ def add_precomputed(layer_kws):
         volumedatasource, volumeidlist, volumenamelist = to_ngmesh(layer_source)
         layer_shard = layer_kws.get('sharding', False)
         layer_res = layer_kws.get('multires', False)
+        layer_precompress = layer_kws.get('precompress', None)
         if layer_res or layer_shard:
             if layer_shard:
                 shardprogress = layer_kws.get('progress', False)
                 uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, layer_serverdir,
-                                            layer_name, shardprogress)
+                                            layer_name, shardprogress, layer_precompress)
             else:
-                uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, layer_serverdir, layer_name)
+                uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, layer_serverdir, layer_name,
+                                     layer_precompress)
         else:
-            uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, layer_serverdir, layer_name)
+            uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, layer_serverdir, layer_name,
+                                  layer_precompress)
 
         return volumeidlist, layer_host
     elif layer_type == 'synapses':
         dimensions = _handle_ngdimensions(layer_kws)
         layer_source = layer_kws['source']
         linked_layername = layer_kws['linked_layername']
+        layer_combined = layer_kws.get('combined', False)
         layer_serverdir, layer_host = get_ngserver()
-        presynapsedir = '/precomputed/' + linked_layername + '/presynapses'
-        postsynapsedir = '/precomputed/' + linked_layername + '/postsynapses'
         print('flushing stuff..')
-        flush_precomputed(layer_serverdir, presynapsedir)
-        flush_precomputed(layer_serverdir, postsynapsedir)
-        print('presynapse stuff at:', layer_serverdir, presynapsedir)
-        print('postsynapse stuff at:', layer_serverdir, postsynapsedir)
+        if layer_combined:
+            synapsedir = '/precomputed/' + linked_layername + '/synapses'
+            flush_precomputed(layer_serverdir, synapsedir)
+            print('synapse stuff at:', layer_serverdir, synapsedir)
+        else:
+            presynapsedir = '/precomputed/' + linked_layername + '/presynapses'
+            postsynapsedir = '/precomputed/' + linked_layername + '/postsynapses'
+            flush_precomputed(layer_serverdir, presynapsedir)
+            flush_precomputed(layer_serverdir, postsynapsedir)
+            print('presynapse stuff at:', layer_serverdir, presynapsedir)
+            print('postsynapse stuff at:', layer_serverdir, postsynapsedir)
 
         layer_path = layer_serverdir + '/precomputed/' + linked_layername
 
-        synapse_path = create_synapseinfo(dimensions, layer_path)
-        upload_synapses(layer_source, synapse_path)
+        sharding = None
+        relationship_sharding = None
+        if layer_kws.get('sharding', False):
+            sharding = synapse_shardingspec(layer_source, layer_combined)
+            relationship_sharding = synapse_relationshipspec(layer_source)
+        if layer_combined:
+            synapse_path = create_combinedsynapseinfo(dimensions, layer_path, sharding, relationship_sharding)
+            upload_combinedsynapses(layer_source, synapse_path, layer_kws.get('precompress', None), sharding,
+                                    layer_kws.get('progress', False), layer_kws.get('limit', 10000),
+                                    relationship_sharding, layer_kws.get('n_workers', None),
+                                    layer_kws.get('properties', None))
+        else:
+            synapse_path = create_synapseinfo(dimensions, layer_path, sharding, relationship_sharding)
+            upload_synapses(layer_source, synapse_path, layer_kws.get('precompress', None), sharding,
+                            layer_kws.get('progress', False), layer_kws.get('limit', 10000), relationship_sharding,
+                            layer_kws.get('n_workers', None), layer_kws.get('properties', None))
         return layer_host
     elif layer_type == 'points':
         layer_source = layer_kws['source']
@@ -168,9 +203,30 @@ def add_precomputed(layer_kws):
         layer_serverdir, layer_host = get_ngserver()
         layer_scale = get_scalevalue(layer_kws)
 
+        manifestfile = os.path.join(layer_serverdir, 'precomputed', layer_name, POINT_MANIFEST)
+        if layer_kws.get('append', False) and not isinstance(layer_source, str) and layerfile_exists(manifestfile):
+            append_points(layer_source, layer_serverdir, layer_name, layer_scale,
+                          layer_kws.get('precompress', None), layer_kws.get('progress', False))
+            return layer_host, layer_name
+
         flush_precomputed(layer_serverdir, layer_name)
-        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
-        upload_points(layer_source, points_path, layer_name, layer_scale)
+        if isinstance(layer_source, str):
+            # a parquet/feather/csv file, streamed in batches of rows..
+            # the by_id sharding is sized for the rows counted by upload_pointtable..
+            points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+            upload_pointtable(layer_source, points_path, layer_name, layer_scale,
+                              layer_kws.get('precompress', None), layer_kws.get('sharding', False) or None,
+                              layer_kws.get('progress', False), layer_kws.get('limit', 10000),
+                              layer_kws.get('properties', None), layer_kws.get('batch_size', 1000000))
+            return layer_host, layer_name
+
+        sharding = None
+        if layer_kws.get('sharding', False):
+            sharding = annotation_shardingspec(len(layer_source))
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name, sharding)
+        upload_points(layer_source, points_path, layer_name, layer_scale, layer_kws.get('precompress', None),
+                      sharding, layer_kws.get('progress', False), layer_kws.get('limit', 10000),
+                      layer_kws.get('properties', None))
 
         return layer_host, layer_name
 
@@ -194,6 +250,10 @@ def flush_precomputed(path, subdir):
     if os.path.exists(path):
         print('deleting..', path)
         shutil.rmtree(path)
+    store = get_memorystore(path)
+    if store is not None:
+        store.remove(path)
+    invalidate_cache(path)
 
 
 def setlayerproperty(ngviewer, property_kws):
@@ -531,7 +591,7 @@ def handle_vols(ngviewer, path, layer_name, segmentColors, alpha, layer_res):
     return ngviewer
 
 
-def handle_synapses(ngviewer, path, layer_linked):
+def handle_synapses(ngviewer, path, layer_linked, combined=False):
     """Add pre/post-synapses hosted via http as a neuroglancer layer.
 
     Parameters
@@ -542,6 +602,9 @@ def handle_synapses(ngviewer, path, layer_linked):
         local path of the precomputed hosted layer.
     layer_linked: str
         name of the linked layer.
+    combined: bool
+        add the single layer of pre and postsynapses (see synapses.create_combinedsynapseinfo) instead of
+        one layer each.
 
     Returns
     -------
@@ -551,6 +614,20 @@ def handle_synapses(ngviewer, path, layer_linked):
     # This function adds synapses in the precomputed format hosted remotely via http to a neuroglancer instance.
     presynapsepath = 'precomputed://' + path + '/precomputed/' + layer_linked + '/presynapses'
     postsynapsepath = 'precomputed://' + path + '/precomputed/' + layer_linked + '/postsynapses'
+    if combined:
+        synapsepath = 'precomputed://' + path + '/precomputed/' + layer_linked + '/synapses'
+        with ngviewer.txn() as s:
+            s.layers['synapses'] = neuroglancer.AnnotationLayer(
+                source=synapsepath,
+                linked_segmentation_layer={'presynapses_cell': layer_linked, 'postsynapses_cell': layer_linked},
+                filter_by_segmentation=['presynapses_cell', 'postsynapses_cell'],
+                shader='''
+                        void main() {
+                          setColor(prop_synapsetype() == 0u ? vec3(1.0, 0.0, 0.0) : vec3(0.0, 0.0, 1.0));
+                        }
+                        ''')
+        return ngviewer
+
     with ngviewer.txn() as s:
         s.layers['presynapses'] = neuroglancer.AnnotationLayer(
             source=presynapsepath,
@@ -682,7 +759,7 @@ def create_nglayer(ngviewer=None, layout='xy-3d', **kwargs):
             # synapse_path = create_synapseinfo(dimensions, layer_serverdir)
             # upload_synapses(layer_source, synapse_path)
 
-            ngviewer = handle_synapses(ngviewer, layer_host, layer_linked)
+            ngviewer = handle_synapses(ngviewer, layer_host, layer_linked, layer_kws.get('combined', False))
 
         if layer_type == 'points':
             layer_annottype = get_annotationstatetype(layer_kws)
@@ -15,16 +15,29 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-# TODO:
-# - Add support for server to look at gzip files using do_GET()
-
 """This code is used to serve local data via http port, so it can be read by neuroglancer."""
 
+import asyncio
+import bisect
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import datetime
+import email.utils
+import io
+import json
+import mmap
 import os
+import queue
 import re
+import socket
+import struct
 import sys
+import tarfile
 import tempfile
-from threading import Thread
+import time
+from threading import Event, Lock, Thread
+import uuid
+import zipfile
 from http.server import SimpleHTTPRequestHandler, HTTPServer
 import types
 import shutil
@@ -37,101 +50,954 @@ def copy_byte_range(infile, outfile, start=None, stop=None, bufsize=16*1024):
     if start is not None:
         infile.seek(start)
     while 1:
-        to_read = min(bufsize, stop + 1 - infile.tell() if stop else bufsize)
+        to_read = min(bufsize, stop + 1 - infile.tell() if stop is not None else bufsize)
         buf = infile.read(to_read)
         if not buf:
             break
         outfile.write(buf)
 
 
-BYTE_RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)?$')
+def can_sendfile(infile):
+    '''Returns True if the file can be sent with os.sendfile (platform support and a real fd).'''
+    if not hasattr(os, 'sendfile'):
+        return False
+    try:
+        infile.fileno()
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+def send_byte_range(infile, sock, start=None, stop=None):
+    '''Like copy_byte_range, but let the kernel copy the range from file to socket (zero-copy).
+    Both start and stop are inclusive.
+    '''
+    offset = start or 0
+    count = None if stop is None else stop + 1 - offset
+    # socket.sendfile drives os.sendfile, and copes with sockets that have a timeout set..
+    sock.sendfile(infile, offset, count)
+
+
+# precompressed siblings the server looks for, in the order of preference..
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def parse_accept_encoding(accept_encoding):
+    '''Returns the set of content codings in an 'Accept-Encoding' header the client accepts.
+    Codings with a quality value of 0 are left out.
+    '''
+    accepted = set()
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip().lower()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                pass
+        if quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+BYTE_RANGE_RE = re.compile(r'(\d*)-(\d*)$')
+
+
+def parse_byte_ranges(byte_range):
+    '''Returns the list of ranges in 'bytes=0-99,200-299,-500' or throws ValueError.
+    Each range is a (first, last) tuple, last may be None (till the end of the file) and a
+    suffix range ('-500', the last 500 bytes) is returned as (None, 500).
+    '''
+    if byte_range.strip() == '':
+        return []
+
+    unit, _, rangeset = byte_range.partition('=')
+    if unit.strip() != 'bytes' or not rangeset.strip():
+        raise ValueError('Invalid byte range %s' % byte_range)
+
+    ranges = []
+    for rangespec in rangeset.split(','):
+        m = BYTE_RANGE_RE.match(rangespec.strip())
+        if not m or m.groups() == ('', ''):
+            raise ValueError('Invalid byte range %s' % byte_range)
+        first, last = [int(x) if x else None for x in m.groups()]
+        if first is not None and last is not None and last < first:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        ranges.append((first, last))
+    return ranges
 
 
 def parse_byte_range(byte_range):
     '''Returns the two numbers in 'bytes=123-456' or throws ValueError.
-    The last number or both numbers may be None.
+    The last number or both numbers may be None, a suffix range 'bytes=-456' is (None, 456).
+    Use parse_byte_ranges for headers with several ranges.
     '''
-    if byte_range.strip() == '':
+    ranges = parse_byte_ranges(byte_range)
+    if not ranges:
         return None, None
+    if len(ranges) > 1:
+        raise ValueError('Multiple byte ranges %s' % byte_range)
+    return ranges[0]
 
-    m = BYTE_RANGE_RE.match(byte_range)
-    if not m:
-        raise ValueError('Invalid byte range %s' % byte_range)
 
-    first, last = [x and int(x) for x in m.groups()]
-    if last and last < first:
-        raise ValueError('Invalid byte range %s' % byte_range)
+def resolve_byte_range(first, last, file_len):
+    '''Returns the inclusive (first, last) offsets of a parsed range within a file of file_len bytes,
+    or None if the range is not satisfiable.
+    '''
+    if first is None:
+        # suffix range, the last `last` bytes..
+        if last == 0 or file_len == 0:
+            return None
+        return max(0, file_len - last), file_len - 1
+    if first >= file_len:
+        return None
+    if last is None or last >= file_len:
+        last = file_len - 1
     return first, last
 
 
+def multipart_part_header(boundary, ctype, first, last, file_len):
+    '''Returns the boundary line and headers that precede one part of a multipart/byteranges body.'''
+    return ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+            % (boundary, ctype, first, last, file_len)).encode('latin-1')
+
+
+def make_etag(fs, encoding=None):
+    '''Returns a strong ETag for a file, built from the inode, size and mtime of its stat result.'''
+    etag = '%x-%x-%x' % (fs.st_ino, fs.st_size, fs.st_mtime_ns)
+    if encoding:
+        etag += '-' + encoding
+    return '"%s"' % etag
+
+
+def etag_matches(if_none_match, etag):
+    '''Returns True if the etag is in an 'If-None-Match' header (weak comparison, '*' matches any).'''
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def parse_http_date(httpdate):
+    '''Returns an HTTP date header as a unix timestamp (in seconds), or None if it is invalid.'''
+    try:
+        parsed = email.utils.parsedate_to_datetime(httpdate)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+# revalidate everything (cheap with the etags/304s)..
+CACHE_CONTROL = 'no-cache'
+# shard files that are never rewritten under the same name can be cached for good..
+IMMUTABLE_SHARDS_CACHE_CONTROL = [(r'\.shard$', 'public, max-age=31536000, immutable'),
+                                  (r'', CACHE_CONTROL)]
+
+
+def get_cache_control(policy, path):
+    '''Returns the 'Cache-Control' value for a request path.
+
+    The policy is either a string used for all paths, or a list of (regex, value) rules where the
+    first rule whose regex is found in the path wins. None uses CACHE_CONTROL.
+    '''
+    if policy is None:
+        return CACHE_CONTROL
+    if isinstance(policy, str):
+        return policy
+    urlpath = path.split('?', 1)[0].split('#', 1)[0]
+    for pattern, value in policy:
+        if re.search(pattern, urlpath):
+            return value
+    return None
+
+
+class ResponseCache(object):
+    """Bounded LRU cache for the bodies of small responses (whole files and range slices).
+
+    Entries are keyed by the file path, its etag (inode, size, mtime) and the byte range, so a
+    rewritten file never serves stale data. The least recently used entries are dropped once the
+    cached bytes exceed max_bytes, bodies larger than max_entry_bytes are never cached.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+        """Initialise an empty cache."""
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.cachedbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        """Return the cached body for key (marking it as recently used), or None."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Add a body to the cache, evicting the least recently used ones if needed."""
+        if len(data) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.cachedbytes += len(data)
+            while self.cachedbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.cachedbytes -= len(evicted)
+
+    def invalidate(self, path):
+        """Drop all entries for the file path, or for any file inside it if it is a directory."""
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == path or key[0].startswith(path + os.sep):
+                    self.cachedbytes -= len(self.entries.pop(key))
+
+    def stats(self):
+        """Return the hit/miss counters and the current size of the cache."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.cachedbytes}
+
+
+METRICS_PATH = '/_pyroglancer/metrics'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class ServerMetrics(object):
+    """Per-request counters of the dataserver: status codes, bytes sent, latency histograms and cache hits.
+
+    Requests are counted by kind, 'full' or 'range' (single and multipart range requests). The
+    counters are exposed at METRICS_PATH in the Prometheus text format (see to_prometheus), and
+    each request can also be written as one JSON line to an access log stream.
+    """
+
+    def __init__(self, accesslog=None):
+        """Initialise all counters to zero.
+
+        Parameters
+        ----------
+        accesslog :  str | file object
+            file path (appended to) or text stream for the access log lines, None disables the access log
+        """
+        self.closelog = isinstance(accesslog, str)
+        if self.closelog:
+            accesslog = open(accesslog, 'a', buffering=1)
+        self.accesslog = accesslog
+        self.requests = {}
+        self.bytessent = {}
+        self.latencies = {}
+        self.cachehits = 0
+        self.cachemisses = 0
+        self.lock = Lock()
+
+    def observe(self, status, kind, nbytes, duration, cachehit=None):
+        """Count one request with its status code, kind, body bytes, duration (seconds) and cache use."""
+        with self.lock:
+            self.requests[(status, kind)] = self.requests.get((status, kind), 0) + 1
+            self.bytessent[kind] = self.bytessent.get(kind, 0) + nbytes
+            if kind not in self.latencies:
+                self.latencies[kind] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram = self.latencies[kind]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            histogram[1] += duration
+            if cachehit is True:
+                self.cachehits += 1
+            elif cachehit is False:
+                self.cachemisses += 1
+
+    def log(self, entry):
+        """Write one access log entry (a dict) as a JSON line."""
+        if self.accesslog is None:
+            return
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.accesslog.write(line)
+
+    def close(self):
+        """Close the access log, if it was opened from a file path."""
+        if self.closelog:
+            self.accesslog.close()
+
+    def snapshot(self):
+        """Return a copy of the counters as a dict."""
+        with self.lock:
+            return {'requests': {'%s %s' % key: count for key, count in self.requests.items()},
+                    'bytes_sent': dict(self.bytessent),
+                    'latency_buckets': {kind: list(zip(LATENCY_BUCKETS + (float('inf'),), counts))
+                                        for kind, (counts, _) in self.latencies.items()},
+                    'latency_sum': {kind: total for kind, (_, total) in self.latencies.items()},
+                    'cache_hits': self.cachehits, 'cache_misses': self.cachemisses}
+
+    def to_prometheus(self, cache=None):
+        """Return the counters (and the size of the ResponseCache, if given) in the Prometheus text format."""
+        prefix = 'pyroglancer_dataserver_'
+        with self.lock:
+            lines = ['# HELP %srequests_total Requests served by status code and kind.' % prefix,
+                     '# TYPE %srequests_total counter' % prefix]
+            for (status, kind), count in sorted(self.requests.items()):
+                lines.append('%srequests_total{status="%s",kind="%s"} %d' % (prefix, status, kind, count))
+            lines += ['# HELP %sresponse_bytes_total Response body bytes sent by kind.' % prefix,
+                      '# TYPE %sresponse_bytes_total counter' % prefix]
+            for kind, nbytes in sorted(self.bytessent.items()):
+                lines.append('%sresponse_bytes_total{kind="%s"} %d' % (prefix, kind, nbytes))
+            lines += ['# HELP %srequest_duration_seconds Request latency by kind.' % prefix,
+                      '# TYPE %srequest_duration_seconds histogram' % prefix]
+            for kind, (counts, total) in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%srequest_duration_seconds_bucket{kind="%s",le="%s"} %d' % (
+                        prefix, kind, le, cumulative))
+                lines.append('%srequest_duration_seconds_sum{kind="%s"} %.6f' % (prefix, kind, total))
+                lines.append('%srequest_duration_seconds_count{kind="%s"} %d' % (prefix, kind, cumulative))
+            lines += ['# HELP %scache_hits_total Responses served from the response cache.' % prefix,
+                      '# TYPE %scache_hits_total counter' % prefix,
+                      '%scache_hits_total %d' % (prefix, self.cachehits),
+                      '# HELP %scache_misses_total Cacheable responses read from the file.' % prefix,
+                      '# TYPE %scache_misses_total counter' % prefix,
+                      '%scache_misses_total %d' % (prefix, self.cachemisses)]
+        if cache is not None:
+            stats = cache.stats()
+            lines += ['# HELP %scache_bytes Bytes held in the response cache.' % prefix,
+                      '# TYPE %scache_bytes gauge' % prefix,
+                      '%scache_bytes %d' % (prefix, stats['bytes']),
+                      '# HELP %scache_entries Entries held in the response cache.' % prefix,
+                      '# TYPE %scache_entries gauge' % prefix,
+                      '%scache_entries %d' % (prefix, stats['entries'])]
+        return '\n'.join(lines) + '\n'
+
+
+class MemoryFileWriter(io.BytesIO):
+    """Writable file of a MemoryStore, the contents are stored when it is closed."""
+
+    def __init__(self, store, path):
+        """Initialise an empty file for path."""
+        io.BytesIO.__init__(self)
+        self.store = store
+        self.path = path
+
+    def close(self):
+        """Store the written contents and close the file."""
+        if not self.closed:
+            self.store[self.path] = self.getvalue()
+        io.BytesIO.close(self)
+
+
+class MemoryFileReader(io.RawIOBase):
+    """Read-only file over the contents of a MemoryStore (or ArchiveStore) file, read without copying them.
+
+    It is deliberately not an io.BytesIO, which the RequestHandler keeps for bodies holding exactly
+    the bytes to send (see ResponseBody).
+    """
+
+    def __init__(self, data):
+        """Initialise the file over data (bytes or a memoryview)."""
+        io.RawIOBase.__init__(self)
+        self.data = memoryview(data).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.data[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def readall(self):
+        chunk = bytes(self.data[self.position:])
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.data)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def view(self, start=None, stop=None):
+        """Return a memoryview of the bytes start-stop (inclusive, the whole file if both are None)."""
+        return self.data[start or 0:len(self.data) if stop is None else stop + 1]
+
+
+class MemoryStore(MutableMapping):
+    """Dict-like store of files kept in memory, served by the dataserver in place of the disk.
+
+    Keys are the absolute paths of the files (below the served directory) and values their
+    contents as bytes. Each write gets a new version number, which stands in for the inode in
+    the etag of the file, so rewritten files are never served stale.
+    """
+
+    def __init__(self):
+        """Initialise an empty store."""
+        self.files = {}
+        self.version = 0
+        self.lock = Lock()
+
+    def __getitem__(self, path):
+        return self.files[os.path.abspath(path)][0]
+
+    def __setitem__(self, path, data):
+        data = bytes(data)
+        with self.lock:
+            self.version += 1
+            mtime = time.time()
+            fs = types.SimpleNamespace(st_ino=self.version, st_size=len(data), st_mtime=mtime,
+                                       st_mtime_ns=int(mtime * 1e9))
+            self.files[os.path.abspath(path)] = data, fs
+
+    def __delitem__(self, path):
+        with self.lock:
+            del self.files[os.path.abspath(path)]
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.files
+
+    def __iter__(self):
+        return iter(list(self.files))
+
+    def __len__(self):
+        return len(self.files)
+
+    def stat(self, path):
+        """Return the size, mtime and version (as st_ino) of a file, like os.stat."""
+        try:
+            return self.files[os.path.abspath(path)][1]
+        except KeyError:
+            raise FileNotFoundError(path)
+
+    def open(self, path, mode='rb'):
+        """Open a file of the store for reading, or a new one for writing ('wb' or 'w')."""
+        if 'r' in mode:
+            try:
+                data = self[path]
+            except KeyError:
+                raise FileNotFoundError(path)
+            return MemoryFileReader(data) if 'b' in mode else io.StringIO(data.decode('utf-8'))
+        memoryfile = MemoryFileWriter(self, os.path.abspath(path))
+        return memoryfile if 'b' in mode else io.TextIOWrapper(memoryfile, encoding='utf-8')
+
+    def walk(self, path):
+        """Yield (dirpath, dirnames, filenames) for the files below path, like os.walk."""
+        path = os.path.abspath(path)
+        tree = {}
+        for filepath in self:
+            if filepath.startswith(path + os.sep):
+                dirpath, filename = os.path.split(filepath)
+                tree.setdefault(dirpath, []).append(filename)
+        for dirpath in sorted(tree):
+            dirnames = sorted(set(os.path.relpath(other, dirpath).split(os.sep)[0] for other in tree
+                                  if other.startswith(dirpath + os.sep)))
+            yield dirpath, dirnames, sorted(tree[dirpath])
+
+    def remove(self, path):
+        """Delete the file path, or all files inside it if it is a directory."""
+        path = os.path.abspath(path)
+        with self.lock:
+            for filepath in list(self.files):
+                if filepath == path or filepath.startswith(path + os.sep):
+                    del self.files[filepath]
+
+    def usage(self):
+        """Return the number of files and bytes held in the store."""
+        with self.lock:
+            return {'files': len(self.files), 'bytes': sum(fs.st_size for _, fs in self.files.values())}
+
+
+class ArchiveStore(object):
+    """Read-only store of the members of a zip or (uncompressed) tar archive, mounted at a folder.
+
+    The archive is indexed once (member path -> offset and size of its data) and read through
+    mmap, so members are served by offset without being extracted. Zip members have to be
+    stored uncompressed (see utils.pack_precomputed).
+    """
+
+    def __init__(self, archivepath, mountpath):
+        """Index the archive and map it into memory.
+
+        Parameters
+        ----------
+        archivepath :  str
+            local path of the .zip or .tar archive
+        mountpath :  str
+            local path of the folder (below the served directory) the members appear in
+        """
+        self.archivepath = archivepath
+        self.mountpath = os.path.abspath(mountpath)
+        self.fs = os.stat(archivepath)
+        if zipfile.is_zipfile(archivepath):
+            members = self._index_zip(archivepath)
+        else:
+            members = self._index_tar(archivepath)
+        self.members = {os.path.join(self.mountpath, *name.split('/')): member for name, member in members}
+        with open(archivepath, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.fs.st_size else b''
+        self.data = memoryview(self.mmap)
+
+    @staticmethod
+    def _index_zip(archivepath):
+        members = []
+        with open(archivepath, 'rb') as f, zipfile.ZipFile(f) as archive:
+            for zinfo in archive.infolist():
+                if zinfo.is_dir():
+                    continue
+                if zinfo.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError('Cannot serve compressed zip member "{0}", pack the archive uncompressed '
+                                     '(e.g. with pack_precomputed or zip -0)'.format(zinfo.filename))
+                # the data follows the local header, whose extra field may differ from the central one..
+                f.seek(zinfo.header_offset)
+                localheader = f.read(30)
+                namelen, extralen = struct.unpack('<HH', localheader[26:30])
+                members.append((zinfo.filename, (zinfo.header_offset + 30 + namelen + extralen, zinfo.file_size)))
+        return members
+
+    @staticmethod
+    def _index_tar(archivepath):
+        try:
+            archive = tarfile.open(archivepath, 'r:')
+        except tarfile.ReadError:
+            raise ValueError('Cannot serve "{0}", it is neither a zip nor an uncompressed tar archive'.format(
+                archivepath))
+        with archive:
+            return [(tinfo.name, (tinfo.offset_data, tinfo.size)) for tinfo in archive.getmembers()
+                    if tinfo.isfile()]
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.members
+
+    def __getitem__(self, path):
+        # a view of the member in the mapped archive, nothing is copied..
+        offset, size = self.members[os.path.abspath(path)]
+        return self.data[offset:offset + size]
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def stat(self, path):
+        """Return the size, mtime (of the archive) and offset (as st_ino) of a member, like os.stat."""
+        try:
+            offset, size = self.members[os.path.abspath(path)]
+        except KeyError:
+            raise FileNotFoundError(path)
+        return types.SimpleNamespace(st_ino=offset, st_size=size, st_mtime=self.fs.st_mtime,
+                                     st_mtime_ns=self.fs.st_mtime_ns)
+
+    def open(self, path, mode='rb'):
+        """Open a member of the archive for reading."""
+        try:
+            data = self[path]
+        except KeyError:
+            raise FileNotFoundError(path)
+        return MemoryFileReader(data)
+
+    def close(self):
+        """Release the memory map of the archive (left to the garbage collector while responses still use it)."""
+        try:
+            self.data.release()
+            if isinstance(self.mmap, mmap.mmap):
+                self.mmap.close()
+        except BufferError:
+            pass
+
+
+class ResponseBody(io.BytesIO):
+    """Buffer holding exactly the bytes of a response body (from the cache, a store or the metrics)."""
+
+
 class RequestHandler(SimpleHTTPRequestHandler):
     """This class provides support for generic cors access, HTTP 'Range' requests
     In case of the range implementation, the approach is to:
     - Override send_head to look for 'Range' and respond appropriately.
     - Override copyfile to only transmit a range when requested.
+    Suffix ranges ('bytes=-500') are supported, and several ranges in one request are answered
+    with a multipart/byteranges body that is streamed part by part.
+    Both full and range responses are sent with os.sendfile where available (see use_sendfile).
+    Full responses are served from a precompressed sibling (file.br, file.gz) if the client
+    accepts that encoding.
+    Files carry strong ETags, and conditional requests ('If-None-Match', 'If-Modified-Since',
+    'If-Range') are answered with 304 (or a full response) as appropriate.
+    Small bodies are served from the server's ResponseCache (if it has one).
+    Every request is counted in the server's ServerMetrics (if it has one), served at METRICS_PATH,
+    and written to its JSON access log instead of the default stderr log lines.
+    Files held in the server's MemoryStore (if it has one) or in its mounted archives (ArchiveStore)
+    are served in place of the ones on disk.
     """
 
+    # copy file contents to the socket inside the kernel instead of via python buffers..
+    use_sendfile = True
+
     def do_OPTIONS(self):
         self.send_response(200, "ok")
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
         self.send_header("Access-Control-Allow-Headers", "Range")
-        self.send_head()
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_one_request(self):
+        self.start_request()
+        SimpleHTTPRequestHandler.handle_one_request(self)
+        self.record_request()
+
+    def start_request(self):
+        """Reset the per request state, so errors sent before parse_request (e.g. 414) are recorded too."""
+        self.status = None
+        self.path = ''
+        self.requeststart = time.perf_counter()
+        self.range = None
+        self.multipart = None
+        self.cachehit = None
+        self.bodylength = 0
+
+    def parse_request(self):
+        # the request line is in, don't count the wait for it on a kept-alive connection..
+        self.requeststart = time.perf_counter()
+        return SimpleHTTPRequestHandler.parse_request(self)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.bodylength = int(value)
+        SimpleHTTPRequestHandler.send_header(self, keyword, value)
+
+    def log_request(self, code='-', size='-'):
+        """Keep the status code for record_request, which replaces the per request stderr log line."""
+        self.status = int(code)
+
+    def record_request(self):
+        """Count the finished request in the server's metrics and write it to the access log."""
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is None or self.status is None:
+            return
+        duration = time.perf_counter() - self.requeststart
+        kind = 'range' if (self.range or self.multipart) else 'full'
+        nbytes = 0 if self.command == 'HEAD' else self.bodylength
+        metrics.observe(self.status, kind, nbytes, duration, self.cachehit)
+        if metrics.accesslog is not None:
+            metrics.log({'time': round(time.time(), 3), 'client': self.client_address[0],
+                         'method': self.command, 'path': self.path, 'status': self.status, 'kind': kind,
+                         'bytes': nbytes, 'cache': self.cachehit, 'ms': round(duration * 1000, 3)})
+
+    def send_metrics(self):
+        """Send the server's metrics in the Prometheus text format."""
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is None:
+            self.send_error(404, 'File not found')
+            return None
+        body = metrics.to_prometheus(getattr(self.server, 'cache', None)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return ResponseBody(body)
 
     def send_head(self):
-        if 'Range' not in self.headers:
-            self.range = None
+        self.range = None
+        self.multipart = None
+        if self.path.split('?', 1)[0] == METRICS_PATH:
+            return self.send_metrics()
+        if 'Range' in self.headers:
+            try:
+                self.range = parse_byte_ranges(self.headers['Range']) or None
+            except ValueError as e:
+                self.send_error(400, 'Invalid byte range: %s' % e)
+                return None
+
+        path = self.translate_path(self.path)
+        encoding, encodedpath = None, None
+        if self.range is None:
+            encoding, encodedpath = self.find_precompressed(path)
+        if encoding is None and not self.isfile(path):
+            # directories and missing files are handled as before..
             return SimpleHTTPRequestHandler.send_head(self)
-        try:
-            self.range = parse_byte_range(self.headers['Range'])
-        except ValueError as e:
-            err_string = 'Invalid byte range with: ' + e
-            self.send_error(400, err_string)
-            return None
-        first, last = self.range
+        return self.send_file_head(path, encoding, encodedpath)
 
+    def send_file_head(self, path, encoding=None, encodedpath=None):
+        """Send the headers for a full or range response of a file, or a 304 if the client copy is fresh.
+
+        If encoding is set, the body is the precompressed sibling at encodedpath.
+        """
         # Mirroring SimpleHTTPServer.py here
-        path = self.translate_path(self.path)
-        f = None
         ctype = self.guess_type(path)
+        filepath = encodedpath if encoding else path
         try:
-            f = open(path, 'rb')
-        except IOError:
+            fs = self.stat_file(filepath)
+        except OSError:
             self.send_error(404, 'File not found')
             return None
 
-        fs = os.fstat(f.fileno())
-        file_len = fs[6]
-        if first >= file_len:
-            self.send_error(416, 'Requested Range Not Satisfiable')
+        etag = make_etag(fs, encoding)
+        if self.range is not None and not self.if_range_matches(fs, etag):
+            self.range = None
+
+        if self.is_not_modified(fs, etag):
+            self.send_response(304)
+            self.send_validator_headers(fs, etag)
+            self.end_headers()
             return None
 
+        file_len = fs.st_size
+        if self.range is None:
+            f = self.open_body(filepath, etag, 0, file_len - 1)
+            if f is None:
+                return None
+            self.send_response(200)
+            self.send_header('Content-type', ctype)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+                self.send_header('Vary', 'Accept-Encoding')
+            else:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(file_len))
+            self.send_validator_headers(fs, etag)
+            self.end_headers()
+            return f
+
+        ranges = [resolve_byte_range(first, last, file_len) for first, last in self.range]
+        ranges = [byterange for byterange in ranges if byterange is not None]
+        if not ranges:
+            self.send_response(416, 'Requested Range Not Satisfiable')
+            self.send_header('Content-Range', 'bytes */%s' % file_len)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        if len(ranges) > 1:
+            return self.send_multipart_head(filepath, fs, etag, ctype, ranges)
+
         self.send_response(206)
         self.send_header('Content-type', ctype)
         self.send_header('Accept-Ranges', 'bytes')
 
-        if last is None or last >= file_len:
-            last = file_len - 1
+        first, last = ranges[0]
+        self.range = first, last
         response_length = last - first + 1
+        f = self.open_body(filepath, etag, first, last)
+        if f is None:
+            return None
 
         self.send_header('Content-Range',
                          'bytes %s-%s/%s' % (first, last, file_len))
         self.send_header('Content-Length', str(response_length))
-        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        self.send_validator_headers(fs, etag)
         self.end_headers()
         return f
 
+    def send_multipart_head(self, filepath, fs, etag, ctype, ranges):
+        """Send the headers for a multipart/byteranges response, the parts are streamed by copyfile."""
+        try:
+            f = self.open_file(filepath)
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+
+        boundary = uuid.uuid4().hex
+        self.range = None
+        self.multipart = boundary, ctype, ranges, fs.st_size
+        response_length = len(('--%s--\r\n' % boundary).encode('latin-1'))
+        for first, last in ranges:
+            response_length += len(multipart_part_header(boundary, ctype, first, last, fs.st_size))
+            response_length += last - first + 1 + len(b'\r\n')
+
+        self.send_response(206)
+        self.send_header('Content-type', 'multipart/byteranges; boundary=%s' % boundary)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(response_length))
+        self.send_validator_headers(fs, etag)
+        self.end_headers()
+        return f
+
+    def open_body(self, filepath, etag, start, stop):
+        """Open the file for the response body, or a buffer holding just the bytes start-stop from the cache."""
+        if self.command == 'HEAD':
+            # only the headers are sent, nothing has to be read..
+            return ResponseBody()
+        store = self.find_store(filepath)
+        if store is not None:
+            # already in memory, no need to go through the cache, the range is sent from a view (see copyrange)..
+            try:
+                return MemoryFileReader(store[filepath])
+            except KeyError:
+                self.send_error(404, 'File not found')
+                return None
+
+        cache = getattr(self.server, 'cache', None)
+        try:
+            if cache is None or self.command != 'GET' or stop + 1 - start > cache.max_entry_bytes:
+                return open(filepath, 'rb')
+            key = (filepath, etag, start, stop)
+            data = cache.get(key)
+            self.cachehit = data is not None
+            if data is None:
+                with open(filepath, 'rb') as f:
+                    f.seek(start)
+                    data = f.read(stop + 1 - start)
+                cache.put(key, data)
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+        return ResponseBody(data)
+
+    def send_validator_headers(self, fs, etag):
+        """Send the ETag, Last-Modified and Cache-Control headers for a file."""
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        cache_control = get_cache_control(getattr(self.server, 'cache_control', None), self.path)
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+
+    def is_not_modified(self, fs, etag):
+        """Check the 'If-None-Match' (or else 'If-Modified-Since') header against the file."""
+        if 'If-None-Match' in self.headers:
+            return etag_matches(self.headers['If-None-Match'], etag)
+        if 'If-Modified-Since' in self.headers:
+            modifiedsince = parse_http_date(self.headers['If-Modified-Since'])
+            if modifiedsince is None:
+                return False
+            return int(fs.st_mtime) <= modifiedsince
+        return False
+
+    def if_range_matches(self, fs, etag):
+        """Check if the 'If-Range' header (if any) still matches the file, so the range may be sent."""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+        return parse_http_date(if_range) == int(fs.st_mtime)
+
+    def find_precompressed(self, path):
+        """Return the encoding and path of a precompressed sibling the client accepts, or (None, None).
+
+        A sibling older than the file itself is stale and is ignored.
+        """
+        accepted = parse_accept_encoding(self.headers.get('Accept-Encoding', ''))
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if encoding not in accepted:
+                continue
+            encodedpath = path + suffix
+            if not self.isfile(encodedpath):
+                continue
+            if self.isfile(path) and self.stat_file(encodedpath).st_mtime < self.stat_file(path).st_mtime:
+                continue
+            return encoding, encodedpath
+        return None, None
+
+    def find_store(self, path):
+        """Return the server's MemoryStore or mounted ArchiveStore holding the file, or None if it is on disk."""
+        store = getattr(self.server, 'store', None)
+        if store is not None and path in store:
+            return store
+        for archive in list((getattr(self.server, 'archives', None) or {}).values()):
+            if path in archive:
+                return archive
+        return None
+
+    def isfile(self, path):
+        """Check if path is a file, in the server's stores or on disk."""
+        return self.find_store(path) is not None or os.path.isfile(path)
+
+    def stat_file(self, path):
+        """Return the os.stat of a file, from the server's stores if it is held there."""
+        store = self.find_store(path)
+        if store is not None:
+            return store.stat(path)
+        return os.stat(path)
+
+    def open_file(self, path):
+        """Open a file for reading, from the server's stores if it is held there."""
+        store = self.find_store(path)
+        if store is not None:
+            return store.open(path)
+        return open(path, 'rb')
+
     def end_headers(self):
         """Allow responses to be shared with any requester without any credentials."""
         self.send_header('Access-Control-Allow-Origin', '*')
         SimpleHTTPRequestHandler.end_headers(self)
 
+    def iter_body(self, source):
+        """Yield the pieces of the response body for the file returned by send_head.
+
+        A piece is either bytes to be written as they are, or a (file, start, stop) range to be copied.
+        """
+        if self.multipart:
+            boundary, ctype, ranges, file_len = self.multipart  # set in send_multipart_head()
+            for start, stop in ranges:
+                yield multipart_part_header(boundary, ctype, start, stop, file_len)
+                yield source, start, stop
+                yield b'\r\n'
+            yield ('--%s--\r\n' % boundary).encode('latin-1')
+            return
+
+        if isinstance(source, ResponseBody):
+            # cached bodies hold exactly the bytes to send..
+            yield source.getvalue()
+            return
+
+        if self.range:
+            start, stop = self.range  # set in send_head()
+        else:
+            start, stop = None, None
+        yield source, start, stop
+
     def copyfile(self, source, outputfile):
-        if not self.range:
+        for piece in self.iter_body(source):
+            if isinstance(piece, bytes):
+                outputfile.write(piece)
+            else:
+                self.copyrange(piece[0], outputfile, piece[1], piece[2])
+
+    def copyrange(self, source, outputfile, start=None, stop=None):
+        """Copy the bytes start-stop (inclusive, the whole file if both are None) of source to the client."""
+        if isinstance(source, MemoryFileReader):
+            # held in memory (MemoryStore or ArchiveStore), written from a view without copying..
+            outputfile.write(source.view(start, stop))
+            return
+
+        if self.use_sendfile and can_sendfile(source):
+            # headers are already flushed (wfile is unbuffered), so the body can go straight to the socket..
+            return send_byte_range(source, self.connection, start, stop)
+
+        if start is None and stop is None:
             return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
 
         # SimpleHTTPRequestHandler uses shutil.copyfileobj, which doesn't let
         # you stop the copying before the end of the file.
-        start, stop = self.range  # set in send_head()
         copy_byte_range(source, outputfile, start, stop)
 
 
@@ -139,12 +1005,69 @@ class Server(HTTPServer):
     """Class for basic HTTP server."""
 
     protocol_version = 'HTTP/1.1'
+    # Cache-Control policy for the served files, see get_cache_control()..
+    cache_control = None
+    # ResponseCache for small bodies, None disables caching..
+    cache = None
+    # MemoryStore with files served in place of the ones on disk, None serves from disk only..
+    store = None
+    # mounted ArchiveStores by mount folder, see mount_archive()..
+    archives = None
+    # ServerMetrics counting the requests, None disables metrics and the access log..
+    metrics = None
 
     def __init__(self, server_address):
         """Initialise HTTP server."""
         HTTPServer.__init__(self, server_address, RequestHandler)
 
 
+class ThreadPoolServer(Server):
+    """Class for HTTP server that handles connections on a fixed pool of worker threads.
+
+    Neuroglancer fetches chunks, shards and mesh fragments over several parallel connections,
+    so each accepted connection is handed over to one of the workers instead of being served
+    on the listening thread.
+    """
+
+    # idle/stalled connections are dropped after this many seconds, so they don't hold a worker forever..
+    connection_timeout = 5
+
+    def __init__(self, server_address, workers=8):
+        """Initialise HTTP server along with its worker threads."""
+        Server.__init__(self, server_address)
+        self.requestqueue = queue.Queue()
+        self.workers = []
+        for _ in range(workers):
+            worker = Thread(target=self._serve_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """Queue the connection to be handled by the next free worker."""
+        self.requestqueue.put((request, client_address))
+
+    def _serve_worker(self):
+        while True:
+            queueditem = self.requestqueue.get()
+            if queueditem is None:
+                break
+            request, client_address = queueditem
+            try:
+                request.settimeout(self.connection_timeout)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Close the server socket and stop the worker threads."""
+        Server.server_close(self)
+        for _ in self.workers:
+            self.requestqueue.put(None)
+
+
 def closedataserver(removefiles=True):
     """Close a already started dataserver.
 
@@ -165,6 +1088,10 @@ def closedataserver(removefiles=True):
 
         # close previously created server..
         currentserver.server_close()
+        for archive in (currentserver.archives or {}).values():
+            archive.close()
+        if currentserver.metrics is not None:
+            currentserver.metrics.close()
 
         del sys.modules['ngserver']
         del sys.modules['ngserverdir']
@@ -186,7 +1113,302 @@ def closedataserver(removefiles=True):
             print("Directory is not cleaned at %s" % (currentdatadir))
 
 
-def _startserver(address='127.0.0.1', port=8000, directory=tempfile.TemporaryDirectory(), restart=True):
+class AsyncRequestHandler(RequestHandler):
+    """Request handler for the AsyncServer engine.
+
+    It runs the RequestHandler logic (CORS, OPTIONS, Range, etags, cache) on a request that has
+    already been read from the connection: the response headers are collected in memory and the
+    body is streamed afterwards by the event loop, using loop.sendfile for file ranges. The headers
+    are prepared in a worker thread of the loop, as they need stats, opens and (for the cache) reads
+    of the files that would otherwise stall every connection on the loop.
+    """
+
+    # the asyncio engine keeps connections alive between requests..
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, requestbytes, client_address, server):
+        """Initialise the handler for one request (request line and headers)."""
+        self.client_address = client_address
+        self.server = server
+        self.directory = server.directory
+        self.connection = None
+        self.rfile = io.BytesIO(requestbytes)
+        self.wfile = io.BytesIO()
+
+    def handle_head(self):
+        """Parse the request and collect the response headers, returning the source of the body (or None)."""
+        self.raw_requestline = self.rfile.readline(65537)
+        source = None
+        if self.parse_request():
+            if self.command in ('GET', 'HEAD'):
+                source = self.send_head()
+            elif self.command == 'OPTIONS':
+                self.do_OPTIONS()
+            else:
+                self.send_error(501, 'Unsupported method (%r)' % self.command)
+        return source
+
+    async def respond(self, writer):
+        """Handle the request and write the response to the asyncio stream writer."""
+        self.close_connection = True
+        self.start_request()
+        loop = asyncio.get_event_loop()
+        # send_head stats and opens files (and fills the cache), so it is kept off the event loop..
+        source = await loop.run_in_executor(None, self.handle_head)
+
+        writer.write(self.wfile.getvalue())
+        if source is None:
+            await writer.drain()
+            self.record_request()
+            return
+        try:
+            if self.command == 'GET':
+                for piece in self.iter_body(source):
+                    if isinstance(piece, bytes):
+                        writer.write(piece)
+                        continue
+                    body, start, stop = piece
+                    if isinstance(body, MemoryFileReader):
+                        writer.write(body.view(start, stop))
+                        continue
+                    offset = start or 0
+                    count = None if stop is None else stop + 1 - offset
+                    await writer.drain()
+                    await loop.sendfile(writer.transport, body, offset, count)
+            await writer.drain()
+            self.record_request()
+        finally:
+            source.close()
+
+    async def respond_error(self, writer, code):
+        """Send an error for a request that could not be read (e.g. 414 for an overlong request line)."""
+        self.close_connection = True
+        self.start_request()
+        # as BaseHTTPRequestHandler does before the request line is parsed..
+        self.requestline, self.request_version, self.command = '', '', ''
+        self.send_error(code)
+        writer.write(self.wfile.getvalue())
+        await writer.drain()
+        self.record_request()
+
+
+class AsyncServer(object):
+    """Class for HTTP server running on an asyncio event loop in a single thread.
+
+    It has the same interface (serve_forever, shutdown, server_close, socket, cache, cache_control)
+    as Server, and answers requests with the same logic through AsyncRequestHandler.
+    """
+
+    # idle/stalled connections are dropped after this many seconds..
+    connection_timeout = 5
+    # Cache-Control policy for the served files, see get_cache_control()..
+    cache_control = None
+    # ResponseCache for small bodies, None disables caching..
+    cache = None
+    # MemoryStore with files served in place of the ones on disk, None serves from disk only..
+    store = None
+    # mounted ArchiveStores by mount folder, see mount_archive()..
+    archives = None
+    # ServerMetrics counting the requests, None disables metrics and the access log..
+    metrics = None
+
+    def __init__(self, server_address):
+        """Initialise HTTP server, binding to the address and serving the current directory."""
+        self.server_address = server_address
+        self.directory = os.getcwd()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.loop = asyncio.new_event_loop()
+        self.stopped = Event()
+        self.stopevent = None
+        self.aioserver = None
+        self.connections = set()
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() or server_close() is called."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+            self.stopped.set()
+
+    async def _serve(self):
+        self.stopevent = asyncio.Event()
+        self.aioserver = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        await self.stopevent.wait()
+        self.aioserver.close()
+        # drop the open (keep-alive) connections before the loop goes away..
+        for task in self.connections:
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests on one connection, until the client or a handler closes it."""
+        client_address = writer.get_extra_info('peername')
+        # headers and body go out in separate writes, don't let Nagle hold them back..
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                try:
+                    requestbytes = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                          self.connection_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError as e:
+                    # over the limit of the reader, answered like the threaded engine: 414 if the request
+                    # line is too long, 431 if the headers are..
+                    head = await reader.read(e.consumed)
+                    handler = AsyncRequestHandler(b'', client_address, self)
+                    await handler.respond_error(writer, 431 if b'\r\n' in head else 414)
+                    break
+                handler = AsyncRequestHandler(requestbytes, client_address, self)
+                await handler.respond(writer)
+                if handler.close_connection:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(task)
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return."""
+        if self.stopevent is not None and not self.stopped.is_set():
+            self.loop.call_soon_threadsafe(self.stopevent.set)
+            self.stopped.wait()
+
+    def server_close(self):
+        """Close the listening socket, as in HTTPServer serve_forever is left running (see shutdown)."""
+        if self.aioserver is not None and not self.stopped.is_set():
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        else:
+            self.socket.close()
+
+    async def _close(self):
+        self.aioserver.close()
+
+
+def get_metrics():
+    """Return the request metrics of the running dataserver (also served at METRICS_PATH).
+
+    Returns
+    -------
+    metrics : dict | None
+        'requests' (by status code and kind), 'bytes_sent', 'latency_buckets', 'latency_sum' (by kind),
+        'cache_hits' and 'cache_misses', None if no server or metrics are running
+    """
+    if 'ngserver' in sys.modules and sys.modules['ngserver'].metrics is not None:
+        return sys.modules['ngserver'].metrics.snapshot()
+    return None
+
+
+def get_cachestats():
+    """Return the hit/miss counters of the response cache of the running dataserver.
+
+    Returns
+    -------
+    stats : dict | None
+        'hits', 'misses', 'entries' and 'bytes' of the cache, None if no server or cache is running
+    """
+    if 'ngserver' in sys.modules and sys.modules['ngserver'].cache is not None:
+        return sys.modules['ngserver'].cache.stats()
+    return None
+
+
+def invalidate_cache(path):
+    """Drop the cached responses of the running dataserver for a file or directory.
+
+    Parameters
+    ----------
+    path :  str
+        local path of the file or directory (e.g. a precomputed layer) that is changed or deleted
+    """
+    if 'ngserver' in sys.modules and sys.modules['ngserver'].cache is not None:
+        sys.modules['ngserver'].cache.invalidate(path)
+
+
+def get_memorystore(path=None):
+    """Return the MemoryStore of the running dataserver, or None if it serves from disk.
+
+    Parameters
+    ----------
+    path :  str
+        if given, the store is only returned if this path is inside the served directory
+
+    Returns
+    -------
+    store :  MemoryStore | None
+        dict-like object store (path -> bytes) the dataserver serves in place of the disk.
+    """
+    if 'ngserver' not in sys.modules or 'ngserverdir' not in sys.modules:
+        return None
+    store = getattr(sys.modules['ngserver'], 'store', None)
+    if store is None or path is None:
+        return store
+    serverdir = sys.modules['ngserverdir']
+    if os.path.commonpath([os.path.abspath(path), serverdir]) != serverdir:
+        return None
+    return store
+
+
+def mount_archive(archivepath, mountpoint=None):
+    """Serve the members of a zip or uncompressed tar archive from the running dataserver.
+
+    Parameters
+    ----------
+    archivepath :  str
+        local path of the archive, e.g. written by utils.pack_precomputed
+    mountpoint :  str
+        folder (relative to the served directory) the members are served from, defaults to
+        'precomputed/<archive name without extension>'
+
+    Returns
+    -------
+    mountpoint :  str
+        the folder the members are served from, e.g. the source url is
+        'precomputed://http://localhost:<port>/<mountpoint>'.
+    """
+    server = sys.modules['ngserver']
+    if mountpoint is None:
+        mountpoint = 'precomputed/' + os.path.splitext(os.path.basename(archivepath))[0]
+    mountpoint = mountpoint.strip('/')
+    archive = ArchiveStore(archivepath, os.path.join(sys.modules['ngserverdir'], *mountpoint.split('/')))
+    archives = dict(server.archives or {})
+    if archive.mountpath in archives:
+        archives[archive.mountpath].close()
+    archives[archive.mountpath] = archive
+    server.archives = archives
+    invalidate_cache(archive.mountpath)
+    print('Serving %d files of %s at: %s' % (len(archive), archivepath, mountpoint))
+    return mountpoint
+
+
+def unmount_archive(mountpoint):
+    """Stop serving an archive mounted with mount_archive.
+
+    Parameters
+    ----------
+    mountpoint :  str
+        folder (relative to the served directory) the archive is mounted at
+    """
+    server = sys.modules['ngserver']
+    mountpath = os.path.join(sys.modules['ngserverdir'], *mountpoint.strip('/').split('/'))
+    archives = dict(server.archives or {})
+    archive = archives.pop(mountpath, None)
+    server.archives = archives
+    if archive is not None:
+        archive.close()
+    invalidate_cache(mountpath)
+
+
+def _startserver(address='127.0.0.1', port=8000, directory=tempfile.TemporaryDirectory(), restart=True,
+                 workers=1, cache_control=None, cache_size=64 * 1024 * 1024, engine='threaded',
+                 storage='disk', accesslog=None):
     """Start a dataserver that can host local folder via http.
 
     Parameters
@@ -195,6 +1417,12 @@ def _startserver(address='127.0.0.1', port=8000, directory=tempfile.TemporaryDir
     port :     port number to use for the local host server
     directory :   local directory to be used for hosting
     restart :   restart/clean up already running data server
+    workers :   number of worker threads serving the requests
+    cache_control :   Cache-Control policy for the served files
+    cache_size :   byte budget of the in-memory response cache, 0 disables it
+    engine :   'threaded' (http.server) or 'asyncio'
+    storage :   'disk' or 'memory' (serve the layers from a MemoryStore)
+    accesslog :   file path or text stream for the JSON access log, None for no access log
 
     Returns
     -------
@@ -219,7 +1447,18 @@ def _startserver(address='127.0.0.1', port=8000, directory=tempfile.TemporaryDir
 
     os.chdir(temp_dirname)
     print("Serving data from: ", temp_dirname)
-    server = Server((args.address, args.port))
+    if engine == 'asyncio':
+        server = AsyncServer((args.address, args.port))
+    elif workers > 1:
+        server = ThreadPoolServer((args.address, args.port), workers=workers)
+    else:
+        server = Server((args.address, args.port))
+    server.cache_control = cache_control
+    if cache_size:
+        server.cache = ResponseCache(max_bytes=cache_size)
+    if storage == 'memory':
+        server.store = MemoryStore()
+    server.metrics = ServerMetrics(accesslog=accesslog)
 
     socketaddress = server.socket.getsockname()
     print("Serving directory at http://%s:%d" %
@@ -240,7 +1479,8 @@ def _startserver(address='127.0.0.1', port=8000, directory=tempfile.TemporaryDir
 
 
 def startdataserver(address='127.0.0.1', port=8000, directory=None,
-                    restart=True):
+                    restart=True, workers=1, cache_control=None, cache_size=64 * 1024 * 1024,
+                    engine='threaded', storage='disk', accesslog=None):
     """Start a dataserver thread(return control back) that can host local folder via http.
 
     Parameters
@@ -253,7 +1493,30 @@ def startdataserver(address='127.0.0.1', port=8000, directory=None,
         local directory to be used for hosting
     restart :  bool
         restart/clean up already running data server
+    workers :  int
+        number of worker threads serving the requests concurrently, 1 uses a single-threaded server
+    cache_control :  str | list
+        Cache-Control header for all files, or a list of (regex, value) rules matched against the
+        request path (e.g. IMMUTABLE_SHARDS_CACHE_CONTROL). Defaults to 'no-cache' (always revalidate).
+    cache_size :  int
+        byte budget of the in-memory cache for small files and range slices, 0 disables it
+    engine :  str
+        'threaded' serves with http.server (see workers), 'asyncio' serves all connections from one
+        asyncio event loop with keep-alive and zero-copy loop.sendfile (workers is ignored)
+    storage :  str
+        'disk' (default) writes the layers as files in the directory, 'memory' keeps them in an
+        in-memory store (see get_memorystore) that the dataserver serves from, nothing is persisted
+    accesslog :  str | file object
+        file path (appended to) or text stream to write one JSON line per request to. Requests are
+        not logged to stderr any more, their counters are served at METRICS_PATH (see get_metrics)
     """
-    serverthread = Thread(target=_startserver, args=(address, port, directory, restart))
+    _ENGINE_OPTIONS = ['threaded', 'asyncio']
+    if engine not in _ENGINE_OPTIONS:
+        raise ValueError('Unknown engine "{0}". Please use either: {1}'.format(engine, _ENGINE_OPTIONS))
+    _STORAGE_OPTIONS = ['disk', 'memory']
+    if storage not in _STORAGE_OPTIONS:
+        raise ValueError('Unknown storage "{0}". Please use either: {1}'.format(storage, _STORAGE_OPTIONS))
+    serverthread = Thread(target=_startserver, args=(address, port, directory, restart, workers, cache_control,
+                                                     cache_size, engine, storage, accesslog))
     serverthread.daemon = True  # This thread dies when main thread (only non-daemon thread) exits..
     serverthread.start()
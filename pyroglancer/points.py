@@ -13,10 +13,22 @@
 
 """Module contains functions to handle point data."""
 
+from .annotations import annotation_bounds, annotation_shardingspec, build_spatialindex, encode_byid
+from .annotations import get_annotationproperties, place_annotations, put_shardedindex, shard_locations
+from .annotations import spatial_levels, update_annotationinfo, update_shardedindex
+import io
 import json
+from .localserver import invalidate_cache
 import neuroglancer
+import numpy as np
 import os
+import pandas as pd
 import struct
+import tempfile
+from .utils import get_precompressed, layerfile_exists, makelayerdirs, open_layerfile, precompress_layerfiles
+from .utils import precompress_precomputed, read_tablebatches, remove_layerfile
+
+POINT_MANIFEST = 'manifest.npz'
 
 
 def commit_info(pointinfo, path, pointlayername):
@@ -32,15 +44,14 @@ def commit_info(pointinfo, path, pointlayername):
       name for the points layer
     """
     pointfilepath = path + '/precomputed/' + pointlayername
-    if not os.path.exists(pointfilepath):
-        os.makedirs(pointfilepath)
+    if makelayerdirs(pointfilepath):
         print('creating:', pointfilepath)
     infofile = os.path.join(pointfilepath, 'info')
-    with open(infofile, 'w') as f:
+    with open_layerfile(infofile, 'w') as f:
         json.dump(pointinfo, f)
 
 
-def create_pointinfo(dimensions, path, layer_name):
+def create_pointinfo(dimensions, path, layer_name, sharding=None):
     """Create info file for the points based precomputed format.
 
     Parameters
@@ -51,6 +62,9 @@ def create_pointinfo(dimensions, path, layer_name):
       name for the points layer
     dimensions:  neuroglancer.CoordinateSpace
         object of neuroglancer coordinate space class.
+    sharding : dict
+        sharding specification of the by_id index (see annotations.annotation_shardingspec),
+        None for one file per point
 
     Returns
     -------
@@ -81,14 +95,184 @@ def create_pointinfo(dimensions, path, layer_name):
         ],
         "upper_bound": [137216, 264192, 4400]
     }
+    if sharding is not None:
+        pointinfo["by_id"]["sharding"] = sharding
     commit_info(pointinfo, path, pointlayername=layer_name)
 
     return path
 
 
-def put_pointfile(path, layer_name, points, pointsscale, pointname):
+def encode_points(pointlocs, ids=None, properties=None):
+    """Encode points in the neuroglancer annotation (POINT) chunk format.
+
+    The chunk is built in a single allocation: the point count ('<Q'), the positions ('<3f' each,
+    followed by the encoded properties of the point if any) and then the annotation ids ('<Q' each).
+
+    Parameters
+    ----------
+    pointlocs :  numpy.ndarray
+        (N, 3) positions of the points
+    ids :  numpy.ndarray
+        (N,) annotation ids of the points, defaults to 0..N-1
+    properties :  numpy.ndarray
+        (N, nbytes) encoded properties of the points (see annotations.encode_properties)
+
+    Returns
+    -------
+    buffer :  bytearray
+        the encoded chunk.
+    """
+    pointlocs = np.asarray(pointlocs).reshape(-1, 3)
+    total_points = len(pointlocs)
+    if ids is None:
+        ids = np.arange(total_points, dtype='<u8')
+    propertysize = 0 if properties is None else properties.shape[1]
+    recordsize = 12 + propertysize
+    buffer = bytearray(8 + (recordsize + 8) * total_points)
+    struct.pack_into('<Q', buffer, 0, total_points)
+    if propertysize == 0:
+        np.frombuffer(buffer, dtype='<f4', count=3 * total_points, offset=8).reshape(-1, 3)[:] = pointlocs
+    else:
+        records = np.frombuffer(buffer, dtype='u1', count=recordsize * total_points, offset=8)
+        records = records.reshape(-1, recordsize)
+        records[:, :12] = np.ascontiguousarray(pointlocs, dtype='<f4').view('u1').reshape(-1, 12)
+        records[:, 12:] = properties
+    np.frombuffer(buffer, dtype='<u8', count=total_points, offset=8 + recordsize * total_points)[:] = ids
+    return buffer
+
+
+def decode_points(buffer, propertysize=0):
+    """Decode a neuroglancer annotation (POINT) chunk, the inverse of encode_points.
+
+    Parameters
+    ----------
+    buffer :  bytes
+        the encoded chunk.
+    propertysize :  int
+        number of bytes of the encoded properties of each point.
+
+    Returns
+    -------
+    pointlocs :  numpy.ndarray
+        (N, 3) positions of the points
+    ids :  numpy.ndarray
+        (N,) annotation ids of the points
+    properties :  numpy.ndarray
+        (N, propertysize) encoded properties of the points, None if propertysize is 0
+    """
+    total_points = struct.unpack_from('<Q', buffer, 0)[0]
+    recordsize = 12 + propertysize
+    records = np.frombuffer(buffer, dtype='u1', count=recordsize * total_points, offset=8)
+    records = records.reshape(-1, recordsize)
+    pointlocs = records[:, :12].copy().view('<f4').reshape(-1, 3)
+    properties = records[:, 12:].copy() if propertysize else None
+    ids = np.frombuffer(buffer, dtype='<u8', count=total_points, offset=8 + recordsize * total_points).copy()
+    return pointlocs, ids, properties
+
+
+def write_pointmanifest(layerpath, ids, chunkindex, chunknames, next_id):
+    """Write the manifest of a points layer, used to append points to the layer later on.
+
+    The manifest (manifest.npz next to the info file) holds the spatial chunk of every point and the
+    next free annotation id (the id allocator), see append_points.
+
+    Parameters
+    ----------
+    layerpath : str
+        local path of the points layer (folder of its info file).
+    ids : numpy.ndarray
+        (N,) annotation ids of the points.
+    chunkindex : numpy.ndarray
+        (N,) index into chunknames of the spatial chunk of every point.
+    chunknames : list
+        chunk keys ('spatial<level>/x_y_z') of the spatial index.
+    next_id : int
+        next annotation id to hand out.
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, ids=np.asarray(ids, dtype='<u8'), chunkindex=np.asarray(chunkindex, dtype='<i4'),
+             chunknames=np.asarray(chunknames, dtype=str), next_id=np.uint64(next_id))
+    with open_layerfile(os.path.join(layerpath, POINT_MANIFEST), 'wb') as f:
+        f.write(buffer.getvalue())
+
+
+def read_pointmanifest(layerpath):
+    """Read the manifest of a points layer (see write_pointmanifest).
+
+    Returns
+    -------
+    manifest : dict
+        'ids', 'chunkindex', 'chunknames' and 'next_id' of the layer.
+    """
+    manifestfile = os.path.join(layerpath, POINT_MANIFEST)
+    if not layerfile_exists(manifestfile):
+        raise FileNotFoundError('No manifest found at: {0}, append_points needs a layer written by '
+                                'upload_points'.format(manifestfile))
+    with open_layerfile(manifestfile, 'rb') as f:
+        data = np.load(io.BytesIO(f.read()))
+        manifest = {key: data[key] for key in ['ids', 'chunkindex', 'chunknames']}
+        manifest['next_id'] = int(data['next_id'])
+    return manifest
+
+
+def put_spatialindex(layerpath, positions, limit=10000, properties=None, ids=None, manifest=False):
+    """Write point annotations as a multi-level spatial index of an annotation layer.
+
+    The chunks are built with annotations.build_spatialindex, the annotation ids default to the row
+    indices of the positions. The bounds and levels of the index are updated in the info file of the layer.
+
+    Parameters
+    ----------
+    layerpath : str
+        local path of the annotation layer (folder of its info file).
+    positions : numpy.ndarray
+        (N, 3) positions of the annotations.
+    limit : int
+        maximum number of annotations per spatial chunk
+    properties : numpy.ndarray
+        (N, nbytes) encoded properties of the annotations (see annotations.encode_properties)
+    ids : numpy.ndarray
+        (N,) annotation ids, defaults to 0..N-1
+    manifest : bool
+        also write the manifest of the layer (see write_pointmanifest)
+
+    Returns
+    -------
+    spatial : list
+        levels of the spatial index, as written in the info file.
+    """
+    if ids is None:
+        ids = np.arange(len(positions), dtype='<u8')
+    lower_bound, upper_bound = annotation_bounds(positions)
+    spatial, chunks = build_spatialindex(positions, lower_bound, upper_bound, limit)
+    chunknames = []
+    chunkindex = np.zeros(len(positions), dtype='<i4')
+    # implementation based on logic suggested by https://github.com/google/neuroglancer/issues/227
+    for level, levelchunks in zip(spatial, chunks):
+        chunkpath = layerpath + '/' + level['key']
+        makelayerdirs(chunkpath)
+        for chunkname, indices in levelchunks.items():
+            with open_layerfile(os.path.join(chunkpath, chunkname), 'wb') as outputbytefile:
+                chunkproperties = None if properties is None else properties[indices]
+                outputbytefile.write(encode_points(positions[indices], ids=ids[indices],
+                                                   properties=chunkproperties))
+            chunkindex[indices] = len(chunknames)
+            chunknames.append(level['key'] + '/' + chunkname)
+        print('written %d chunks to: %s' % (len(levelchunks), chunkpath))
+    if manifest:
+        next_id = int(ids.max()) + 1 if len(ids) else 0
+        write_pointmanifest(layerpath, ids, chunkindex, chunknames, next_id)
+    update_annotationinfo(os.path.join(layerpath, 'info'), lower_bound=lower_bound, upper_bound=upper_bound,
+                          spatial=spatial)
+    return spatial
+
+
+def put_pointfile(path, layer_name, points, pointsscale, pointname, sharding=None, shardprogress=False,
+                  limit=10000, properties=None):
     """Put pointfile in the local dataserver.
 
+    The points are written as a multi-level spatial index (see put_spatialindex).
+
     Parameters
     ----------
     path: str
@@ -101,47 +285,38 @@ def put_pointfile(path, layer_name, points, pointsscale, pointname):
         scaling from voxel to native space in 'x', 'y', 'z'
     pointsname :  str
         name for the points (not yet implemented)
+    sharding : dict
+        sharding specification of the by_id index, None for one file per point
+    shardprogress : bool
+        progress bar for sharding operation
+    limit : int
+        maximum number of points per spatial chunk
+    properties : numpy.ndarray
+        (N, nbytes) encoded properties of the points (see annotations.get_annotationproperties)
 
     """
-    pointsfilepath = path + '/precomputed/' + layer_name + '/spatial0'
-    if not os.path.exists(pointsfilepath):
-        os.makedirs(pointsfilepath)
+    layerpath = path + '/precomputed/' + layer_name
+    pointlocs = points[['x', 'y', 'z']].values/1000 * np.asarray(pointsscale)
 
-    pointsfile = os.path.join(pointsfilepath, '0_0_0')
-    print(pointsfile)
-    pointlocs = points[['x', 'y', 'z']].values/1000
+    put_spatialindex(layerpath, pointlocs, limit, properties, manifest=True)
 
-    # implementation based on logic suggested by https://github.com/google/neuroglancer/issues/227
-    with open(pointsfile, 'wb') as outputbytefile:
-        total_points = len(pointlocs)
-        buffer = struct.pack('<Q', total_points)
-        for (x, y, z) in pointlocs:
-            x = x*pointsscale[0]
-            y = y*pointsscale[1]
-            z = z*pointsscale[2]
-            annotpoint = struct.pack('<3f', x, y, z)
-            buffer += annotpoint
-        pointid_buffer = struct.pack('<%sQ' % len(pointlocs), *range(len(pointlocs)))
-        buffer += pointid_buffer
-        outputbytefile.write(buffer)
-
-    idfilepath = path + '/precomputed/' + layer_name + '/by_id'
-    if not os.path.exists(idfilepath):
-        os.makedirs(idfilepath)
-
-    for idfileidx in range(len(pointlocs)):
-        filename = str(idfileidx)
-        idfile = os.path.join(idfilepath, filename)
-        print(idfile)
-        with open(idfile, 'wb') as outputbytefile:
-            x = pointlocs[idfileidx][0]*pointsscale[0]
-            y = pointlocs[idfileidx][1]*pointsscale[1]
-            z = pointlocs[idfileidx][2]*pointsscale[2]
-            annotpoint = struct.pack('<3f', x, y, z)
-            outputbytefile.write(annotpoint)
-
-
-def upload_points(points_df, path, layer_name, layer_scale):
+    # the by_id entries hold the position and the properties of each point..
+    entries = encode_byid(pointlocs, properties=properties)
+    idfilepath = layerpath + '/by_id'
+    if sharding is not None:
+        put_shardedindex(idfilepath, sharding, dict(zip(range(len(pointlocs)), entries)), shardprogress)
+        return
+
+    makelayerdirs(idfilepath)
+    for idfileidx, entry in enumerate(entries):
+        idfile = os.path.join(idfilepath, str(idfileidx))
+        with open_layerfile(idfile, 'wb') as outputbytefile:
+            outputbytefile.write(entry)
+    print('written %d points to: %s' % (len(pointlocs), idfilepath))
+
+
+def upload_points(points_df, path, layer_name, layer_scale, precompress=None, sharding=None, shardprogress=False,
+                  limit=10000, properties=None):
     """Upload points from a dataframe.
 
     Parameters
@@ -154,17 +329,309 @@ def upload_points(points_df, path, layer_name, layer_scale):
       name for the points layer
     layer_scale : int | float
         scaling from voxel to native space in 'x', 'y', 'z'
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
+    sharding : dict
+        sharding specification of the by_id index (as passed to create_pointinfo), None for one file per point
+    shardprogress : bool
+        progress bar for sharding operation
+    limit : int
+        maximum number of points per spatial chunk
+    properties : list
+        columns of points_df to write as typed properties of the points, names or property
+        specifications (see annotations.get_annotationproperties)
 
     """
     pointname = points_df['description']
     points = points_df[['x', 'y', 'z']]
     pointsscale = layer_scale
-    put_pointfile(path, layer_name, points, pointsscale, pointname)
+    propertyspecs, encodedproperties = get_annotationproperties(points_df, properties)
+    update_annotationinfo(os.path.join(path, 'precomputed', layer_name, 'info'), properties=propertyspecs)
+    put_pointfile(path, layer_name, points, pointsscale, pointname, sharding, shardprogress, limit,
+                  encodedproperties)
+
+    if precompress:
+        precompress_precomputed(path + '/precomputed/' + layer_name, precompress)
+
+
+def _get_tablestats(filepath, layer_scale, properties, batch_size):
+    """Scan a points table for its number of rows, the bounds of the points and the property specifications."""
+    propertyids = [prop['id'] if isinstance(prop, dict) else prop for prop in properties or []]
+    num_points = 0
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    samples = {}
+    for batch in read_tablebatches(filepath, ['x', 'y', 'z'] + propertyids, batch_size):
+        if len(batch) == 0:
+            continue
+        num_points += len(batch)
+        pointlocs = batch[['x', 'y', 'z']].values/1000 * np.asarray(layer_scale)
+        lower = np.minimum(lower, pointlocs.min(axis=0))
+        upper = np.maximum(upper, pointlocs.max(axis=0))
+        for prop in properties or []:
+            propid = prop['id'] if isinstance(prop, dict) else prop
+            if isinstance(prop, dict) and prop.get('type', None) in ['rgb', 'rgba']:
+                samples.setdefault(propid, batch[propid].values[:1])
+                continue
+            # the smallest type that fits all values follows from their range..
+            values = pd.to_numeric(batch[propid]).values
+            sample = samples.get(propid, values[:1])
+            samples[propid] = np.array([min(sample.min(), values.min()), max(sample.max(), values.max())])
+
+    specs = []
+    for prop in properties or []:
+        propid = prop['id'] if isinstance(prop, dict) else prop
+        specs += get_annotationproperties({propid: samples.get(propid, np.zeros(1))}, [prop])[0]
+    bounds = np.array([lower, upper]) if num_points else np.zeros((0, 3))
+    lower_bound, upper_bound = annotation_bounds(bounds)
+    return num_points, lower_bound, upper_bound, specs
+
+
+def upload_pointtable(filepath, path, layer_name, layer_scale, precompress=None, sharding=None,
+                      shardprogress=False, limit=10000, properties=None, batch_size=1000000):
+    """Upload points from a Parquet, Feather or CSV file, streaming it in batches of rows.
+
+    The file is read twice with utils.read_tablebatches, once for the number of points, their bounds and
+    the range of the property columns and once to place the points into the spatial chunks (see
+    annotations.place_annotations, a chunk takes points until it holds limit of them). Chunks and by_id
+    shards are collected in spool files on disk and only encoded once complete, so the memory used depends
+    on batch_size and the size of the largest chunk or shard but not on the size of the file. The annotation
+    ids are the row numbers in the file. No manifest is written, so append_points does not work on the layer.
+
+    Parameters
+    ----------
+    filepath : str
+        path of a .parquet, .feather or .csv file with 'x', 'y', 'z' columns.
+    path: str
+        local path of the precomputed hosted layer (with the info written by create_pointinfo).
+    layer_name : str
+      name for the points layer
+    layer_scale : int | float
+        scaling from voxel to native space in 'x', 'y', 'z'
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
+    sharding : dict | bool
+        sharding specification of the by_id index (see annotations.annotation_shardingspec), True for
+        one sized for the number of rows in the file, None for one file per point
+    shardprogress : bool
+        progress bar for sharding operation
+    limit : int
+        maximum number of points per spatial chunk
+    properties : list
+        columns of the file to write as typed properties of the points, names or property
+        specifications (see annotations.get_annotationproperties)
+    batch_size : int
+        number of rows read at once.
+
+    Returns
+    -------
+    num_points : int
+        number of points written.
+    """
+    layerpath = path + '/precomputed/' + layer_name
+    infofile = os.path.join(layerpath, 'info')
+    num_points, lower_bound, upper_bound, specs = _get_tablestats(filepath, layer_scale, properties, batch_size)
+    if sharding is True:
+        # sized with the rows counted by _get_tablestats, written to the info with the bounds below..
+        sharding = annotation_shardingspec(num_points)
+    byid = {'key': 'by_id'}
+    if sharding is not None:
+        byid['sharding'] = sharding
+    propertyids = [spec['id'] for spec in specs]
+    levels = spatial_levels(lower_bound, upper_bound, limit)
+    counts = {}
+    shards = set()
+    idfilepath = layerpath + '/by_id'
+    makelayerdirs(idfilepath)
+
+    with tempfile.TemporaryDirectory() as spooldir:
+        firstid = 0
+        recordsize = 20
+        for batch in read_tablebatches(filepath, ['x', 'y', 'z'] + propertyids, batch_size):
+            pointlocs = batch[['x', 'y', 'z']].values/1000 * np.asarray(layer_scale)
+            _, encodedproperties = get_annotationproperties(batch, specs)
+            ids = np.arange(firstid, firstid + len(batch), dtype='<u8')
+            firstid += len(batch)
+            # fixed size records of the position, the properties and the id of every point..
+            entries = np.ascontiguousarray(pointlocs, dtype='<f4').view('u1').reshape(-1, 12)
+            if encodedproperties is not None:
+                entries = np.concatenate([entries, encodedproperties], axis=1)
+            records = np.concatenate([entries, ids.view('u1').reshape(-1, 8)], axis=1)
+            recordsize = records.shape[1]
+
+            for chunkkey, indices in place_annotations(pointlocs, levels, lower_bound, counts).items():
+                if chunkkey not in counts:
+                    os.makedirs(os.path.join(spooldir, os.path.dirname(chunkkey)), exist_ok=True)
+                counts[chunkkey] = counts.get(chunkkey, 0) + len(indices)
+                with open(os.path.join(spooldir, chunkkey), 'ab') as f:
+                    f.write(records[np.sort(indices)].tobytes())
+
+            if sharding is not None:
+                batchshards, _ = shard_locations(sharding, ids)
+                for shard in np.unique(batchshards):
+                    shards.add(int(shard))
+                    with open(os.path.join(spooldir, 'shard%d' % shard), 'ab') as f:
+                        f.write(records[batchshards == shard].tobytes())
+            else:
+                for annotationid, entry in zip(ids, entries):
+                    with open_layerfile(os.path.join(idfilepath, str(annotationid)), 'wb') as outputbytefile:
+                        outputbytefile.write(entry.tobytes())
+            print('read %d points from: %s' % (firstid, filepath))
+
+        for chunkkey in counts:
+            with open(os.path.join(spooldir, chunkkey), 'rb') as f:
+                records = np.frombuffer(f.read(), dtype='u1').reshape(-1, recordsize)
+            makelayerdirs(os.path.join(layerpath, os.path.dirname(chunkkey)))
+            with open_layerfile(os.path.join(layerpath, chunkkey), 'wb') as outputbytefile:
+                outputbytefile.write(encode_points(records[:, :12].copy().view('<f4'),
+                                                   ids=records[:, -8:].copy().view('<u8').reshape(-1),
+                                                   properties=records[:, 12:-8] if recordsize > 20 else None))
+        print('written %d chunks to: %s' % (len(counts), layerpath))
+        for shard in sorted(shards):
+            with open(os.path.join(spooldir, 'shard%d' % shard), 'rb') as f:
+                records = np.frombuffer(f.read(), dtype='u1').reshape(-1, recordsize)
+            keys = records[:, -8:].copy().view('<u8').reshape(-1).tolist()
+            entries = dict(zip(keys, (record.tobytes() for record in records[:, :-8])))
+            put_shardedindex(idfilepath, sharding, entries, shardprogress)
+
+    numlevels = max([int(chunkkey.split('/')[0][len('spatial'):]) for chunkkey in counts] + [0]) + 1
+    update_annotationinfo(infofile, lower_bound=lower_bound, upper_bound=upper_bound, spatial=levels[:numlevels],
+                          properties=specs, by_id=byid)
+    if precompress:
+        precompress_precomputed(layerpath, precompress)
+    return num_points
+
+
+def append_points(points_df, path, layer_name, layer_scale, precompress=None, shardprogress=False):
+    """Append points to (or update points of) a points layer written by upload_points.
+
+    Rows with the 'id' of a point already in the layer replace that point, the other rows get new ids
+    from the id allocator kept in the manifest of the layer (see write_pointmanifest). Only the spatial
+    chunks and by_id entries (or by_id shards) of the new and replaced points are written again, then
+    the manifest and lastly the info file, which is replaced atomically. If a new point falls outside
+    the bounds of the layer, the spatial index is built again for all points.
+
+    Parameters
+    ----------
+    points_df :  dataframe
+        should contain 'x', 'y', 'z' columns, the property columns of the layer and optionally 'id'
+    path: str
+        local path of the precomputed hosted layer.
+    layer_name : str
+      name for the points layer
+    layer_scale : int | float
+        scaling from voxel to native space in 'x', 'y', 'z'
+    precompress : str | list
+        precompressed siblings ('gzip' and/or 'br') to write, defaults to the ones of the info file
+    shardprogress : bool
+        progress bar for sharding operation
+
+    Returns
+    -------
+    ids : numpy.ndarray
+        annotation ids of the appended (or updated) points.
+    """
+    layerpath = path + '/precomputed/' + layer_name
+    infofile = os.path.join(layerpath, 'info')
+    with open_layerfile(infofile, 'r') as f:
+        info = json.load(f)
+    manifest = read_pointmanifest(layerpath)
+    encodings = precompress or get_precompressed(infofile)
+    pointlocs = points_df[['x', 'y', 'z']].values/1000 * np.asarray(layer_scale)
+    _, properties = get_annotationproperties(points_df, info['properties'])
+    propertysize = 0 if properties is None else properties.shape[1]
+
+    if 'id' in points_df.columns:
+        ids = pd.to_numeric(points_df['id']).values.astype(float)
+    else:
+        ids = np.full(len(points_df), np.nan)
+    new = np.isnan(ids)
+    ids[new] = manifest['next_id'] + np.arange(np.count_nonzero(new))
+    ids = ids.astype('<u8')
+    if len(np.unique(ids)) != len(ids):
+        raise ValueError('Duplicate ids in the points to append')
+    next_id = max(manifest['next_id'], int(ids.max()) + 1) if len(ids) else manifest['next_id']
+    replaced = np.isin(manifest['ids'], ids)
+    written = []
+
+    # by_id entries first, the spatial chunks referring to the new ids are only written after them..
+    entries = encode_byid(pointlocs, properties=properties)
+    idfilepath = layerpath + '/by_id'
+    if 'sharding' in info['by_id']:
+        update_shardedindex(idfilepath, info['by_id']['sharding'], dict(zip(ids.tolist(), entries)), shardprogress)
+    else:
+        makelayerdirs(idfilepath)
+        for annotationid, entry in zip(ids, entries):
+            idfile = os.path.join(idfilepath, str(annotationid))
+            with open_layerfile(idfile, 'wb') as outputbytefile:
+                outputbytefile.write(entry)
+            written.append(idfile)
+
+    lower_bound = np.asarray(info['lower_bound'])
+    if np.all((pointlocs >= lower_bound) & (pointlocs < np.asarray(info['upper_bound']))):
+        chunknames = list(manifest['chunknames'])
+        counts = np.bincount(manifest['chunkindex'][~replaced], minlength=len(chunknames))
+        placed = place_annotations(pointlocs, info['spatial'], lower_bound, dict(zip(chunknames, counts)))
+        affected = set(placed) | set(manifest['chunknames'][np.unique(manifest['chunkindex'][replaced])])
+        chunklookup = {chunkname: idx for idx, chunkname in enumerate(chunknames)}
+        chunkindex = np.zeros(len(ids), dtype='<i4')
+        for chunkkey in sorted(affected):
+            chunkfile = os.path.join(layerpath, chunkkey)
+            indices = placed.get(chunkkey, np.zeros(0, dtype=int))
+            if layerfile_exists(chunkfile):
+                with open_layerfile(chunkfile, 'rb') as f:
+                    chunklocs, chunkids, chunkproperties = decode_points(f.read(), propertysize)
+                keep = ~np.isin(chunkids, ids)
+                chunklocs = np.concatenate([chunklocs[keep], pointlocs[indices]])
+                chunkids = np.concatenate([chunkids[keep], ids[indices]])
+                if propertysize:
+                    chunkproperties = np.concatenate([chunkproperties[keep], properties[indices]])
+            else:
+                makelayerdirs(os.path.dirname(chunkfile))
+                chunklocs, chunkids = pointlocs[indices], ids[indices]
+                chunkproperties = properties[indices] if propertysize else None
+            with open_layerfile(chunkfile, 'wb') as outputbytefile:
+                outputbytefile.write(encode_points(chunklocs, ids=chunkids, properties=chunkproperties))
+            written.append(chunkfile)
+            if chunkkey not in chunklookup:
+                chunklookup[chunkkey] = len(chunknames)
+                chunknames.append(chunkkey)
+            chunkindex[indices] = chunklookup[chunkkey]
+        print('written %d chunks to: %s' % (len(affected), layerpath))
+        write_pointmanifest(layerpath, np.concatenate([manifest['ids'][~replaced], ids]),
+                            np.concatenate([manifest['chunkindex'][~replaced], chunkindex]), chunknames, next_id)
+        update_annotationinfo(infofile)
+    else:
+        # the chunk grid depends on the bounds, so read back all points and index them again..
+        alllocs, allids, allproperties = [pointlocs], [ids], [properties]
+        for chunkkey in manifest['chunknames']:
+            chunkfile = os.path.join(layerpath, chunkkey)
+            with open_layerfile(chunkfile, 'rb') as f:
+                chunklocs, chunkids, chunkproperties = decode_points(f.read(), propertysize)
+            keep = ~np.isin(chunkids, ids)
+            alllocs.append(chunklocs[keep])
+            allids.append(chunkids[keep])
+            allproperties.append(chunkproperties[keep] if propertysize else None)
+            remove_layerfile(chunkfile)
+        put_spatialindex(layerpath, np.concatenate(alllocs), info['spatial'][0]['limit'],
+                         np.concatenate(allproperties) if propertysize else None, np.concatenate(allids),
+                         manifest=True)
+        written = None
+
+    if encodings and written is None:
+        precompress_precomputed(layerpath, encodings)
+    elif encodings:
+        precompress_layerfiles(written + [os.path.join(layerpath, POINT_MANIFEST), infofile], encodings)
+    invalidate_cache(layerpath)
+    return ids
 
 
 def annotate_points(ngviewer, dimensions, pointscolor, points_df, layer_name, layer_scale):
     """Annotate points from a dataframe (defunct do not use..).
 
+    The annotations are built from the columns of the dataframe at once and set with the layer in a
+    single state update, the dataframe itself is left unchanged.
+
     Parameters
     ----------
     ngviewer : ng.viewer.Viewer
@@ -176,8 +643,12 @@ def annotate_points(ngviewer, dimensions, pointscolor, points_df, layer_name, la
     layer_scale : int | float
         scaling from voxel to native space in 'x', 'y', 'z'
     """
-    pointname = points_df['description']
-    points_df.loc[:, ['x', 'y', 'z']] = points_df.loc[:, ['x', 'y', 'z']].values/1000
+    pointlocs = points_df[['x', 'y', 'z']].values/1000 * np.asarray(layer_scale)
+    # plain dicts are converted to PointAnnotation once, when the layer is created..
+    annotations = [{'type': 'point', 'id': str(index), 'point': point, 'props': [pointscolor],
+                    'description': description}
+                   for index, point, description in zip(points_df.index, pointlocs.tolist(),
+                                                        points_df['description'])]
 
     with ngviewer.txn() as s:
         s.layers.append(
@@ -192,6 +663,7 @@ def annotate_points(ngviewer, dimensions, pointscolor, points_df, layer_name, la
                         default='blue',
                     )
                 ],
+                annotations=annotations,
                 shader='''
                         void main() {
                           setColor(prop_color());
@@ -199,16 +671,6 @@ def annotate_points(ngviewer, dimensions, pointscolor, points_df, layer_name, la
                         }
                         ''',
             ))
-        for index, indivpoints in points_df.iterrows():
-            s.layers[layer_name].annotations.append(
-                neuroglancer.PointAnnotation(
-                    id=str(index),
-                    point=[indivpoints.x*layer_scale[0], indivpoints.y*layer_scale[1],
-                           indivpoints.z*layer_scale[2]],
-                    props=[pointscolor],
-                    description=pointname[index]
-                )
-            )
 
     status = True
     return status
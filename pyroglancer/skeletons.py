@@ -13,6 +13,8 @@
 
 """Module contains functions to handle skeleton data."""
 
+from concurrent.futures import ProcessPoolExecutor
+import gc
 import numpy as np
 import os
 from cloudvolume import Skeleton, CloudVolume
@@ -21,6 +23,9 @@ import pandas as pd
 import pymaid
 import navis
 import json
+from tqdm import tqdm
+from .annotations import shard_filename, shard_locations
+from .utils import commit_cvinfo, makelayerdirs, open_layerfile, precompress_precomputed
 
 
 def _generate_skeleton(x, min_radius=0):
@@ -34,56 +39,105 @@ def _generate_skeleton(x, min_radius=0):
     -------
     skeleton :      Cloud volume skeleton
     """
-    # flatten the list of the segments (sub-trees)..
-    nodes_ordered = [n for seg in x.segments for n in seg[::-1]]
-    # arrange the nodes in the order of segments..
-    this_tn = x.nodes.set_index('node_id').loc[nodes_ordered]
-    # remove the first occurance of duplicated elements (as seglist stuff is repeated for different segments)..
-    this_tn = this_tn[~this_tn.index.duplicated(keep='first')]
-    this_tn['index'] = list(range(1, this_tn.shape[0] + 1))
-
-    # treenode to index..
-    tn2ix = this_tn['index'].to_dict()
-
-    # set the rootnodes as 0..
-    this_tn['parent_ix'] = this_tn.parent_id.map(lambda x: tn2ix.get(x, -1))
+    # flatten the list of the segments (sub-trees), keeping the first occurance of the nodes
+    # (as seglist stuff is repeated for different segments)..
+    nodes_ordered = np.concatenate([np.asarray(seg[::-1]) for seg in x.segments])
+    _, firstidx = np.unique(nodes_ordered, return_index=True)
+    nodes_ordered = nodes_ordered[np.sort(firstidx)]
+
+    # rows of the node table in the order of segments..
+    node_ids = x.nodes['node_id'].values
+    node_sorter = np.argsort(node_ids, kind='stable')
+    nodepos = np.clip(np.searchsorted(node_ids, nodes_ordered, sorter=node_sorter), 0, len(node_ids) - 1)
+    rows = node_sorter[nodepos]
+    if not np.array_equal(node_ids[rows], nodes_ordered):
+        raise KeyError('segments of neuron {0} refer to nodes missing from its node table'.format(x.id))
+
+    # treenode to index (from 1), the rootnodes get 0..
+    parent_ids = x.nodes['parent_id'].values[rows]
+    order_sorter = np.argsort(nodes_ordered, kind='stable')
+    parentpos = np.clip(np.searchsorted(nodes_ordered, parent_ids, sorter=order_sorter), 0, len(nodes_ordered) - 1)
+    parentfound = nodes_ordered[order_sorter[parentpos]] == parent_ids
+    parent_ix = np.where(parentfound, order_sorter[parentpos] + 1, -1)
+    index = np.arange(1, len(nodes_ordered) + 1)
 
     # get the vertices now..
-    vertices = np.array(this_tn[['x', 'y', 'z']].values.tolist(), dtype="float32")
+    vertices = np.asarray(x.nodes[['x', 'y', 'z']].values[rows], dtype="float32")
 
     # get the edges now..
-    edges = np.array(this_tn[['index', 'parent_ix']].values[1:] - 1, dtype="uint32")
+    edges = (np.stack([index, parent_ix], axis=1)[1:] - 1).astype("uint32")
 
     skeleton = Skeleton(segid=x.id, vertices=vertices, edges=edges)
 
     # set the min_radius
     min_radius = 0
+    radius = x.nodes['radius'].values[rows]
     if not isinstance(min_radius, type(None)):
-        this_tn.loc[this_tn.radius < min_radius, 'radius'] = min_radius
+        radius = np.where(radius < min_radius, min_radius, radius)
 
-    skeleton.radius = np.array(this_tn['radius'].values, dtype="float32")
+    skeleton.radius = np.array(radius, dtype="float32")
 
-    # Set Label column to 0 (undefined)
-    this_tn['label'] = 0
-    # Add end/branch labels
-    this_tn.loc[this_tn.type == 'branch', 'label'] = 5
-    this_tn.loc[this_tn.type == 'end', 'label'] = 6
+    # Set Label column to 0 (undefined), add end/branch labels
+    node_types = x.nodes['type'].values[rows]
+    label = np.zeros(len(rows), dtype=np.int64)
+    label[node_types == 'branch'] = 5
+    label[node_types == 'end'] = 6
     # Add soma label
     if x.soma is not None:
-        this_tn.loc[x.soma, 'label'] = 1
+        label[np.isin(nodes_ordered, np.atleast_1d(x.soma))] = 1
 
-    skeleton.vertex_types = this_tn.label
+    skeleton.vertex_types = label
 
     return skeleton
 
 
-def to_ngskeletons(x):
+def _get_skeletonbatch(neurons):
+    """Convert a batch of neurons into compact skeleton arrays (also in the workers).
+
+    The vertices, edges, radii and vertex types of all skeletons are concatenated, with the number of
+    vertices and edges per skeleton to split them again (see _get_ngskeletons).
+    """
+    skeletons = [_generate_skeleton(neuron) for neuron in neurons]
+    return {'ids': [skeleton.id for skeleton in skeletons],
+            'names': [neuron.name for neuron in neurons],
+            'numvertices': np.array([len(skeleton.vertices) for skeleton in skeletons], dtype=np.int64),
+            'numedges': np.array([len(skeleton.edges) for skeleton in skeletons], dtype=np.int64),
+            'vertices': np.concatenate([skeleton.vertices for skeleton in skeletons]).astype('float32'),
+            'edges': np.concatenate([skeleton.edges for skeleton in skeletons]).astype('uint32'),
+            'radius': np.concatenate([skeleton.radius for skeleton in skeletons]).astype('float32'),
+            'vertex_types': np.concatenate([skeleton.vertex_types for skeleton in skeletons]).astype('uint8')}
+
+
+def _get_ngskeletons(batch):
+    """Split the compact arrays of a batch (see _get_skeletonbatch) into cloudvolume skeletons."""
+    vertexsplits = np.cumsum(batch['numvertices'])[:-1]
+    edgesplits = np.cumsum(batch['numedges'])[:-1]
+    skeletons = []
+    for segid, vertices, edges, radius, vertex_types in zip(
+            batch['ids'], np.split(batch['vertices'], vertexsplits), np.split(batch['edges'], edgesplits),
+            np.split(batch['radius'], vertexsplits), np.split(batch['vertex_types'], vertexsplits)):
+        skeleton = Skeleton(segid=segid, vertices=vertices, edges=edges)
+        skeleton.radius = radius
+        skeleton.vertex_types = vertex_types
+        skeletons.append(skeleton)
+    return skeletons
+
+
+def to_ngskeletons(x, n_workers=None, executor=None):
     """Generate skeleton (of cloudvolume class) for given neuron(s).
 
+    With n_workers (or an executor) the neurons are split into contiguous batches that are converted
+    in worker processes, the workers return compact NumPy arrays only (see _get_skeletonbatch) and the
+    skeletons are returned in the order of the neurons, so the result is the same as with a single process.
+
     Parameters
     ----------
      x :             CatmaidNeuron | CatmaidNeuronList or TreeNeuron | NeuronList
        neuron or neuronlist of different formats
+     n_workers :     int
+       number of worker processes, None or 1 to convert in this process.
+     executor :      concurrent.futures.Executor
+       executor to convert the batches in instead of a new ProcessPoolExecutor of n_workers processes.
 
     Returns
     -------
@@ -103,14 +157,30 @@ def to_ngskeletons(x):
     else:
         raise TypeError(f'Expected neuron or neuronlist, got "{type(x)}"')
 
-    skeldatasegidlist = []
+    if len(x) == 0:
+        batches = []
+    elif executor is None and (not n_workers or n_workers <= 1 or len(x) < 2):
+        batches = [_get_skeletonbatch(x)]
+    else:
+        # a few batches per worker, as the neurons can differ a lot in size..
+        num_batches = min(4 * (n_workers or os.cpu_count() or 1), len(x))
+        bounds = np.linspace(0, len(x), num_batches + 1).astype(int)
+        neuronbatches = [x[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+        if executor is None:
+            # freezing the objects inherited from the parent keeps the garbage collector of the workers from
+            # touching (and so copying) all their memory pages..
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=gc.freeze) as executor:
+                batches = list(executor.map(_get_skeletonbatch, neuronbatches))
+        else:
+            batches = list(executor.map(_get_skeletonbatch, neuronbatches))
+
     skeldatasource = []
+    skeldatasegidlist = []
     skelsegnamelist = []
-    for neuronelement in x:
-        skeldata = _generate_skeleton(neuronelement)
-        skeldatasource.append(skeldata)
-        skeldatasegidlist.append(skeldata.id)
-        skelsegnamelist.append(neuronelement.name)
+    for batch in batches:
+        skeldatasource += _get_ngskeletons(batch)
+        skeldatasegidlist += batch['ids']
+        skelsegnamelist += batch['names']
 
     skeldatasegidlist = list(map(str, skeldatasegidlist))
     skelsegnamelist = list(map(str, skelsegnamelist))
@@ -118,7 +188,7 @@ def to_ngskeletons(x):
     return skeldatasource, skeldatasegidlist, skelsegnamelist
 
 
-def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name):
+def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name, precompress=None):
     """Upload skeleton (of cloudvolume class) to a local server.
 
     Parameters
@@ -133,6 +203,8 @@ def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name):
         local path of the precomputed hosted layer.
     layer_name: str
         layer name.
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
 
     Returns
     -------
@@ -156,7 +228,8 @@ def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name):
 
     cv.skeleton.meta.info['segment_properties'] = 'seg_props'
 
-    cv.skeleton.meta.commit_info()
+    commit_cvinfo(cv.skeleton.meta, os.path.join(cv.basepath, os.path.basename(path),
+                                                 cv.skeleton.meta.skeleton_path, 'info'))
 
     files = [os.path.join(cv.skeleton.meta.skeleton_path, str(skel.id)) for skel in skelsource]
 
@@ -166,14 +239,13 @@ def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name):
         uploadskel = Skeleton(
             vertices=skelsource[fileidx].vertices, edges=skelsource[fileidx].edges)
         print(fullfilepath)
-        with open(fullfilepath, 'wb') as f:
+        with open_layerfile(fullfilepath, 'wb') as f:
             f.write(uploadskel.to_precomputed())
 
     segfilepath = os.path.join(cv.basepath, os.path.basename(
         path), cv.skeleton.meta.skeleton_path, 'seg_props')
 
-    if not os.path.exists(segfilepath):
-        os.makedirs(segfilepath)
+    if makelayerdirs(segfilepath):
         print('creating:', segfilepath)
 
     allsegproplist = []
@@ -189,9 +261,12 @@ def uploadskeletons(skelsource, skelseglist, skelnamelist, path, layer_name):
                           "properties": allsegproplist}}
 
     segfile = os.path.join(segfilepath, 'info')
-    with open(segfile, 'w') as segfile:
+    with open_layerfile(segfile, 'w') as segfile:
         json.dump(seginfo, segfile)
 
+    if precompress:
+        precompress_precomputed(os.path.join(cv.basepath, os.path.basename(path)), precompress)
+
     return cv
 
 
@@ -295,7 +370,63 @@ def to_precomputedskelsinfo(skelseglist, skelnamelist, path):
         json.dump(seginfo, segfile)
 
 
-def uploadshardedskeletons(skelsource, skelseglist, skelnamelist, path, layer_name, shardprogress=False):
+def _encode_shardedskeleton(skeleton):
+    """Encode a skeleton (in physical space) for a sharded skeleton layer."""
+    skel = Skeleton(skeleton.vertices,
+                    edges=skeleton.edges,
+                    segid=int(skeleton.id),
+                    extra_attributes=[{"id": "radius",
+                                       "data_type": "float32",
+                                       "num_components": 1, }]
+                    ).physical_space()
+    return skel.to_precomputed()
+
+
+def put_shardedskeletons(skelsource, shardedfilepath, spec, progress=False):
+    """Write skeletons as shard files, encoding and writing one shard at a time.
+
+    The shard and minishard of every skeleton are computed up front from its id (see
+    annotations.shard_locations), then the skeletons of each shard are encoded, the shard file is
+    assembled and written before the next shard, so only the encoded skeletons of a single shard are
+    held in memory.
+
+    Parameters
+    ----------
+    skelsource:  list
+        contains cloud volume skeletons.
+    shardedfilepath: str
+        local path of the skeleton folder of the layer.
+    spec:   ShardingSpecification
+        sharding specification of the layer.
+    progress:   bool
+        progress bar over the shards
+
+    Returns
+    -------
+    shardfiles : list
+        names of the written shard files.
+    """
+    skelids = np.array([int(skeleton.id) for skeleton in skelsource], dtype=np.uint64)
+    shards, minishards = shard_locations(spec, skelids)
+    order = np.argsort(shards, kind='stable')
+    shardnumbers, starts = np.unique(shards[order], return_index=True)
+
+    shardfiles = []
+    for shard, skelindices in tqdm(zip(shardnumbers, np.split(order, starts[1:])), total=len(shardnumbers),
+                                   desc='Writing Shard Files', disable=not progress):
+        minishardgroups = {}
+        for skelidx in skelindices:
+            minishardgroups.setdefault(int(minishards[skelidx]), {})[int(skelids[skelidx])] = \
+                _encode_shardedskeleton(skelsource[skelidx])
+        shardfile = shard_filename(spec, shard)
+        with open_layerfile(shardedfilepath + '/' + shardfile, 'wb') as f:
+            f.write(spec.synthesize_shard(minishardgroups, presorted=True))
+        shardfiles.append(shardfile)
+    return shardfiles
+
+
+def uploadshardedskeletons(skelsource, skelseglist, skelnamelist, path, layer_name, shardprogress=False,
+                           precompress=None):
     """Upload sharded skeletons to a local server.
 
     Parameters
@@ -312,6 +443,8 @@ def uploadshardedskeletons(skelsource, skelseglist, skelnamelist, path, layer_na
         layer name.
     shardprogress:   bool
         progress bar for sharding operation
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
 
     Returns
     -------
@@ -343,31 +476,15 @@ def uploadshardedskeletons(skelsource, skelseglist, skelnamelist, path, layer_na
 
     cv.skeleton.meta.info['segment_properties'] = 'seg_props'
 
-    cv.skeleton.meta.commit_info()
+    commit_cvinfo(cv.skeleton.meta, os.path.join(cv.basepath, os.path.basename(path),
+                                                 cv.skeleton.meta.skeleton_path, 'info'))
 
-    precomputedskels = {}
-    for skelidx in range(len(skelsource)):
-        skelid = int(skelsource[skelidx].id)
-        skel = Skeleton(skelsource[skelidx].vertices,
-                        edges=skelsource[skelidx].edges,
-                        segid=skelid,
-                        extra_attributes=[{"id": "radius",
-                                           "data_type": "float32",
-                                           "num_components": 1, }]
-                        ).physical_space()
-        precomputedskels[skelid] = skel.to_precomputed()
-
-    shardfiles = spec.synthesize_shards(precomputedskels, progress=shardprogress)
     shardedfilepath = os.path.join(cv.basepath, os.path.basename(path), cv.skeleton.meta.skeleton_path)
-
-    for fname in shardfiles.keys():
-        with open(shardedfilepath + '/' + fname, 'wb') as f:
-            f.write(shardfiles[fname])
+    put_shardedskeletons(skelsource, shardedfilepath, spec, shardprogress)
 
     segfilepath = os.path.join(cv.basepath, os.path.basename(path), cv.skeleton.meta.skeleton_path, 'seg_props')
 
-    if not os.path.exists(segfilepath):
-        os.makedirs(segfilepath)
+    if makelayerdirs(segfilepath):
         print('creating:', segfilepath)
 
     allsegproplist = []
@@ -383,9 +500,12 @@ def uploadshardedskeletons(skelsource, skelseglist, skelnamelist, path, layer_na
                           "properties": allsegproplist}}
 
     segfile = os.path.join(segfilepath, 'info')
-    with open(segfile, 'w') as segfile:
+    with open_layerfile(segfile, 'w') as segfile:
         json.dump(seginfo, segfile)
 
+    if precompress:
+        precompress_precomputed(os.path.join(cv.basepath, os.path.basename(path)), precompress)
+
     return cv
 
 
@@ -13,13 +13,18 @@
 
 """Module contains functions to handle synapse data."""
 
+from concurrent.futures import ProcessPoolExecutor
 import json
 import navis
 import neuroglancer
+import numpy as np
 import os
 import pandas as pd
 import pymaid
-import struct
+from .annotations import annotation_shardingspec, encode_byid, get_annotationproperties, put_shardedindex
+from .annotations import update_annotationinfo
+from .points import encode_points, put_spatialindex
+from .utils import makelayerdirs, open_layerfile, precompress_precomputed
 
 
 def commit_info(synapseinfo, path, synapsetype):
@@ -35,15 +40,14 @@ def commit_info(synapseinfo, path, synapsetype):
         pre or postsynapses
     """
     synapsefilepath = path + '/' + synapsetype
-    if not os.path.exists(synapsefilepath):
-        os.makedirs(synapsefilepath)
+    if makelayerdirs(synapsefilepath):
         print('creating:', synapsefilepath)
     infofile = os.path.join(synapsefilepath, 'info')
-    with open(infofile, 'w') as f:
+    with open_layerfile(infofile, 'w') as f:
         json.dump(synapseinfo, f)
 
 
-def create_synapseinfo(dimensions, path):
+def create_synapseinfo(dimensions, path, sharding=None, relationship_sharding=None):
     """Create info file for the synapse based precomputed format.
 
     Parameters
@@ -52,6 +56,11 @@ def create_synapseinfo(dimensions, path):
         local path of the precomputed hosted layer.
     dimensions:  neuroglancer.CoordinateSpace
         object of neuroglancer coordinate space class.
+    sharding : dict
+        sharding specification of the by_id index (see synapse_shardingspec), None to write no by_id index
+    relationship_sharding : dict
+        sharding specification of the relationship (<type>_cell) indexes (see synapse_relationshipspec),
+        None for one file per neuron
 
     """
     synapseinfo = {
@@ -78,17 +87,128 @@ def create_synapseinfo(dimensions, path):
         ],
         "upper_bound": [34422, 37820, 41362]
     }
+    if sharding is not None:
+        synapseinfo["by_id"]["sharding"] = sharding
     synapseinfo["relationships"] = [{"id": "presynapses_cell",
                                      "key": "presynapses_cell"}]
+    if relationship_sharding is not None:
+        synapseinfo["relationships"][0]["sharding"] = relationship_sharding
     print('synapses info path:', path)
     commit_info(synapseinfo, path, synapsetype='presynapses')
     synapseinfo["relationships"] = [{"id": "postsynapses_cell",
                                      "key": "postsynapses_cell"}]
+    if relationship_sharding is not None:
+        synapseinfo["relationships"][0]["sharding"] = relationship_sharding
     commit_info(synapseinfo, path, synapsetype='postsynapses')
     return path
 
 
-def put_synapsefile(path, synapsetype, synapses, skeletonid):
+SYNAPSE_PROPERTIES = [{"id": "synapsetype", "type": "uint8", "enum_values": [0, 1],
+                       "enum_labels": ["presynapse", "postsynapse"]},
+                      {"id": "score", "type": "float32"}]
+
+
+def create_combinedsynapseinfo(dimensions, path, sharding=None, relationship_sharding=None):
+    """Create info file for a single layer holding both the pre and postsynapses.
+
+    The synapses carry a 'synapsetype' (0 pre, 1 post) and a 'score' property, and are related to
+    their neuron through the 'presynapses_cell' or 'postsynapses_cell' relationship.
+
+    Parameters
+    ----------
+    path: str
+        local path of the precomputed hosted layer.
+    dimensions:  neuroglancer.CoordinateSpace
+        object of neuroglancer coordinate space class.
+    sharding : dict
+        sharding specification of the by_id index (see synapse_shardingspec), None to write no by_id index
+    relationship_sharding : dict
+        sharding specification of the relationship indexes (see synapse_relationshipspec), None for one
+        file per neuron
+
+    """
+    synapseinfo = {
+        '@type': 'neuroglancer_annotations_v1',
+        "annotation_type": "POINT",
+        "by_id": {
+            "key": "by_id"
+        },
+        "dimensions": {
+            "x": [dimensions['x'].scale, dimensions['x'].unit],
+            "y": [dimensions['y'].scale, dimensions['y'].unit],
+            "z": [dimensions['z'].scale, dimensions['z'].unit]
+        },
+        "lower_bound": [0, 0, 0],
+        "properties": SYNAPSE_PROPERTIES,
+        "relationships": [{"id": "presynapses_cell", "key": "presynapses_cell"},
+                          {"id": "postsynapses_cell", "key": "postsynapses_cell"}],
+        "spatial": [],
+        "upper_bound": [1, 1, 1]
+    }
+    if sharding is not None:
+        synapseinfo["by_id"]["sharding"] = sharding
+    if relationship_sharding is not None:
+        for relationship in synapseinfo["relationships"]:
+            relationship["sharding"] = relationship_sharding
+    print('synapses info path:', path)
+    commit_info(synapseinfo, path, synapsetype='synapses')
+    return path
+
+
+def _get_neuronlist(x):
+    """Return the neuron or neuronlist as a neuronlist."""
+    if isinstance(x, pymaid.core.CatmaidNeuron):
+        neuronlist = pymaid.core.CatmaidNeuronList(x)
+    elif isinstance(x, navis.core.TreeNeuron):
+        neuronlist = navis.core.NeuronList(x)
+    elif (isinstance(x, pymaid.core.CatmaidNeuronList) or isinstance(x, navis.core.NeuronList)):
+        neuronlist = x
+    else:
+        raise TypeError(f'Expected neuron or neuronlist, got "{type(x)}"')
+    return neuronlist
+
+
+def synapse_shardingspec(x, combined=False):
+    """Create the sharding specification of the by_id index for the synapses of a neuron or neuronlist.
+
+    Parameters
+    ----------
+    x :  CatmaidNeuron | CatmaidNeuronList or TreeNeuron | NeuronList
+       neuron or neuronlist of different formats
+    combined : bool
+        sized for the combined layer of pre and postsynapses (see create_combinedsynapseinfo)
+
+    Returns
+    -------
+    sharding : dict
+        sharding specification for create_synapseinfo and upload_synapses.
+    """
+    neuronlist = _get_neuronlist(x)
+    num_presynapses = sum(len(neuron.presynapses) for neuron in neuronlist)
+    num_postsynapses = sum(len(neuron.postsynapses) for neuron in neuronlist)
+    if combined:
+        return annotation_shardingspec(num_presynapses + num_postsynapses)
+    return annotation_shardingspec(max(num_presynapses, num_postsynapses))
+
+
+def synapse_relationshipspec(x):
+    """Create the sharding specification of the relationship indexes for a neuron or neuronlist.
+
+    Parameters
+    ----------
+    x :  CatmaidNeuron | CatmaidNeuronList or TreeNeuron | NeuronList
+       neuron or neuronlist of different formats
+
+    Returns
+    -------
+    sharding : dict
+        sharding specification for create_synapseinfo and upload_synapses, keyed by neuron id.
+    """
+    # neuron ids are sparse, so they are hashed to spread over the shards..
+    return annotation_shardingspec(len(_get_neuronlist(x)), hash='murmurhash3_x86_128')
+
+
+def put_synapsefile(path, synapsetype, synapses, skeletonid, firstid=0):
     """Put synapse in the local dataserver.
 
     Parameters
@@ -101,58 +221,334 @@ def put_synapsefile(path, synapsetype, synapses, skeletonid):
         contains 'x', 'y', 'z' columns
     skeletonid : int
         skeleton id to be associated with the corresponding synapse
+    firstid : int
+        annotation id of the first synapse, ids have to be unique in the layer
     pointsname : str
         name for the points (not yet implemented)
 
+    Returns
+    -------
+    synapselocs : numpy.ndarray
+        (N, 3) positions of the written synapses.
     """
     synapsefilepath = path + '/' + synapsetype + '/' + synapsetype + '_cell/'
-    if not os.path.exists(synapsefilepath):
-        os.makedirs(synapsefilepath)
-        # print('creating:', synapsefilepath)
+    makelayerdirs(synapsefilepath)
+    # print('creating:', synapsefilepath)
     synapsefile = os.path.join(synapsefilepath, str(skeletonid))
     print('making:', synapsefile)
     synapselocs = synapses[['x', 'y', 'z']].values/1000
 
     # implementation based on logic suggested by https://github.com/google/neuroglancer/issues/227
-    with open(synapsefile, 'wb') as outputbytefile:
-        total_synapses = len(synapselocs)  # coordinates is a list of tuples (x,y,z)
-        buffer = struct.pack('<Q', total_synapses)
-        for (x, y, z) in synapselocs:
-            synapsepoint = struct.pack('<3f', x, y, z)
-            buffer += synapsepoint
-        # write the ids of the individual points at the very end..
-        synapseid_buffer = struct.pack('<%sQ' % len(synapselocs), *range(len(synapselocs)))
-        buffer += synapseid_buffer
-        outputbytefile.write(buffer)
-
-
-def upload_synapses(x, path):
+    with open_layerfile(synapsefile, 'wb') as outputbytefile:
+        outputbytefile.write(encode_points(synapselocs, ids=firstid + np.arange(len(synapselocs))))
+
+    return synapselocs
+
+
+def _get_propertycolumns(properties):
+    """Return the connector table columns of property names or specifications."""
+    return [prop['id'] if isinstance(prop, dict) else prop for prop in properties or []]
+
+
+def get_synapsetable(neuronlist, synapsetype, columns=()):
+    """Concatenate the pre or postsynapses of all neurons of a neuronlist.
+
+    Parameters
+    ----------
+    neuronlist :  CatmaidNeuronList | NeuronList
+       neuronlist of different formats
+    synapsetype : str
+        pre or postsynapses
+    columns : list
+        further columns of the connector tables to return the values of (e.g. for properties)
+
+    Returns
+    -------
+    synapselocs : numpy.ndarray
+        (N, 3) positions of the synapses of all neurons, in the order of the neurons.
+    segmentids : numpy.ndarray
+        (N,) id of the neuron each synapse belongs to.
+    scores : numpy.ndarray
+        (N,) 'score' (or 'confidence') column of the connector tables, 0 where there is none.
+    values : dict
+        column to (N,) values, for the requested columns.
+    """
+    tables = [getattr(neuron, synapsetype) for neuron in neuronlist]
+    counts = [len(table) for table in tables]
+    neuronids = np.array([int(neuron.id) for neuron in neuronlist], dtype='<u8')
+    if sum(counts) == 0:
+        synapselocs = np.zeros((0, 3))
+        scores = np.zeros(0)
+        values = {column: np.zeros(0) for column in columns}
+    else:
+        # one concat of the whole connector tables, selecting columns per neuron is much slower..
+        table = pd.concat(tables, ignore_index=True)
+        synapselocs = table[['x', 'y', 'z']].values/1000
+        scorecolumn = 'score' if 'score' in table.columns else 'confidence'
+        if scorecolumn in table.columns:
+            scores = pd.to_numeric(table[scorecolumn], errors='coerce').fillna(0).values
+        else:
+            scores = np.zeros(len(table))
+        values = {column: table[column].values for column in columns}
+    segmentids = np.repeat(neuronids, counts)
+    return synapselocs, segmentids, scores, values
+
+
+def _get_synapsebatch(neurons, columns=()):
+    """Extract the pre and postsynapses of a batch of neurons as compact arrays (also in the workers)."""
+    batch = {}
+    for synapsetype in ['presynapses', 'postsynapses']:
+        synapselocs, segmentids, scores, values = get_synapsetable(neurons, synapsetype, columns)
+        batch[synapsetype] = (synapselocs.astype('<f4'), segmentids, scores.astype('<f4'), values)
+    return batch
+
+
+def get_synapsetables(neuronlist, n_workers=None, columns=()):
+    """Extract the pre and postsynapses of all neurons of a neuronlist, optionally in worker processes.
+
+    With n_workers the neuronlist is split into contiguous batches that are extracted in a
+    ProcessPoolExecutor, the workers return NumPy arrays only and the batches are joined in the
+    order of the neurons, so the result is the same as with a single process.
+
+    Parameters
+    ----------
+    neuronlist :  CatmaidNeuronList | NeuronList
+       neuronlist of different formats
+    n_workers : int
+        number of worker processes, None or 1 to extract in this process.
+    columns : list
+        further columns of the connector tables to return the values of
+
+    Returns
+    -------
+    synapsetables : dict
+        'presynapses' and 'postsynapses' to (synapselocs, segmentids, scores, values) (see
+        get_synapsetable), with float32 positions and scores.
+    """
+    if not n_workers or n_workers <= 1 or len(neuronlist) < 2:
+        return _get_synapsebatch(neuronlist, columns)
+
+    bounds = np.linspace(0, len(neuronlist), min(n_workers, len(neuronlist)) + 1).astype(int)
+    batches = [neuronlist[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_get_synapsebatch, batches, [columns] * len(batches)))
+
+    synapsetables = {}
+    for synapsetype in ['presynapses', 'postsynapses']:
+        arrays = tuple(np.concatenate([batch[synapsetype][column] for batch in results]) for column in range(3))
+        values = {column: np.concatenate([batch[synapsetype][3][column] for batch in results])
+                  for column in columns}
+        synapsetables[synapsetype] = arrays + (values,)
+    return synapsetables
+
+
+def put_relationshipindex(indexpath, synapselocs, segmentids, neuronids=None, ids=None, properties=None,
+                          sharding=None, shardprogress=False):
+    """Write the relationship index of a synapse layer, the synapses of every neuron.
+
+    The synapses are grouped by neuron id with NumPy, and the entry of every neuron is encoded from
+    array views.
+
+    Parameters
+    ----------
+    indexpath : str
+        local path of the folder of the index, e.g. '<layer>/presynapses_cell'.
+    synapselocs : numpy.ndarray
+        (N, 3) positions of the synapses (see get_synapsetable).
+    segmentids : numpy.ndarray
+        (N,) id of the neuron each synapse belongs to.
+    neuronids : list
+        ids of the neurons to write an entry for (also neurons without synapses), by default the ids
+        in segmentids.
+    ids : numpy.ndarray
+        (N,) annotation ids of the synapses, defaults to the row indices of synapselocs.
+    properties : numpy.ndarray
+        (N, nbytes) encoded properties of the synapses (see annotations.encode_properties)
+    sharding : dict
+        sharding specification of the relationship index, None for one file per neuron
+    shardprogress : bool
+        progress bar for sharding operation
+    """
+    if neuronids is None:
+        neuronids = np.unique(segmentids)
+    neuronids = np.asarray(neuronids, dtype='<u8')
+    if ids is None:
+        ids = np.arange(len(synapselocs), dtype='<u8')
+
+    order = np.argsort(segmentids, kind='stable')
+    sortedids = segmentids[order]
+    starts = np.searchsorted(sortedids, neuronids, side='left')
+    stops = np.searchsorted(sortedids, neuronids, side='right')
+    entries = {}
+    for neuronid, start, stop in zip(neuronids, starts, stops):
+        indices = order[start:stop]
+        entries[int(neuronid)] = encode_points(synapselocs[indices], ids=ids[indices],
+                                               properties=None if properties is None else properties[indices])
+
+    if sharding is not None:
+        put_shardedindex(indexpath, sharding, {key: bytes(entry) for key, entry in entries.items()},
+                         shardprogress)
+        return
+
+    makelayerdirs(indexpath)
+    for neuronid, entry in entries.items():
+        with open_layerfile(os.path.join(indexpath, str(neuronid)), 'wb') as outputbytefile:
+            outputbytefile.write(entry)
+    print('written %d synapses of %d neurons to: %s' % (len(synapselocs), len(neuronids), indexpath))
+
+
+def put_synapsefiles(path, synapsetype, synapselocs, segmentids, neuronids=None, sharding=None,
+                     shardprogress=False, properties=None):
+    """Put the synapse files of all neurons in the local dataserver in one pass.
+
+    The annotation id of a synapse is its row in synapselocs (see put_relationshipindex).
+
+    Parameters
+    ----------
+    path: str
+        local path of the precomputed hosted layer.
+    synapsetype : str
+        pre or postsynapses
+    synapselocs : numpy.ndarray
+        (N, 3) positions of the synapses (see get_synapsetable).
+    segmentids : numpy.ndarray
+        (N,) id of the neuron each synapse belongs to.
+    neuronids : list
+        ids of the neurons to write a file for (also neurons without synapses), by default the ids
+        in segmentids.
+    sharding : dict
+        sharding specification of the relationship index, None for one file per neuron
+    shardprogress : bool
+        progress bar for sharding operation
+    properties : numpy.ndarray
+        (N, nbytes) encoded properties of the synapses (see annotations.get_annotationproperties)
+    """
+    put_relationshipindex(path + '/' + synapsetype + '/' + synapsetype + '_cell', synapselocs, segmentids,
+                          neuronids, properties=properties, sharding=sharding, shardprogress=shardprogress)
+
+
+def upload_synapses(x, path, precompress=None, sharding=None, shardprogress=False, limit=10000,
+                    relationship_sharding=None, n_workers=None, properties=None):
     """Upload synpases from a neuron or neuronlist.
 
+    The connector tables of all neurons are concatenated once (see get_synapsetables), then written
+    as the per neuron relationship files and as a multi-level spatial index, with bounds computed
+    from the connector tables.
+
     Parameters
     ----------
     x :  CatmaidNeuron | CatmaidNeuronList or TreeNeuron | NeuronList
        neuron or neuronlist of different formats
     path: str
         local path of the precomputed hosted layer.
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
+    sharding : dict
+        sharding specification of the by_id index (as passed to create_synapseinfo), None to write no
+        by_id index
+    shardprogress : bool
+        progress bar for sharding operation
+    limit : int
+        maximum number of synapses per spatial chunk
+    relationship_sharding : dict
+        sharding specification of the relationship indexes (as passed to create_synapseinfo), None for
+        one file per neuron
+    n_workers : int
+        number of worker processes to extract the synapses of the neurons (see get_synapsetables),
+        None to extract them in this process
+    properties : list
+        columns of the connector tables to write as typed properties of the synapses, names or property
+        specifications (see annotations.get_annotationproperties)
 
     """
-    if isinstance(x, pymaid.core.CatmaidNeuron):
-        neuronlist = pymaid.core.CatmaidNeuronList(x)
-    elif isinstance(x, navis.core.TreeNeuron):
-        neuronlist = navis.core.NeuronList(x)
-    elif (isinstance(x, pymaid.core.CatmaidNeuronList) or isinstance(x, navis.core.NeuronList)):
-        neuronlist = x
-    else:
-        raise TypeError(f'Expected neuron or neuronlist, got "{type(x)}"')
+    neuronlist = _get_neuronlist(x)
+    neuronids = [int(neuron.id) for neuron in neuronlist]
+    print('Adding %d neurons' % len(neuronids))
+
+    synapsetables = get_synapsetables(neuronlist, n_workers, _get_propertycolumns(properties))
+    for synapsetype in ['presynapses', 'postsynapses']:
+        synapselocs, segmentids, _, values = synapsetables[synapsetype]
+        propertyspecs, encodedproperties = get_annotationproperties(values, properties)
+        update_annotationinfo(os.path.join(path, synapsetype, 'info'), properties=propertyspecs)
+        put_synapsefiles(path, synapsetype, synapselocs, segmentids, neuronids, relationship_sharding,
+                         shardprogress, encodedproperties)
+        put_spatialindex(path + '/' + synapsetype, synapselocs, limit, encodedproperties)
+        if sharding is not None:
+            entries = dict(zip(range(len(synapselocs)), encode_byid(synapselocs, [segmentids],
+                                                                    encodedproperties)))
+            put_shardedindex(path + '/' + synapsetype + '/by_id', sharding, entries, shardprogress)
+
+    if precompress:
+        precompress_precomputed(path + '/presynapses', precompress)
+        precompress_precomputed(path + '/postsynapses', precompress)
+
+
+def upload_combinedsynapses(x, path, precompress=None, sharding=None, shardprogress=False, limit=10000,
+                            relationship_sharding=None, n_workers=None, properties=None):
+    """Upload the pre and postsynapses of a neuron or neuronlist as one annotation layer.
+
+    The layer (see create_combinedsynapseinfo) is written in one pass: the spatial index and by_id
+    entries hold all synapses once, with their 'synapsetype' and 'score' properties, and the
+    'presynapses_cell' and 'postsynapses_cell' relationships index them by neuron.
 
-    for neuronidx in range(len(neuronlist)):
-        neuronelement = neuronlist[neuronidx]
-        presynapses = neuronelement.presynapses
-        postsynapses = neuronelement.postsynapses
-        print('Adding neuron: ', neuronelement.id)
-        put_synapsefile(path, 'presynapses', presynapses, neuronelement.id)
-        put_synapsefile(path, 'postsynapses', postsynapses, neuronelement.id)
+    Parameters
+    ----------
+    x :  CatmaidNeuron | CatmaidNeuronList or TreeNeuron | NeuronList
+       neuron or neuronlist of different formats
+    path: str
+        local path of the precomputed hosted layer.
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
+    sharding : dict
+        sharding specification of the by_id index (as passed to create_combinedsynapseinfo), None to write
+        no by_id index
+    shardprogress : bool
+        progress bar for sharding operation
+    limit : int
+        maximum number of synapses per spatial chunk
+    relationship_sharding : dict
+        sharding specification of the relationship indexes (as passed to create_combinedsynapseinfo), None
+        for one file per neuron
+    n_workers : int
+        number of worker processes to extract the synapses of the neurons (see get_synapsetables),
+        None to extract them in this process
+    properties : list
+        further columns of the connector tables to write as typed properties of the synapses, names or
+        property specifications (see annotations.get_annotationproperties)
+
+    """
+    neuronlist = _get_neuronlist(x)
+    neuronids = [int(neuron.id) for neuron in neuronlist]
+    print('Adding %d neurons' % len(neuronids))
+
+    columns = _get_propertycolumns(properties)
+    synapsetables = get_synapsetables(neuronlist, n_workers, columns)
+    presynapses, postsynapses = synapsetables['presynapses'], synapsetables['postsynapses']
+    synapselocs, segmentids, scores = [np.concatenate([presynapses[column], postsynapses[column]])
+                                       for column in range(3)]
+    values = {column: np.concatenate([presynapses[3][column], postsynapses[3][column]]) for column in columns}
+    values['synapsetype'] = np.repeat(np.array([0, 1], dtype='u1'), [len(presynapses[0]), len(postsynapses[0])])
+    values['score'] = scores
+    synapsetype = values['synapsetype']
+    propertyspecs, encodedproperties = get_annotationproperties(values,
+                                                                SYNAPSE_PROPERTIES + list(properties or []))
+
+    layerpath = path + '/synapses'
+    update_annotationinfo(os.path.join(layerpath, 'info'), properties=propertyspecs)
+    ids = np.arange(len(synapselocs), dtype='<u8')
+    for typeidx, relationship in enumerate(['presynapses_cell', 'postsynapses_cell']):
+        selected = synapsetype == typeidx
+        put_relationshipindex(layerpath + '/' + relationship, synapselocs[selected], segmentids[selected],
+                              neuronids, ids[selected], encodedproperties[selected], relationship_sharding,
+                              shardprogress)
+    put_spatialindex(layerpath, synapselocs, limit, encodedproperties)
+    if sharding is not None:
+        relatedids = [np.where(synapsetype == 0, segmentids, 0), np.where(synapsetype == 1, segmentids, 0)]
+        entries = dict(zip(range(len(synapselocs)), encode_byid(synapselocs, relatedids, encodedproperties)))
+        put_shardedindex(layerpath + '/by_id', sharding, entries, shardprogress)
+
+    if precompress:
+        precompress_precomputed(layerpath, precompress)
 
 
 def annotate_synapses(ngviewer, dimensions, x):
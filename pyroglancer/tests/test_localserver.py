@@ -1,10 +1,26 @@
 """Module contains test cases for localserver.py module."""
 
 import unittest
-from pyroglancer.localserver import startdataserver, closedataserver
+from pyroglancer.localserver import startdataserver, closedataserver, Server, ThreadPoolServer, send_byte_range
+from pyroglancer.localserver import IMMUTABLE_SHARDS_CACHE_CONTROL, ResponseCache, parse_byte_ranges
+from pyroglancer.localserver import AsyncServer, MemoryStore, ArchiveStore, mount_archive, unmount_archive
+from pyroglancer.localserver import ServerMetrics, METRICS_PATH
+from pyroglancer.utils import pack_precomputed
+from pyroglancer.layers import get_ngserver
 from pyroglancer.ngviewer import openviewer, closeviewer
+import email
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
+import pytest
+import socket
 import sys
+from threading import Thread
+import time
+import tracemalloc
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -15,6 +31,87 @@ startdataserver(port=8008)  # start dataserver..
 openviewer(headless=True)  # open ngviewer
 
 
+def _startlocalserver(servertype, port, **kwargs):
+    """Start a dataserver (serving the current directory) on a background thread."""
+    server = servertype(('127.0.0.1', port), **kwargs)
+    serverthread = Thread(target=server.serve_forever)
+    serverthread.daemon = True
+    serverthread.start()
+    return server
+
+
+def _stoplocalserver(server):
+    """Stop a dataserver started by _startlocalserver."""
+    server.shutdown()
+    server.server_close()
+
+
+def _parsemultipart(contenttype, body):
+    """Split a multipart/byteranges body into its boundary and (Content-Range, bytes) parts.
+
+    The boundary is None (and there are no parts) if the body is not framed by the boundary of contenttype.
+    """
+    message = email.message_from_bytes(b'Content-Type: ' + contenttype.encode() + b'\r\n\r\n' + body)
+    boundary = message.get_boundary()
+    if (message.get_content_type() != 'multipart/byteranges') or (boundary is None) or \
+            not body.startswith(('--%s\r\n' % boundary).encode('latin-1')) or \
+            not body.endswith(('\r\n--%s--\r\n' % boundary).encode('latin-1')):
+        return None, []
+    return boundary, [(part['Content-Range'], part.get_payload(decode=True)) for part in message.get_payload()]
+
+
+def _tracedrange(port, path, first, last):
+    """HEAD and GET a range of path, returning the range (status, md5 of the body) and the peak of the traced
+    allocations. The body is read in small pieces, so the peak is what the server allocated.
+    """
+    tracemalloc.start()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('HEAD', path)
+    conn.getresponse().read()
+    conn.request('GET', path, headers={'Range': 'bytes=%d-%d' % (first, last)})
+    response = conn.getresponse()
+    bodyhash = hashlib.md5()
+    for piece in iter(lambda: response.read(64 * 1024), b''):
+        bodyhash.update(piece)
+    result = response.status, bodyhash.hexdigest()
+    conn.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak
+
+
+def _loadclient(port, requests, latencies, failures):
+    """Issue the requests over one keep-alive connection, recording latencies and failed responses."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    for path, headers, expected in requests:
+        start = time.perf_counter()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        latencies.append(time.perf_counter() - start)
+        if (response.status, body) != expected:
+            failures.append((path, headers, response.status))
+        if response.will_close:
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.close()
+
+
+def _loadtest(port, requests, clients=8):
+    """Run the requests from concurrent clients, returning (requests/s, p99 latency in ms, failures)."""
+    latencies, failures = [], []
+    clientthreads = [Thread(target=_loadclient, args=(port, requests, latencies, failures))
+                     for _ in range(clients)]
+    start = time.perf_counter()
+    for clientthread in clientthreads:
+        clientthread.start()
+    for clientthread in clientthreads:
+        clientthread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, 1000 * latencies[int(0.99 * (len(latencies) - 1))], failures
+
+
 # def setup_module(module):
 #     """Start all servers."""
 #     # Add a common viewer, dataserver for the whole serie of test..
@@ -51,6 +148,409 @@ class Testlocalserver(unittest.TestCase):
 
         assert status
 
+    def test_threadpoolserver(self):
+        """Check if the thread pool dataserver serves a request while another connection is busy."""
+        layer_serverdir, layer_host = get_ngserver()
+        with open(os.path.join(layer_serverdir, 'pooltest'), 'wb') as f:
+            f.write(b'0123456789')
+
+        server = _startlocalserver(ThreadPoolServer, 8010, workers=4)
+
+        # keep one connection idle, this would block a single threaded server..
+        idleconn = socket.create_connection(('127.0.0.1', 8010))
+        conn = http.client.HTTPConnection('127.0.0.1', 8010, timeout=5)
+        conn.request('GET', '/pooltest', headers={'Range': 'bytes=2-5'})
+        response = conn.getresponse()
+        status = (response.status == 206) and (response.read() == b'2345')
+
+        idleconn.close()
+        conn.close()
+        _stoplocalserver(server)
+
+        assert status
+
+    def test_sendbyterange(self):
+        """Check if the zero-copy range transfer sends the right bytes."""
+        layer_serverdir, layer_host = get_ngserver()
+        filepath = os.path.join(layer_serverdir, 'sendfiletest')
+        with open(filepath, 'wb') as f:
+            f.write(bytes(range(256)) * 64)
+
+        sender, receiver = socket.socketpair()
+        with open(filepath, 'rb') as f:
+            send_byte_range(f, sender, 1000, 1999)
+            send_byte_range(f, sender, 16000)
+        sender.close()
+        received = b''
+        while True:
+            buf = receiver.recv(65536)
+            if not buf:
+                break
+            received += buf
+        receiver.close()
+
+        status = received == (bytes(range(256)) * 64)[1000:2000] + (bytes(range(256)) * 64)[16000:]
+
+        assert status
+
+    def test_precompressedsibling(self):
+        """Check if the gzip sibling is served only to clients that accept it."""
+        layer_serverdir, layer_host = get_ngserver()
+        data = b'{"@type": "neuroglancer_annotations_v1"}' * 10
+        with open(os.path.join(layer_serverdir, 'gziptest'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(layer_serverdir, 'gziptest.gz'), 'wb') as f:
+            f.write(gzip.compress(data))
+
+        server = _startlocalserver(Server, 8011)
+        conn = http.client.HTTPConnection('127.0.0.1', 8011, timeout=5)
+        conn.request('GET', '/gziptest', headers={'Accept-Encoding': 'gzip, deflate'})
+        response = conn.getresponse()
+        gzipstatus = (response.getheader('Content-Encoding') == 'gzip') and \
+            (gzip.decompress(response.read()) == data)
+        conn.close()
+
+        conn = http.client.HTTPConnection('127.0.0.1', 8011, timeout=5)
+        conn.request('GET', '/gziptest', headers={'Accept-Encoding': 'gzip;q=0'})
+        response = conn.getresponse()
+        plainstatus = (response.getheader('Content-Encoding') is None) and (response.read() == data)
+        conn.close()
+        _stoplocalserver(server)
+
+        assert gzipstatus and plainstatus
+
+    def test_conditionalrequests(self):
+        """Check if fresh full and range requests are answered with 304 along with the cache policy."""
+        layer_serverdir, layer_host = get_ngserver()
+        with open(os.path.join(layer_serverdir, 'etagtest.shard'), 'wb') as f:
+            f.write(b'0123456789')
+
+        server = _startlocalserver(Server, 8012)
+        server.cache_control = IMMUTABLE_SHARDS_CACHE_CONTROL
+        conn = http.client.HTTPConnection('127.0.0.1', 8012, timeout=5)
+        conn.request('GET', '/etagtest.shard')
+        response = conn.getresponse()
+        response.read()
+        etag = response.getheader('ETag')
+        lastmodified = response.getheader('Last-Modified')
+        cachestatus = 'immutable' in response.getheader('Cache-Control')
+        conn.close()
+
+        statuses = []
+        for headers in [{'If-None-Match': etag}, {'If-None-Match': etag, 'Range': 'bytes=2-5'},
+                        {'If-Modified-Since': lastmodified}, {'If-None-Match': '"stale"'}]:
+            conn = http.client.HTTPConnection('127.0.0.1', 8012, timeout=5)
+            conn.request('GET', '/etagtest.shard', headers=headers)
+            response = conn.getresponse()
+            response.read()
+            statuses.append(response.status)
+            conn.close()
+        _stoplocalserver(server)
+
+        assert cachestatus and (statuses == [304, 304, 304, 200])
+
+    def test_responsecache(self):
+        """Check if repeated whole file and range requests are served from the response cache."""
+        layer_serverdir, layer_host = get_ngserver()
+        cachedir = os.path.join(layer_serverdir, 'cachetest')
+        os.makedirs(cachedir, exist_ok=True)
+        with open(os.path.join(cachedir, 'info'), 'wb') as f:
+            f.write(b'0123456789')
+
+        server = _startlocalserver(Server, 8013)
+        server.cache = ResponseCache(max_bytes=1024)
+        bodies = []
+        for headers in [{}, {}, {'Range': 'bytes=2-5'}, {'Range': 'bytes=2-5'}]:
+            conn = http.client.HTTPConnection('127.0.0.1', 8013, timeout=5)
+            conn.request('GET', '/cachetest/info', headers=headers)
+            bodies.append(conn.getresponse().read())
+            conn.close()
+        _stoplocalserver(server)
+
+        stats = server.cache.stats()
+        server.cache.invalidate(cachedir)
+
+        assert bodies == [b'0123456789', b'0123456789', b'2345', b'2345']
+        assert (stats['hits'] == 2) and (stats['misses'] == 2) and (stats['bytes'] == 14)
+        assert server.cache.stats()['entries'] == 0
+
+    def test_responsecacheeviction(self):
+        """Check if the response cache keeps to its byte budget."""
+        cache = ResponseCache(max_bytes=10, max_entry_bytes=6)
+        cache.put(('a', '"1"', 0, 3), b'aaaa')
+        cache.put(('b', '"1"', 0, 3), b'bbbb')
+        cache.get(('a', '"1"', 0, 3))
+        cache.put(('c', '"1"', 0, 3), b'cccc')
+        cache.put(('d', '"1"', 0, 9), b'dddddddddd')
+
+        assert list(cache.entries) == [('a', '"1"', 0, 3), ('c', '"1"', 0, 3)]
+
+    def test_parsebyteranges(self):
+        """Check if single, suffix and multiple byte ranges are parsed."""
+        assert parse_byte_ranges('bytes=0-99') == [(0, 99)]
+        assert parse_byte_ranges('bytes=-500') == [(None, 500)]
+        assert parse_byte_ranges('bytes=0-9, 20-, -5') == [(0, 9), (20, None), (None, 5)]
+        with pytest.raises(ValueError):
+            parse_byte_ranges('bytes=9-0')
+        with pytest.raises(ValueError):
+            parse_byte_ranges('items=0-9')
+
+    def test_multirangerequest(self):
+        """Check if suffix and multiple range requests are answered correctly."""
+        layer_serverdir, layer_host = get_ngserver()
+        data = bytes(range(256)) * 4
+        with open(os.path.join(layer_serverdir, 'multirangetest.shard'), 'wb') as f:
+            f.write(data)
+
+        server = _startlocalserver(Server, 8014)
+        conn = http.client.HTTPConnection('127.0.0.1', 8014, timeout=5)
+        conn.request('GET', '/multirangetest.shard', headers={'Range': 'bytes=-16'})
+        response = conn.getresponse()
+        suffixstatus = (response.status == 206) and (response.read() == data[-16:])
+        conn.close()
+
+        conn = http.client.HTTPConnection('127.0.0.1', 8014, timeout=5)
+        conn.request('GET', '/multirangetest.shard', headers={'Range': 'bytes=0-15,100-131,-8'})
+        response = conn.getresponse()
+        body = response.read()
+        contenttype = response.getheader('Content-Type')
+        contentlength = int(response.getheader('Content-Length'))
+        conn.close()
+        _stoplocalserver(server)
+
+        message = email.message_from_bytes(b'Content-Type: ' + contenttype.encode() + b'\r\n\r\n' + body)
+        parts = [(part['Content-Range'], part.get_payload(decode=True)) for part in message.get_payload()]
+
+        assert suffixstatus and (contentlength == len(body))
+        assert parts == [('bytes 0-15/1024', data[0:16]), ('bytes 100-131/1024', data[100:132]),
+                         ('bytes 1016-1023/1024', data[-8:])]
+
+    def test_asyncserver(self):
+        """Check if the asyncio engine keeps the CORS, OPTIONS, Range and keep-alive semantics."""
+        layer_serverdir, layer_host = get_ngserver()
+        data = bytes(range(256)) * 4
+        with open(os.path.join(layer_serverdir, 'asynctest.shard'), 'wb') as f:
+            f.write(data)
+
+        server = _startlocalserver(AsyncServer, 8015)
+        conn = http.client.HTTPConnection('127.0.0.1', 8015, timeout=5)
+        conn.request('OPTIONS', '/asynctest.shard')
+        response = conn.getresponse()
+        response.read()
+        optionsstatus = (response.status == 200) and \
+            (response.getheader('Access-Control-Allow-Methods') == 'GET, OPTIONS') and \
+            (response.getheader('Access-Control-Allow-Origin') == '*')
+
+        # the following requests reuse the same connection..
+        conn.request('GET', '/asynctest.shard')
+        response = conn.getresponse()
+        fullstatus = (response.status == 200) and (response.read() == data)
+        etag = response.getheader('ETag')
+        conn.request('GET', '/asynctest.shard', headers={'Range': 'bytes=100-131'})
+        response = conn.getresponse()
+        rangestatus = (response.status == 206) and (response.read() == data[100:132])
+        conn.request('GET', '/asynctest.shard', headers={'Range': 'bytes=0-15,-8'})
+        response = conn.getresponse()
+        multipartstatus = (response.status == 206) and (data[-8:] in response.read())
+        conn.request('GET', '/asynctest.shard', headers={'If-None-Match': etag})
+        response = conn.getresponse()
+        response.read()
+        conditionalstatus = response.status == 304
+        conn.request('GET', '/asynctest.missing')
+        response = conn.getresponse()
+        response.read()
+        missingstatus = response.status == 404
+        conn.close()
+        _stoplocalserver(server)
+
+        assert optionsstatus and fullstatus and rangestatus and multipartstatus
+        assert conditionalstatus and missingstatus
+
+    def test_engineloadtest(self):
+        """Compare the threaded and asyncio engines on throughput and tail latency."""
+        layer_serverdir, layer_host = get_ngserver()
+        data = os.urandom(256 * 1024)
+        with open(os.path.join(layer_serverdir, 'loadtest.shard'), 'wb') as f:
+            f.write(data)
+        requests = [('/loadtest.shard', {}, (200, data)),
+                    ('/loadtest.shard', {'Range': 'bytes=1024-5119'}, (206, data[1024:5120])),
+                    ('/loadtest.shard', {'Range': 'bytes=-64'}, (206, data[-64:])),
+                    ('/loadtest.shard', {'Range': 'bytes=0-63'}, (206, data[0:64]))] * 10
+
+        results = {}
+        for engine, servertype, port, kwargs in [('threaded', ThreadPoolServer, 8016, {'workers': 8}),
+                                                 ('asyncio', AsyncServer, 8017, {})]:
+            server = _startlocalserver(servertype, port, **kwargs)
+            server.cache = ResponseCache()
+            results[engine] = _loadtest(port, requests)
+            _stoplocalserver(server)
+            print('%s engine: %.0f requests/s, p99 %.1f ms' % (engine, results[engine][0], results[engine][1]))
+
+        assert results['threaded'][2] == [] and results['asyncio'][2] == []
+
+    def test_memorystore(self):
+        """Check if files of the memory store are served in place of the disk, with range and etag support."""
+        layer_serverdir, layer_host = get_ngserver()
+        data = bytes(range(256)) * 4
+        filepath = os.path.join(layer_serverdir, 'memorytest', 'data.shard')
+
+        server = _startlocalserver(Server, 8018)
+        server.store = MemoryStore()
+        with server.store.open(filepath, 'wb') as f:
+            f.write(data)
+        with server.store.open(os.path.join(layer_serverdir, 'memorytest', 'info'), 'w') as f:
+            f.write('{"@type": "neuroglancer_annotations_v1"}')
+
+        responses = []
+        for path, headers in [('/memorytest/data.shard', {}), ('/memorytest/data.shard', {'Range': 'bytes=-16'}),
+                              ('/memorytest/data.shard', {'Range': 'bytes=0-3,8-11'}), ('/memorytest/info', {}),
+                              ('/memorytest/missing', {})]:
+            conn = http.client.HTTPConnection('127.0.0.1', 8018, timeout=5)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            responses.append((response.status, response.read(), response.getheader('ETag')))
+            if 'Range' in headers and ',' in headers['Range']:
+                multipart = (response.getheader('Content-Type'), responses[-1][1],
+                             int(response.getheader('Content-Length')))
+                # the connection has to stay usable after the multipart body..
+                conn.request('GET', '/memorytest/info')
+                response = conn.getresponse()
+                keepalivestatus = (response.status == 200) and \
+                    (response.read() == b'{"@type": "neuroglancer_annotations_v1"}')
+            conn.close()
+
+        etag = responses[0][2]
+        server.store[filepath] = data[::-1]
+        conn = http.client.HTTPConnection('127.0.0.1', 8018, timeout=5)
+        conn.request('GET', '/memorytest/data.shard', headers={'If-None-Match': etag})
+        response = conn.getresponse()
+        rewrittenstatus = (response.status == 200) and (response.read() == data[::-1])
+        conn.close()
+
+        # a range of a large file is sent from a view, the file is not copied..
+        largedata = bytes(range(256)) * (1 << 17)
+        server.store[os.path.join(layer_serverdir, 'memorytest', 'large.shard')] = largedata
+        largerange, largepeak = _tracedrange(8018, '/memorytest/large.shard', 1000, len(largedata) - 1001)
+        _stoplocalserver(server)
+
+        assert [status for status, _, _ in responses] == [200, 206, 206, 200, 404]
+        assert responses[0][1] == data and responses[1][1] == data[-16:]
+        boundary, parts = _parsemultipart(multipart[0], multipart[1])
+        assert (boundary is not None) and (multipart[2] == len(multipart[1])) and keepalivestatus
+        assert parts == [('bytes 0-3/1024', data[0:4]), ('bytes 8-11/1024', data[8:12])]
+        assert responses[3][1] == b'{"@type": "neuroglancer_annotations_v1"}'
+        assert rewrittenstatus and not os.path.exists(os.path.join(layer_serverdir, 'memorytest'))
+        assert largerange == (206, hashlib.md5(largedata[1000:-1000]).hexdigest())
+        assert largepeak < len(largedata) // 8
+
+    def test_archivestore(self):
+        """Check if members of zip and tar archives are served by offset, with range and etag support."""
+        layer_serverdir, layer_host = get_ngserver()
+        layerpath = os.path.join(layer_serverdir, 'precomputed', 'archivetest')
+        os.makedirs(os.path.join(layerpath, 'by_id'), exist_ok=True)
+        data = bytes(range(256)) * 4
+        with open(os.path.join(layerpath, 'info'), 'wb') as f:
+            f.write(b'{"@type": "neuroglancer_annotations_v1"}')
+        with open(os.path.join(layerpath, 'by_id', '0'), 'wb') as f:
+            f.write(data)
+        # a member well above the cache limit..
+        largedata = bytes(range(256)) * (1 << 17)
+        with open(os.path.join(layerpath, 'by_id', '1000'), 'wb') as f:
+            f.write(largedata)
+
+        for port, archiveformat in [(8019, 'zip'), (8020, 'tar')]:
+            archivepath = pack_precomputed(layerpath, archiveformat=archiveformat)
+            archive = ArchiveStore(archivepath, os.path.join(layer_serverdir, 'archived'))
+            server = _startlocalserver(Server, port)
+            server.archives = {archive.mountpath: archive}
+
+            responses = []
+            for path, headers in [('/archived/info', {}), ('/archived/by_id/0', {}),
+                                  ('/archived/by_id/0', {'Range': 'bytes=100-131'}),
+                                  ('/archived/by_id/0', {'Range': 'bytes=0-3,-4'}), ('/archived/by_id/1', {})]:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                responses.append((response.status, response.read(), response.getheader('ETag')))
+                if 'Range' in headers and ',' in headers['Range']:
+                    multipart = (response.getheader('Content-Type'), responses[-1][1],
+                                 int(response.getheader('Content-Length')))
+                conn.close()
+
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/archived/by_id/0', headers={'If-None-Match': responses[1][2]})
+            response = conn.getresponse()
+            response.read()
+            conditionalstatus = response.status == 304
+            conn.close()
+
+            # a range of the large member is sent from the mapped archive, the member is not copied..
+            server.cache = ResponseCache()
+            largerange, largepeak = _tracedrange(port, '/archived/by_id/1000', 1000, len(largedata) - 1001)
+            _stoplocalserver(server)
+            archive.close()
+
+            assert [status for status, _, _ in responses] == [200, 200, 206, 206, 404]
+            assert responses[0][1] == b'{"@type": "neuroglancer_annotations_v1"}'
+            assert responses[1][1] == data and responses[2][1] == data[100:132]
+            boundary, parts = _parsemultipart(multipart[0], multipart[1])
+            assert (boundary is not None) and (multipart[2] == len(multipart[1]))
+            assert parts == [('bytes 0-3/1024', data[0:4]), ('bytes 1020-1023/1024', data[-4:])]
+            assert conditionalstatus
+            assert largerange == (206, hashlib.md5(largedata[1000:-1000]).hexdigest())
+            assert largepeak < len(largedata) // 8
+
+        mountpoint = mount_archive(archivepath)
+        mounted = os.path.join(layer_serverdir, 'precomputed', 'archivetest') in sys.modules['ngserver'].archives
+        unmount_archive(mountpoint)
+
+        assert mounted and (mountpoint == 'precomputed/archivetest') and not sys.modules['ngserver'].archives
+
+    def test_servermetrics(self):
+        """Check if requests are counted, served at the metrics path and written to the access log."""
+        layer_serverdir, layer_host = get_ngserver()
+        with open(os.path.join(layer_serverdir, 'metricstest'), 'wb') as f:
+            f.write(b'0123456789')
+
+        for servertype, port in [(Server, 8021), (AsyncServer, 8022)]:
+            server = _startlocalserver(servertype, port)
+            accesslog = io.StringIO()
+            server.metrics = ServerMetrics(accesslog=accesslog)
+            server.cache = ResponseCache()
+            for path, headers in [('/metricstest', {}), ('/metricstest', {}),
+                                  ('/metricstest', {'Range': 'bytes=2-5'}), ('/metricsmissing', {}),
+                                  (METRICS_PATH, {})]:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                conn.close()
+            _stoplocalserver(server)
+
+            metricstext = body.decode('utf-8')
+            snapshot = server.metrics.snapshot()
+            logentries = [json.loads(line) for line in accesslog.getvalue().splitlines()]
+
+            assert 'pyroglancer_dataserver_requests_total{status="200",kind="full"} 2' in metricstext
+            assert 'pyroglancer_dataserver_requests_total{status="206",kind="range"} 1' in metricstext
+            assert 'pyroglancer_dataserver_requests_total{status="404",kind="full"} 1' in metricstext
+            assert 'pyroglancer_dataserver_request_duration_seconds_count{kind="range"} 1' in metricstext
+            assert 'pyroglancer_dataserver_cache_hits_total 1' in metricstext
+            assert snapshot['bytes_sent']['range'] == 4 and snapshot['cache_misses'] == 2
+            assert [entry['status'] for entry in logentries] == [200, 200, 206, 404, 200]
+            assert [entry['cache'] for entry in logentries[:3]] == [False, True, False]
+
+        # errors sent before the request is parsed are counted as well, by both engines..
+        for servertype, port in [(Server, 8023), (AsyncServer, 8024)]:
+            server = _startlocalserver(servertype, port)
+            server.metrics = ServerMetrics()
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                client.sendall(b'GET /' + b'a' * 70000 + b' HTTP/1.1\r\n\r\n')
+                toolongstatus = b' 414 ' in client.recv(1024).split(b'\r\n', 1)[0]
+            _stoplocalserver(server)
+
+            assert toolongstatus and server.metrics.requests == {(414, 'full'): 1}
+
 
 if __name__ == '__main__':
 
@@ -1,12 +1,20 @@
 """Module contains test cases for points.py module."""
 
 import unittest
-from pyroglancer.points import create_pointinfo, upload_points, annotate_points
+from pyroglancer.annotations import annotation_shardingspec, encode_byid, get_annotationproperties, read_shardfile
+from pyroglancer.annotations import shard_filename, shard_locations
+from pyroglancer.points import create_pointinfo, upload_points, annotate_points, encode_points
+from pyroglancer.points import append_points, decode_points, read_pointmanifest, upload_pointtable
 from pyroglancer.layers import get_ngserver, _handle_ngdimensions
-from pyroglancer.localserver import startdataserver, closedataserver
+from pyroglancer.localserver import startdataserver, closedataserver, MemoryStore
 from pyroglancer.ngviewer import openviewer, closeviewer
+from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
+import json
+import numpy as np
 import os
 import pandas as pd
+import struct
+import sys
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -80,6 +88,298 @@ class Testpoints(unittest.TestCase):
 
         assert status
 
+    def test_encodepoints(self):
+        """Check if the vectorized encoder writes the count, positions and ids of the points."""
+        pointlocs = np.array([[5.0, 10.0, 20.0], [15.0, 25.0, 30.5]])
+
+        buffer = encode_points(pointlocs)
+        expected = struct.pack('<Q', 2) + struct.pack('<3f', 5.0, 10.0, 20.0) + \
+            struct.pack('<3f', 15.0, 25.0, 30.5) + struct.pack('<2Q', 0, 1)
+
+        assert bytes(buffer) == expected
+        assert bytes(encode_points(np.zeros((0, 3)))) == struct.pack('<Q', 0)
+
+    def test_put_pointfileprecompressed(self):
+        """Check if the precompressed point files are stored."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_gzip'
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+
+        location_data = [{'x': 5, 'y': 10, 'z': 20}, {'x': 15, 'y': 25, 'z': 30}]
+
+        points = pd.DataFrame(location_data)
+        points['description'] = 'dummy data'
+
+        upload_points(points, points_path, layer_name, [1, 1, 1], precompress='gzip')
+
+        status = os.path.isfile(points_path + '/precomputed/' + layer_name + '/info.gz') and \
+            os.path.isfile(points_path + '/precomputed/' + layer_name + '/spatial0/0_0_0.gz')
+
+        assert status
+
+    def test_put_pointfileinmemory(self):
+        """Check if the point files are kept in the memory store of the dataserver instead of the disk."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_memory'
+        store = MemoryStore()
+        sys.modules['ngserver'].store = store
+        try:
+            points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+
+            location_data = [{'x': 5, 'y': 10, 'z': 20}, {'x': 15, 'y': 25, 'z': 30}]
+
+            points = pd.DataFrame(location_data)
+            points['description'] = 'dummy data'
+
+            upload_points(points, points_path, layer_name, [1, 1, 1], precompress='gzip')
+        finally:
+            sys.modules['ngserver'].store = None
+
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        status = (os.path.join(layerpath, 'info') in store) and \
+            (os.path.join(layerpath, 'spatial0', '0_0_0.gz') in store) and \
+            (len(store[os.path.join(layerpath, 'by_id', '1')]) == 12) and \
+            not os.path.exists(layerpath)
+
+        assert status
+
+    def test_put_pointfilemultilevel(self):
+        """Check if the points are split over a multi-level spatial index, each point written once."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_multilevel'
+        pointlocs = np.random.default_rng(1).random((3000, 3)) * [4000, 2000, 1000]
+        points = pd.DataFrame(pointlocs * 1000, columns=['x', 'y', 'z'])
+        points['description'] = 'dummy data'
+
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+        upload_points(points, points_path, layer_name, [1, 1, 1], limit=100)
+
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        with open(os.path.join(layerpath, 'info')) as f:
+            info = json.load(f)
+        pointids = []
+        for level in info['spatial']:
+            for chunkname in os.listdir(os.path.join(layerpath, level['key'])):
+                with open(os.path.join(layerpath, level['key'], chunkname), 'rb') as f:
+                    buffer = f.read()
+                total_points = struct.unpack_from('<Q', buffer)[0]
+                positions = np.frombuffer(buffer, '<f4', 3 * total_points, 8).reshape(-1, 3)
+                ids = np.frombuffer(buffer, '<u8', total_points, 8 + 12 * total_points)
+                cell = np.floor((positions - info['lower_bound']) / level['chunk_size']).astype(int)
+                assert total_points <= level['limit']
+                assert (cell == [int(c) for c in chunkname.split('_')]).all()
+                assert np.allclose(positions, pointlocs[ids], rtol=1e-6)
+                pointids += ids.tolist()
+
+        assert len(info['spatial']) > 1
+        assert info['spatial'][0]['grid_shape'] == [1, 1, 1]
+        assert sorted(pointids) == list(range(len(points)))
+        assert (np.array(info['lower_bound']) <= pointlocs.min(axis=0)).all()
+        assert (np.array(info['upper_bound']) > pointlocs.max(axis=0)).all()
+
+    def test_put_pointfileproperties(self):
+        """Check if dataframe columns are written as typed properties of the points."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_properties'
+        location_data = [{'x': 5, 'y': 10, 'z': 20}, {'x': 15, 'y': 25, 'z': 30}]
+        points = pd.DataFrame(location_data)
+        points['description'] = 'dummy data'
+        points['score'] = [0.5, 0.25]
+        points['kind'] = [3, 300]
+        points['color'] = ['red', '#0000ff']
+
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+        upload_points(points, points_path, layer_name, [1, 1, 1],
+                      properties=['color', 'score', {'id': 'kind', 'type': 'uint32'}])
+
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        with open(os.path.join(layerpath, 'info')) as f:
+            info = json.load(f)
+        with open(os.path.join(layerpath, 'by_id', '1'), 'rb') as f:
+            entry = f.read()
+
+        assert info['properties'] == [{'id': 'color', 'type': 'rgb'}, {'id': 'score', 'type': 'float32'},
+                                      {'id': 'kind', 'type': 'uint32'}]
+        # 4 byte types first, then the color, padded to 4 bytes..
+        assert entry == struct.pack('<3ffI3Bx', 0.015, 0.025, 0.03, 0.25, 300, 0, 0, 255)
+
+        with self.assertRaises(ValueError):
+            get_annotationproperties(points, ['Score'])
+        with self.assertRaises(ValueError):
+            get_annotationproperties(points, [{'id': 'score', 'type': 'float64'}])
+
+    def test_put_pointfilesharded(self):
+        """Check if the by_id index of the points is written as shard files."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_sharded'
+        location_data = [{'x': 5*idx, 'y': 10, 'z': 20} for idx in range(100)]
+        points = pd.DataFrame(location_data)
+        points['description'] = 'dummy data'
+
+        sharding = annotation_shardingspec(len(points))
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name, sharding)
+        upload_points(points, points_path, layer_name, [1, 1, 1], sharding=sharding)
+
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        with open(os.path.join(layerpath, 'info')) as f:
+            info = json.load(f)
+        byid_files = os.listdir(os.path.join(layerpath, 'by_id'))
+
+        assert info['by_id']['sharding'] == sharding
+        assert len(byid_files) > 0
+        assert all(fname.endswith('.shard') for fname in byid_files)
+        assert len(encode_byid(np.zeros((3, 3)), [np.arange(1, 4)])[0]) == 24
+
+    def test_append_points(self):
+        """Check if points are appended and updated in place, rewriting only the affected chunks."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_append'
+        rng = np.random.default_rng(1)
+        points = pd.DataFrame(rng.uniform(0, 1000, size=(300, 3)) * 1000, columns=['x', 'y', 'z'])
+        points['description'] = 'dummy data'
+        points['node_id'] = np.arange(300)
+
+        sharding = annotation_shardingspec(len(points))
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name, sharding)
+        upload_points(points, points_path, layer_name, [1, 1, 1], sharding=sharding, limit=50,
+                      properties=[{'id': 'node_id', 'type': 'uint32'}])
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        manifest = read_pointmanifest(layerpath)
+        assert manifest['next_id'] == 300
+
+        # an update of point 7 and two new points inside the bounds..
+        added = pd.DataFrame({'x': [500e3, 10e3, 20e3], 'y': [500e3, 10e3, 20e3], 'z': [500e3, 10e3, 20e3],
+                              'id': [7, None, None], 'node_id': [1007, 300, 301]})
+        mtimes = {key: os.stat(os.path.join(layerpath, key)).st_mtime_ns for key in manifest['chunknames']}
+        ids = append_points(added, points_path, layer_name, [1, 1, 1])
+        manifest = read_pointmanifest(layerpath)
+        changed = [key for key in manifest['chunknames']
+                   if os.stat(os.path.join(layerpath, key)).st_mtime_ns != mtimes.get(key)]
+        entries = {}
+        for fname in os.listdir(os.path.join(layerpath, 'by_id')):
+            with open(os.path.join(layerpath, 'by_id', fname), 'rb') as f:
+                entries.update(read_shardfile(f.read(), sharding))
+
+        assert ids.tolist() == [7, 300, 301]
+        assert manifest['next_id'] == 302
+        assert 0 < len(changed) < len(mtimes)
+        assert sorted(entries) == list(range(302))
+        assert entries[7] == struct.pack('<3fI', 500, 500, 500, 1007)
+
+        # and one outside the bounds, which rebuilds the spatial index..
+        append_points(pd.DataFrame({'x': [2e6], 'y': [2e6], 'z': [2e6], 'node_id': [302]}),
+                      points_path, layer_name, [1, 1, 1])
+        manifest = read_pointmanifest(layerpath)
+        with open(os.path.join(layerpath, 'info')) as f:
+            info = json.load(f)
+        chunkids = []
+        for key in manifest['chunknames']:
+            with open(os.path.join(layerpath, key), 'rb') as f:
+                pointlocs, pointids, properties = decode_points(f.read(), 4)
+            chunkids += pointids.tolist()
+            if 7 in pointids:
+                assert pointlocs[pointids == 7].tolist() == [[500, 500, 500]]
+                assert properties[pointids == 7].view('<u4').tolist() == [[1007]]
+
+        assert sorted(chunkids) == list(range(303))
+        assert info['upper_bound'] == [2001, 2001, 2001]
+        assert not os.path.exists(os.path.join(layerpath, 'info.tmp'))
+
+    def test_append_pointsmurmurhash(self):
+        """Check if points are appended to a by_id index sharded with the murmurhash."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        layer_name = 'points_appendmurmurhash'
+        rng = np.random.default_rng(2)
+        points = pd.DataFrame(rng.uniform(0, 1000, size=(300, 3)) * 1000, columns=['x', 'y', 'z'])
+        points['description'] = 'dummy data'
+
+        sharding = annotation_shardingspec(len(points), hash='murmurhash3_x86_128')
+        points_path = create_pointinfo(dimensions, layer_serverdir, layer_name, sharding)
+        upload_points(points, points_path, layer_name, [1, 1, 1], sharding=sharding, limit=50)
+        layerpath = os.path.join(points_path, 'precomputed', layer_name)
+        ids = append_points(pd.DataFrame({'x': [10e3, 20e3], 'y': [10e3, 20e3], 'z': [10e3, 20e3], 'id': [7, None],
+                                          'description': 'dummy data'}), points_path, layer_name, [1, 1, 1])
+
+        shardfiles = {}
+        for fname in os.listdir(os.path.join(layerpath, 'by_id')):
+            with open(os.path.join(layerpath, 'by_id', fname), 'rb') as f:
+                shardfiles[fname] = read_shardfile(f.read(), sharding)
+        shards, _ = shard_locations(sharding, np.arange(301))
+        spec = ShardingSpecification.from_dict(sharding)
+
+        assert ids.tolist() == [7, 300]
+        assert sorted(key for entries in shardfiles.values() for key in entries) == list(range(301))
+        assert all(key in shardfiles[shard_filename(spec, shard)] for key, shard in enumerate(shards))
+        assert shardfiles[shard_filename(spec, shards[7])][7] == struct.pack('<3f', 10, 10, 10)
+
+    def test_upload_pointtable(self):
+        """Check if points streamed from parquet and csv files in batches are all written once."""
+        layer_serverdir, layer_host = get_ngserver()
+
+        layer_kws = {}
+        layer_kws['ngspace'] = 'FAFB'
+        dimensions = _handle_ngdimensions(layer_kws)
+        rng = np.random.default_rng(2)
+        points = pd.DataFrame(rng.uniform(0, 1000, size=(500, 3)) * 1000, columns=['x', 'y', 'z'])
+        points['node_id'] = np.arange(500) * 1000
+
+        for tableformat, sharding in [('parquet', True), ('csv', None)]:
+            layer_name = 'points_table' + tableformat
+            tablefile = os.path.join(layer_serverdir, 'points.' + tableformat)
+            if tableformat == 'parquet':
+                points.to_parquet(tablefile)
+            else:
+                points.to_csv(tablefile, index=False)
+            points_path = create_pointinfo(dimensions, layer_serverdir, layer_name)
+            num_points = upload_pointtable(tablefile, points_path, layer_name, [1, 1, 1], sharding=sharding,
+                                           limit=40, properties=['node_id'], batch_size=64)
+            os.remove(tablefile)
+
+            layerpath = os.path.join(points_path, 'precomputed', layer_name)
+            with open(os.path.join(layerpath, 'info')) as f:
+                info = json.load(f)
+            chunkids = []
+            for level in info['spatial']:
+                for chunkname in os.listdir(os.path.join(layerpath, level['key'])):
+                    with open(os.path.join(layerpath, level['key'], chunkname), 'rb') as f:
+                        pointlocs, pointids, properties = decode_points(f.read(), 4)
+                    chunkids += pointids.tolist()
+                    assert np.allclose(pointlocs, points[['x', 'y', 'z']].values[pointids] / 1000, atol=1e-3)
+                    assert (properties.view('<u4').reshape(-1) == pointids * 1000).all()
+
+            assert num_points == 500
+            assert sorted(chunkids) == list(range(500))
+            assert info['properties'] == [{'id': 'node_id', 'type': 'uint32'}]
+            assert info['by_id'].get('sharding') == (annotation_shardingspec(len(points)) if sharding else None)
+
     def test_annotate_annotate_points(self):
         """Check if individual annotation works."""
         layer_serverdir, layer_host = get_ngserver()
@@ -98,8 +398,13 @@ class Testpoints(unittest.TestCase):
         annot_colors = '#ff0000'
 
         status = annotate_points(ngviewer, dimensions, annot_colors, points, 'points', layer_scale)
+        annotations = ngviewer.state.layers['points'].annotations
 
         assert status
+        assert points['x'].tolist() == [5, 15]
+        assert len(annotations) == 2
+        assert np.allclose(annotations[1].point, [0.015, 0.025, 0.03])
+        assert annotations[1].description == 'dummy data'
 
 
 if __name__ == '__main__':
@@ -1,15 +1,21 @@
 """Module contains test cases for skeleton.py module."""
 
 import unittest
-from pyroglancer.skeletons import to_ngskeletons, uploadskeletons
+from pyroglancer.skeletons import _generate_skeleton, to_ngskeletons, uploadskeletons
+from pyroglancer.skeletons import _encode_shardedskeleton, put_shardedskeletons
+from pyroglancer.annotations import read_shardfile, shard_filename, shard_locations
+from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
+from concurrent.futures import ThreadPoolExecutor
 from pyroglancer.layers import get_ngserver
 from pyroglancer.localserver import startdataserver, closedataserver
 from pyroglancer.ngviewer import openviewer, closeviewer
 import os
 import navis
+import numpy as np
 import pymaid
 import glob
 import pytest
+import types
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,6 +52,84 @@ class Testskeleton(unittest.TestCase):
     #     """Perform tearing down."""
     #     super(Testsynapses, self).tearDown()
 
+    def test_generate_skeleton(self):
+        """Check if the skeleton keeps the nodes in the order of the segments with their parents as edges."""
+        swc_file = glob.glob(os.path.join(BASE_DIR, 'data/swc', '*.swc'))[0]
+        neuron = navis.read_swc(swc_file, units='8 nm')
+        neuron.soma = neuron.nodes.node_id.values[10]
+
+        skeleton = _generate_skeleton(neuron)
+        nodes = neuron.nodes.set_index('node_id')
+        nodes_ordered = list(dict.fromkeys(node for seg in neuron.segments for node in seg[::-1]))
+        # map the edges back to node ids, the rootnodes have no parent..
+        vertex_nodes = np.array(nodes_ordered)
+        child_nodes = vertex_nodes[skeleton.edges[:, 0]]
+        isroot = skeleton.edges[:, 1] >= len(vertex_nodes)
+        parent_nodes = vertex_nodes[np.where(isroot, 0, skeleton.edges[:, 1])]
+
+        assert np.allclose(skeleton.vertices, nodes.loc[nodes_ordered, ['x', 'y', 'z']].values)
+        assert (nodes.loc[child_nodes[~isroot], 'parent_id'].values == parent_nodes[~isroot]).all()
+        assert skeleton.vertex_types[nodes_ordered.index(neuron.soma)] == 1
+        assert (skeleton.vertex_types[nodes.loc[nodes_ordered, 'type'].values == 'end'] == 6).all()
+
+        # segments referring to nodes missing from the node table, also past the largest node id..
+        for missing in [neuron.nodes.node_id.max(), neuron.nodes.node_id.min()]:
+            truncated = types.SimpleNamespace(id=neuron.id, soma=None, segments=neuron.segments,
+                                              nodes=neuron.nodes[neuron.nodes.node_id != missing])
+            with pytest.raises(KeyError):
+                _generate_skeleton(truncated)
+
+    def test_to_ngskeletonsworkers(self):
+        """Check if converting neurons in worker processes gives the same skeletons in the same order."""
+        swc_files = sorted(glob.glob(os.path.join(BASE_DIR, 'data/swc', '*.swc')))
+        neuronlist = navis.core.NeuronList([navis.read_swc(f, units='8 nm', id=idx)
+                                            for idx, f in enumerate(swc_files * 3)])
+
+        skelsource, skelseglist, skelsegnamelist = to_ngskeletons(neuronlist)
+        workersource, workerseglist, workersegnamelist = to_ngskeletons(neuronlist, n_workers=2)
+
+        assert skelseglist == workerseglist == [str(idx) for idx in range(len(neuronlist))]
+        assert skelsegnamelist == workersegnamelist
+        for skeleton, workerskeleton in zip(skelsource, workersource):
+            assert skeleton.to_precomputed() == workerskeleton.to_precomputed()
+            assert (skeleton.vertex_types == workerskeleton.vertex_types).all()
+
+        # an empty neuronlist gives no skeletons, in this process and in the workers..
+        with ThreadPoolExecutor(max_workers=2) as threadpool:
+            emptyresults = [to_ngskeletons(navis.core.NeuronList([]), n_workers=n_workers, executor=executor)
+                            for n_workers, executor in [(None, None), (2, None), (None, threadpool)]]
+        assert emptyresults == [([], [], [])] * 3
+
+    def test_put_shardedskeletons(self):
+        """Check if every skeleton is written once, to the shard and minishard its murmurhash points to."""
+        swc_files = sorted(glob.glob(os.path.join(BASE_DIR, 'data/swc', '*.swc')))
+        neuronlist = navis.core.NeuronList([navis.read_swc(f, units='8 nm', id=int(os.path.basename(f)[:-4]))
+                                            for f in swc_files])
+        skelsource, skelseglist, skelsegnamelist = to_ngskeletons(neuronlist)
+        spec = ShardingSpecification('neuroglancer_uint64_sharded_v1', preshift_bits=0,
+                                     hash='murmurhash3_x86_128', minishard_bits=1, shard_bits=1)
+
+        layer_serverdir, layer_host = get_ngserver()
+        shardedfilepath = os.path.join(layer_serverdir, 'precomputed', 'sharded_test', 'skeletons')
+        os.makedirs(shardedfilepath, exist_ok=True)
+        shardfiles = put_shardedskeletons(skelsource, shardedfilepath, spec)
+
+        entries = {}
+        for shardfile in shardfiles:
+            with open(os.path.join(shardedfilepath, shardfile), 'rb') as f:
+                shardentries = read_shardfile(f.read(), spec)
+            shards, _ = shard_locations(spec, list(shardentries))
+            assert all(shard_filename(spec, shard) == shardfile for shard in shards)
+            entries.update(shardentries)
+
+        assert sorted(entries) == sorted(int(segid) for segid in skelseglist)
+        for skeleton in skelsource:
+            assert entries[int(skeleton.id)] == _encode_shardedskeleton(skeleton)
+        location = spec.compute_shard_location(27295)
+        shards, minishards = shard_locations(spec, [27295])
+        assert shard_filename(spec, shards[0]) == location.shard_number + '.shard'
+        assert minishards[0] == location.minishard_number
+
     def test_upload_skeletontreeneuronlist(self):
         """Check if skeleton upload works in a tree neuronlist."""
         # load some example neurons..
@@ -1,16 +1,23 @@
 """Module contains test cases for synapses.py module."""
 
 import unittest
-from pyroglancer.synapses import create_synapseinfo, put_synapsefile, annotate_synapses
+from pyroglancer.synapses import create_synapseinfo, put_synapsefile, annotate_synapses, synapse_shardingspec
+from pyroglancer.synapses import get_synapsetables, put_synapsefiles, synapse_relationshipspec
+from pyroglancer.annotations import shard_filename, shard_locations
+from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
 from pyroglancer.layers import get_ngserver, _handle_ngdimensions
 from pyroglancer.localserver import startdataserver, closedataserver
 from pyroglancer.ngviewer import openviewer, closeviewer
 from pyroglancer.layers import create_nglayer
+import json
+import numpy as np
 import os
 import pandas as pd
+import struct
 import navis
 import pymaid
 import glob
+import gzip
 import pytest
 
 
@@ -37,6 +44,21 @@ openviewer(headless=True)  # open ngviewer
 #     closeviewer()
 
 
+def _read_shardedentry(indexpath, sharding, key):
+    """Read the entry of a key from the shard files of an index."""
+    spec = ShardingSpecification.from_dict(sharding)
+    shards, minishards = shard_locations(spec, [key])
+    with open(os.path.join(indexpath, shard_filename(spec, shards[0])), 'rb') as f:
+        data = f.read()
+    indexlength = spec.index_length()
+    start, stop = np.frombuffer(data[:indexlength], '<u8').reshape(-1, 2)[int(minishards[0])]
+    minishard = np.frombuffer(gzip.decompress(data[indexlength + start:indexlength + stop]), '<u8').reshape(3, -1)
+    keys = np.cumsum(minishard[0])
+    offsets = np.cumsum(minishard[1] + np.concatenate([[0], minishard[2][:-1]]))
+    idx = list(keys).index(key)
+    return data[indexlength + int(offsets[idx]):indexlength + int(offsets[idx]) + int(minishard[2][idx])]
+
+
 class Testsynapses(unittest.TestCase):
     """Test pyroglancer.synapses."""
 
@@ -110,6 +132,40 @@ class Testsynapses(unittest.TestCase):
 
         assert status
 
+    def test_put_synapsefiles(self):
+        """Check if the bulk writer groups the synapses by neuron, also for neurons without synapses."""
+        layer_serverdir, layer_host = get_ngserver()
+        synapse_path = os.path.join(layer_serverdir, 'precomputed', 'test_bulk')
+        synapselocs = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 9.0]])
+        segmentids = np.array([20, 10, 20], dtype='<u8')
+
+        put_synapsefiles(synapse_path, 'presynapses', synapselocs, segmentids, neuronids=[10, 20, 30])
+
+        cellpath = os.path.join(synapse_path, 'presynapses', 'presynapses_cell')
+        with open(os.path.join(cellpath, '20'), 'rb') as f:
+            assert f.read() == struct.pack('<Q6f2Q', 2, 1.0, 2.0, 3.0, 7.0, 8.0, 9.0, 0, 2)
+        with open(os.path.join(cellpath, '10'), 'rb') as f:
+            assert f.read() == struct.pack('<Q3fQ', 1, 4.0, 5.0, 6.0, 1)
+        with open(os.path.join(cellpath, '30'), 'rb') as f:
+            assert f.read() == struct.pack('<Q', 0)
+
+    def test_get_synapsetablesworkers(self):
+        """Check if extracting the synapses in worker processes gives the same arrays as in one process."""
+        swc_path = os.path.join(BASE_DIR, 'data/swc')
+        swc_files = glob.glob(os.path.join(swc_path, '*.swc'))
+
+        neuronlist = []
+        neuronlist += [navis.read_swc(f, units='8 nm', connector_labels={'presynapse': 7, 'postsynapse': 8},
+                                      id=int(os.path.splitext(os.path.basename(f))[0])) for f in swc_files]
+        neuronlist = navis.core.NeuronList(neuronlist)
+
+        serial = get_synapsetables(neuronlist)
+        parallel = get_synapsetables(neuronlist, n_workers=2)
+        for synapsetype in ['presynapses', 'postsynapses']:
+            assert np.array_equal(serial[synapsetype][0], parallel[synapsetype][0])
+            assert np.array_equal(serial[synapsetype][1], parallel[synapsetype][1])
+            assert len(serial[synapsetype][0]) == sum(len(getattr(neuron, synapsetype)) for neuron in neuronlist)
+
     def test_upload_synapsestreeneuronlist(self):
         """Check if synapse upload works in a tree neuronlist."""
         # load some example neurons..
@@ -144,6 +200,130 @@ class Testsynapses(unittest.TestCase):
 
         assert status
 
+    def test_upload_synapsessharded(self):
+        """Check if the synapse by_id indexes are written as shard files."""
+        swc_path = os.path.join(BASE_DIR, 'data/swc')
+        swc_files = glob.glob(os.path.join(swc_path, '*.swc'))
+
+        neuronlist = []
+        neuronlist += [navis.read_swc(f, units='8 nm', connector_labels={'presynapse': 7, 'postsynapse': 8},
+                                      id=int(os.path.splitext(os.path.basename(f))[0])) for f in swc_files]
+        neuronlist = navis.core.NeuronList(neuronlist)
+
+        layer_serverdir, layer_host = get_ngserver()
+
+        presynlayer_kws = {'type': 'synapses', 'ngspace': 'FAFB',
+                           'linked_layername': 'test_neurons_sharded',
+                           'source': neuronlist, 'sharding': True}
+        create_nglayer(layer_kws=presynlayer_kws)
+
+        layerpath = os.path.join(layer_serverdir, 'precomputed', 'test_neurons_sharded')
+        for synapsetype in ['presynapses', 'postsynapses']:
+            with open(os.path.join(layerpath, synapsetype, 'info')) as f:
+                info = json.load(f)
+            assert info['by_id']['sharding'] == synapse_shardingspec(neuronlist)
+            assert info['relationships'][0]['sharding'] == synapse_relationshipspec(neuronlist)
+            for key in ['by_id', synapsetype + '_cell']:
+                shardfiles = os.listdir(os.path.join(layerpath, synapsetype, key))
+                assert len(shardfiles) > 0
+                assert all(fname.endswith('.shard') for fname in shardfiles)
+
+            # the relationship entry of a neuron holds its synapses..
+            assert info['relationships'][0]['sharding']['hash'] == 'murmurhash3_x86_128'
+            for neuron in neuronlist:
+                entry = _read_shardedentry(os.path.join(layerpath, synapsetype, synapsetype + '_cell'),
+                                           info['relationships'][0]['sharding'], int(neuron.id))
+                total_synapses = struct.unpack_from('<Q', entry)[0]
+                positions = np.frombuffer(entry, '<f4', 3 * total_synapses, 8).reshape(-1, 3)
+                assert np.allclose(positions, getattr(neuron, synapsetype)[['x', 'y', 'z']].values/1000)
+
+    def test_upload_synapsesspatial(self):
+        """Check if the synapses are written as a spatial index with bounds from the connector tables."""
+        swc_path = os.path.join(BASE_DIR, 'data/swc')
+        swc_files = glob.glob(os.path.join(swc_path, '*.swc'))
+
+        neuronlist = []
+        neuronlist += [navis.read_swc(f, units='8 nm', connector_labels={'presynapse': 7, 'postsynapse': 8},
+                                      id=int(os.path.splitext(os.path.basename(f))[0])) for f in swc_files]
+        neuronlist = navis.core.NeuronList(neuronlist)
+
+        layer_serverdir, layer_host = get_ngserver()
+
+        presynlayer_kws = {'type': 'synapses', 'ngspace': 'FAFB',
+                           'linked_layername': 'test_neurons_spatial',
+                           'source': neuronlist, 'limit': 20,
+                           'properties': [{'id': 'node_id', 'type': 'uint32'}]}
+        create_nglayer(layer_kws=presynlayer_kws)
+
+        layerpath = os.path.join(layer_serverdir, 'precomputed', 'test_neurons_spatial')
+        for synapsetype in ['presynapses', 'postsynapses']:
+            synapselocs = np.concatenate([getattr(neuron, synapsetype)[['x', 'y', 'z']].values/1000
+                                          for neuron in neuronlist])
+            with open(os.path.join(layerpath, synapsetype, 'info')) as f:
+                info = json.load(f)
+            assert info['properties'] == [{'id': 'node_id', 'type': 'uint32'}]
+            total_synapses = 0
+            nodeids = []
+            for level in info['spatial']:
+                for chunkname in os.listdir(os.path.join(layerpath, synapsetype, level['key'])):
+                    with open(os.path.join(layerpath, synapsetype, level['key'], chunkname), 'rb') as f:
+                        buffer = f.read()
+                    count = struct.unpack_from('<Q', buffer)[0]
+                    records = np.frombuffer(buffer, 'u1', 16 * count, 8).reshape(count, 16)
+                    nodeids += records[:, 12:].copy().view('<u4').reshape(-1).tolist()
+                    total_synapses += count
+            expected = [int(nodeid) for neuron in neuronlist for nodeid in getattr(neuron, synapsetype)['node_id']]
+            assert sorted(nodeids) == sorted(expected)
+
+            assert total_synapses == len(synapselocs)
+            assert (np.array(info['lower_bound']) <= synapselocs.min(axis=0)).all()
+            assert (np.array(info['upper_bound']) > synapselocs.max(axis=0)).all()
+
+    def test_upload_combinedsynapses(self):
+        """Check if pre and postsynapses are written as one layer with properties and both relationships."""
+        swc_path = os.path.join(BASE_DIR, 'data/swc')
+        swc_files = glob.glob(os.path.join(swc_path, '*.swc'))
+
+        neuronlist = []
+        neuronlist += [navis.read_swc(f, units='8 nm', connector_labels={'presynapse': 7, 'postsynapse': 8},
+                                      id=int(os.path.splitext(os.path.basename(f))[0])) for f in swc_files]
+        neuronlist = navis.core.NeuronList(neuronlist)
+
+        layer_serverdir, layer_host = get_ngserver()
+
+        synlayer_kws = {'type': 'synapses', 'ngspace': 'FAFB',
+                        'linked_layername': 'test_neurons_combined',
+                        'source': neuronlist, 'combined': True, 'sharding': True}
+        ngviewer = create_nglayer(layer_kws=synlayer_kws)
+
+        layerpath = os.path.join(layer_serverdir, 'precomputed', 'test_neurons_combined', 'synapses')
+        with open(os.path.join(layerpath, 'info')) as f:
+            info = json.load(f)
+        assert [prop['id'] for prop in info['properties']] == ['synapsetype', 'score']
+        assert [rel['id'] for rel in info['relationships']] == ['presynapses_cell', 'postsynapses_cell']
+        assert not os.path.exists(os.path.join(layerpath, '..', 'presynapses', 'spatial0'))
+        assert 'synapses' in [layer.name for layer in ngviewer.state.layers]
+
+        # every synapse is written once, flagged pre (0) or post (1)..
+        synapsetypes = []
+        for level in info['spatial']:
+            for chunkname in os.listdir(os.path.join(layerpath, level['key'])):
+                with open(os.path.join(layerpath, level['key'], chunkname), 'rb') as f:
+                    buffer = f.read()
+                total_synapses = struct.unpack_from('<Q', buffer)[0]
+                records = np.frombuffer(buffer, 'u1', 20 * total_synapses, 8).reshape(-1, 20)
+                synapsetypes += records[:, 16].tolist()
+        assert synapsetypes.count(0) == sum(len(neuron.presynapses) for neuron in neuronlist)
+        assert synapsetypes.count(1) == sum(len(neuron.postsynapses) for neuron in neuronlist)
+
+        neuron = neuronlist[0]
+        entry = _read_shardedentry(os.path.join(layerpath, 'postsynapses_cell'),
+                                   info['relationships'][1]['sharding'], int(neuron.id))
+        total_synapses = struct.unpack_from('<Q', entry)[0]
+        records = np.frombuffer(entry, 'u1', 20 * total_synapses, 8).reshape(-1, 20)
+        assert total_synapses == len(neuron.postsynapses)
+        assert (records[:, 16] == 1).all()
+
     def test_upload_synapsestreeneuron(self):
         """Check if synapse upload works in a tree neuron."""
         # load some example neurons..
@@ -1,7 +1,11 @@
 """Module contains test cases for utils.py module."""
 
 import unittest
-from pyroglancer.utils import get_hexcolor, get_alphavalue
+from pyroglancer.utils import get_hexcolor, get_alphavalue, pack_precomputed
+import os
+import tarfile
+import tempfile
+import zipfile
 
 
 class Testutils(unittest.TestCase):
@@ -45,6 +49,26 @@ class Testutils(unittest.TestCase):
 
         assert alphavalue == 1.0
 
+    def test_packprecomputed(self):
+        """Check if a layer folder is packed into uncompressed zip and tar archives."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            layerpath = os.path.join(tmpdir, 'layer')
+            os.makedirs(os.path.join(layerpath, 'spatial0'))
+            with open(os.path.join(layerpath, 'info'), 'w') as f:
+                f.write('{}')
+            with open(os.path.join(layerpath, 'spatial0', '0_0_0'), 'wb') as f:
+                f.write(b'0123456789')
+
+            zippath = pack_precomputed(layerpath)
+            with zipfile.ZipFile(zippath) as archive:
+                zipmembers = sorted((zinfo.filename, zinfo.compress_type) for zinfo in archive.infolist())
+            tarpath = pack_precomputed(layerpath, archiveformat='tar')
+            with tarfile.open(tarpath) as archive:
+                tarmembers = sorted(archive.getnames())
+
+        assert zipmembers == [('info', zipfile.ZIP_STORED), ('spatial0/0_0_0', zipfile.ZIP_STORED)]
+        assert tarmembers == ['info', 'spatial0/0_0_0']
+
 
 if __name__ == '__main__':
     unittest.main()
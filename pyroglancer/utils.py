@@ -13,13 +13,22 @@
 
 """Module contains utility functions."""
 from .loadconfig import getconfigdata
+from .localserver import PRECOMPRESSED_ENCODINGS, get_memorystore
+from cloudvolume.lib import jsonify
+import copy
+import gzip
+import io
 import navis
 import numpy as np
 import open3d as o3d
+import os
+import pandas as pd
 from scipy import ndimage
 from skimage import measure
+import tarfile
 import trimesh as tm
 import webcolors
+import zipfile
 
 
 def get_hexcolor(layer_kws):
@@ -80,6 +89,277 @@ def get_scalevalue(layer_kws):
     return scale
 
 
+def open_layerfile(filepath, mode='wb'):
+    """Open a file of a precomputed layer, in memory if the dataserver serves from a MemoryStore.
+
+    Parameters
+    ----------
+    filepath : str
+        local path of the file inside the hosted folder.
+    mode : str
+        'wb', 'w' (text) for writing or 'rb' for reading.
+
+    Returns
+    -------
+    f : file object
+        file on disk, or in the MemoryStore of the dataserver (stored once it is closed).
+    """
+    store = get_memorystore(filepath)
+    if store is None:
+        return open(filepath, mode)
+    return store.open(filepath, mode)
+
+
+def makelayerdirs(dirpath):
+    """Create the folder for files of a precomputed layer, unless the dataserver serves from memory.
+
+    Returns
+    -------
+    created : bool
+        True if the folder was created now.
+    """
+    if get_memorystore(dirpath) is not None or os.path.exists(dirpath):
+        return False
+    os.makedirs(dirpath)
+    return True
+
+
+def commit_cvinfo(meta, infopath):
+    """Commit the info of cloudvolume skeleton/mesh metadata, in memory if the dataserver serves from memory.
+
+    Parameters
+    ----------
+    meta : cloudvolume skeleton or mesh metadata
+        e.g. cv.skeleton.meta or cv.mesh.meta
+    infopath : str
+        local path of the info file (in the skeleton/mesh folder of the layer).
+    """
+    if get_memorystore(infopath) is None:
+        meta.commit_info()
+        return
+    info = copy.deepcopy(meta.info)
+    if info.get('sharding', None) is None:
+        info.pop('sharding', None)
+    with open_layerfile(infopath, 'w') as f:
+        f.write(jsonify(info))
+
+
+def precompress_precomputed(path, encodings='gzip'):
+    """Write precompressed siblings (file.gz, file.br) for the files of a precomputed layer.
+
+    The local dataserver streams these to clients that accept the encoding. Files that are only
+    read with range requests (shards, multi-resolution mesh fragment data) are skipped, as range
+    responses are always sent uncompressed.
+
+    Parameters
+    ----------
+    path : str
+        local path of the precomputed layer (or a subfolder of it).
+    encodings : str | list
+        'gzip' and/or 'br' (brotli, needs the brotli package).
+    """
+    if isinstance(encodings, str):
+        encodings = [encodings]
+    suffixes = dict(PRECOMPRESSED_ENCODINGS)
+    for encoding in encodings:
+        if encoding not in suffixes:
+            raise ValueError('Unknown encoding "{0}". Please use either: {1}'.format(encoding, list(suffixes)))
+    if 'br' in encodings:
+        try:
+            import brotli  # noqa: F401
+        except ImportError:
+            raise ImportError('brotli precompression needs the brotli package: pip install brotli')
+
+    store = get_memorystore(path)
+    walk = os.walk(path) if store is None else store.walk(path)
+    filepaths = []
+    for dirpath, dirnames, filenames in walk:
+        for filename in filenames:
+            if filename.endswith(tuple(suffixes.values())) or filename.endswith('.shard'):
+                continue
+            if (filename + '.index') in filenames:
+                continue
+            filepaths.append(os.path.join(dirpath, filename))
+    precompress_layerfiles(filepaths, encodings)
+
+
+def precompress_layerfiles(filepaths, encodings='gzip'):
+    """Write (or refresh) the precompressed siblings of some files of a precomputed layer.
+
+    Parameters
+    ----------
+    filepaths : list
+        local paths of the files, see precompress_precomputed for the files worth precompressing.
+    encodings : str | list
+        'gzip' and/or 'br' (brotli, needs the brotli package).
+    """
+    if isinstance(encodings, str):
+        encodings = [encodings]
+    suffixes = dict(PRECOMPRESSED_ENCODINGS)
+    if 'br' in encodings:
+        import brotli
+    for filepath in filepaths:
+        with open_layerfile(filepath, 'rb') as f:
+            data = f.read()
+        for encoding in encodings:
+            if encoding == 'br':
+                encodeddata = brotli.compress(data)
+            else:
+                encodeddata = gzip.compress(data)
+            with open_layerfile(filepath + suffixes[encoding], 'wb') as f:
+                f.write(encodeddata)
+
+
+def get_precompressed(filepath):
+    """Return the encodings ('gzip', 'br') a file of a precomputed layer has precompressed siblings for."""
+    return [encoding for encoding, suffix in PRECOMPRESSED_ENCODINGS if layerfile_exists(filepath + suffix)]
+
+
+def layerfile_exists(filepath):
+    """Return True if a file of a precomputed layer exists, in memory if the dataserver serves from memory."""
+    store = get_memorystore(filepath)
+    if store is None:
+        return os.path.isfile(filepath)
+    return filepath in store
+
+
+def remove_layerfile(filepath):
+    """Remove a file of a precomputed layer along with its precompressed siblings, if they exist."""
+    store = get_memorystore(filepath)
+    for suffix in [''] + [suffix for encoding, suffix in PRECOMPRESSED_ENCODINGS]:
+        if store is not None:
+            store.remove(filepath + suffix)
+        elif os.path.isfile(filepath + suffix):
+            os.remove(filepath + suffix)
+
+
+TABLE_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather',
+                 '.ipc': 'feather', '.csv': 'csv', '.csv.gz': 'csv'}
+
+
+def read_tablebatches(filepath, columns=None, batch_size=1000000):
+    """Read a table from a columnar (Parquet, Feather) or CSV file in batches of rows.
+
+    The file is never loaded as a whole: Parquet files are read per record batch, Feather files are
+    memory mapped and sliced, and CSV files are parsed block by block. Parquet and Feather need the
+    pyarrow package, CSV files are read with pandas if pyarrow is missing.
+
+    Parameters
+    ----------
+    filepath : str
+        path of a .parquet/.pq, .feather/.arrow/.ipc or .csv/.csv.gz file.
+    columns : list
+        columns to read, None for all.
+    batch_size : int
+        (maximum) number of rows per batch.
+
+    Returns
+    -------
+    batches : generator
+        yields pandas.DataFrame of at most batch_size rows.
+    """
+    tableformat = next((TABLE_FORMATS[ext] for ext in sorted(TABLE_FORMATS, key=len, reverse=True)
+                        if str(filepath).endswith(ext)), None)
+    if tableformat is None:
+        raise ValueError('Unknown table format "{0}". Please use either: {1}'.format(
+            filepath, list(TABLE_FORMATS)))
+    try:
+        import pyarrow
+    except ImportError:
+        if tableformat != 'csv':
+            raise ImportError('reading {0} files needs the pyarrow package: '
+                              'pip install pyarrow'.format(tableformat))
+        for batch in pd.read_csv(filepath, usecols=columns, chunksize=batch_size):
+            yield batch
+        return
+
+    if tableformat == 'parquet':
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(filepath).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+    elif tableformat == 'feather':
+        import pyarrow.ipc
+        with pyarrow.memory_map(str(filepath)) as source:
+            reader = pyarrow.ipc.open_file(source)
+            for batchidx in range(reader.num_record_batches):
+                recordbatch = reader.get_batch(batchidx)
+                if columns is not None:
+                    recordbatch = recordbatch.select(columns)
+                for start in range(0, recordbatch.num_rows, batch_size):
+                    yield recordbatch.slice(start, batch_size).to_pandas()
+    else:
+        import pyarrow.csv
+        # pyarrow splits csv files by bytes, rows are rebatched to batch_size..
+        convert_options = pyarrow.csv.ConvertOptions(include_columns=columns)
+        reader = pyarrow.csv.open_csv(filepath, convert_options=convert_options)
+        pending = []
+        numpending = 0
+        for recordbatch in reader:
+            pending.append(recordbatch)
+            numpending += recordbatch.num_rows
+            while numpending >= batch_size:
+                table = pyarrow.Table.from_batches(pending)
+                yield table.slice(0, batch_size).to_pandas()
+                pending = table.slice(batch_size).to_batches()
+                numpending -= batch_size
+        if numpending:
+            yield pyarrow.Table.from_batches(pending).to_pandas()
+
+
+def pack_precomputed(path, archivepath=None, archiveformat='zip'):
+    """Pack the files of a precomputed layer into a single archive that the dataserver can serve.
+
+    Members are stored uncompressed (with paths relative to the layer folder), so they can be
+    served by offset, see localserver.mount_archive.
+
+    Parameters
+    ----------
+    path : str
+        local path of the precomputed layer, e.g. '<dataserver folder>/precomputed/<layer>'.
+    archivepath : str
+        local path of the archive to write, defaults to path + '.zip' (or '.tar').
+    archiveformat : str
+        'zip' or 'tar'.
+
+    Returns
+    -------
+    archivepath : str
+        local path of the written archive.
+    """
+    _ARCHIVE_OPTIONS = ['zip', 'tar']
+    if archiveformat not in _ARCHIVE_OPTIONS:
+        raise ValueError('Unknown archiveformat "{0}". Please use either: {1}'.format(
+            archiveformat, _ARCHIVE_OPTIONS))
+    path = path.rstrip('/')
+    if archivepath is None:
+        archivepath = path + '.' + archiveformat
+
+    store = get_memorystore(path)
+    walk = os.walk(path) if store is None else store.walk(path)
+    members = []
+    for dirpath, dirnames, filenames in walk:
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            members.append((filepath, os.path.relpath(filepath, path).replace(os.sep, '/')))
+
+    if archiveformat == 'zip':
+        with zipfile.ZipFile(archivepath, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for filepath, name in members:
+                with open_layerfile(filepath, 'rb') as f:
+                    archive.writestr(name, f.read())
+    else:
+        with tarfile.open(archivepath, 'w:', format=tarfile.PAX_FORMAT) as archive:
+            for filepath, name in members:
+                with open_layerfile(filepath, 'rb') as f:
+                    data = f.read()
+                tinfo = tarfile.TarInfo(name)
+                tinfo.size = len(data)
+                archive.addfile(tinfo, io.BytesIO(data))
+    print('packed %d files into: %s' % (len(members), archivepath))
+    return archivepath
+
+
 def obj2pointcloud(objurl=None):
     """Convert object url to point cloud data in open3d format.
 
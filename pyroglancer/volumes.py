@@ -24,6 +24,7 @@ import os
 import struct
 import trimesh
 from pyroglancer.meshgenerator import decompose_meshes
+from pyroglancer.utils import commit_cvinfo, makelayerdirs, open_layerfile, precompress_precomputed
 from io import BytesIO
 from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
 
@@ -112,7 +113,7 @@ def _to_multires_precomputed(vertices, faces, quant_bits, meshpath):
     fragment_positions = []
 
     # write the mesh fragment data file first..
-    with open(meshpath, 'wb') as f:
+    with open_layerfile(meshpath, 'wb') as f:
         # for each level now decompose the mesh into submeshes with lower resolution..
         for scale in lod_scales[::-1]:
             # start with lod-0, which is the highest resolution possible..
@@ -131,7 +132,7 @@ def _to_multires_precomputed(vertices, faces, quant_bits, meshpath):
 
     # write the mesh manifest file now..
     manifestfilepath = meshpath + '.index'
-    with open(manifestfilepath, 'wb') as f:
+    with open_layerfile(manifestfilepath, 'wb') as f:
         f.write(chunk_shape.astype('<f').tobytes())
         f.write(grid_origin.astype('<f').tobytes())
         f.write(struct.pack('<I', num_lods))
@@ -198,7 +199,7 @@ def _to_multires_shardedprecomputed(vertices, faces, quant_bits):
     return combineddata.getvalue(), offset
 
 
-def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name):
+def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name, precompress=None):
     """Upload mesh (of cloudvolume class) to a local server.
 
     Parameters
@@ -213,6 +214,8 @@ def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path,
         local path of the precomputed hosted layer.
     layer_name: str
         layer name.
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
 
     Returns
     -------
@@ -227,7 +230,7 @@ def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path,
     cv.mesh.meta.info['@type'] = 'neuroglancer_legacy_mesh'
     cv.mesh.meta.info['segment_name_map'] = 'segment_names'
     cv.mesh.meta.info['segment_properties'] = 'segment_properties'
-    cv.mesh.meta.commit_info()
+    commit_cvinfo(cv.mesh.meta, os.path.join(cv.basepath, os.path.basename(path), cv.mesh.meta.mesh_path, 'info'))
 
     files = [os.path.join(cv.mesh.meta.mesh_path, str(vol.segid)) for vol in volumedatasource]
     volumeids = [str(vol.segid) for vol in volumedatasource]
@@ -242,14 +245,14 @@ def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path,
         precomputed_mesh = _to_precomputed(uploadvol)
         print('Seg id is:', str(volumeids[fileidx]))
         print('Full filepath:', fullfilepath)
-        with open(fullfilepath, 'wb') as f:
+        with open_layerfile(fullfilepath, 'wb') as f:
             f.write(precomputed_mesh)
 
         manifestinfo = {
             "fragments": [str(volumeids[fileidx])]}
         manifestfilepath = str(files[fileidx]) + ':' + str(0)  # files[fileidx]
         manifestfilepath = os.path.join(cv.basepath, os.path.basename(path), manifestfilepath)
-        with open(manifestfilepath, 'w') as f:
+        with open_layerfile(manifestfilepath, 'w') as f:
             json.dump(manifestinfo, f)
 
     # create the file for segment_properties
@@ -262,11 +265,10 @@ def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path,
                           "properties": [allvolproplist]}}
     volfilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                'segment_properties')
-    if not os.path.exists(volfilepath):
-        os.makedirs(volfilepath)
+    if makelayerdirs(volfilepath):
         print('creating:', volfilepath)
     volinfofile = os.path.join(volfilepath, 'info')
-    with open(volinfofile, 'w') as volinfofile:
+    with open_layerfile(volinfofile, 'w') as volinfofile:
         json.dump(volinfo, volinfofile)
 
     # create the file for segment_names
@@ -275,13 +277,15 @@ def uploadsingleresmeshes(volumedatasource, volumeidlist, volumenamelist, path,
                   "map": volumenamedict}
     volnamefilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                    'segment_names')
-    if not os.path.exists(volnamefilepath):
-        os.makedirs(volnamefilepath)
+    if makelayerdirs(volnamefilepath):
         print('creating:', volnamefilepath)
     volnamemapfile = os.path.join(volnamefilepath, 'info')
-    with open(volnamemapfile, 'w') as volnamemapfile:
+    with open_layerfile(volnamemapfile, 'w') as volnamemapfile:
         json.dump(volnamemap, volnamemapfile)
 
+    if precompress:
+        precompress_precomputed(os.path.join(cv.basepath, os.path.basename(path)), precompress)
+
 
 def to_precomputedsingleresmeshes(volumedatasource, path, layer_name):
     """Upload mesh (of cloudvolume class) to a local server.
@@ -396,7 +400,7 @@ def to_precomputedsingleresmeshesinfo(volumeidlist, volumenamelist, path, layer_
         json.dump(volnamemap, volnamemapfile)
 
 
-def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name):
+def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name, precompress=None):
     """Upload multi-res mesh to a local server.
 
     Parameters
@@ -411,6 +415,8 @@ def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, l
         local path of the precomputed hosted layer.
     layer_name: str
         layer name.
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
 
     Returns
     -------
@@ -433,7 +439,7 @@ def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, l
 
     cv.mesh.meta.info['segment_name_map'] = 'segment_names'
     cv.mesh.meta.info['segment_properties'] = 'segment_properties'
-    cv.mesh.meta.commit_info()
+    commit_cvinfo(cv.mesh.meta, os.path.join(cv.basepath, os.path.basename(path), cv.mesh.meta.mesh_path, 'info'))
 
     files = [os.path.join(cv.mesh.meta.mesh_path, str(vol.segid)) for vol in volumedatasource]
     volumeids = [str(vol.segid) for vol in volumedatasource]
@@ -458,11 +464,10 @@ def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, l
                           "properties": [allvolproplist]}}
     volfilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                'segment_properties')
-    if not os.path.exists(volfilepath):
-        os.makedirs(volfilepath)
+    if makelayerdirs(volfilepath):
         print('creating:', volfilepath)
     volinfofile = os.path.join(volfilepath, 'info')
-    with open(volinfofile, 'w') as volinfofile:
+    with open_layerfile(volinfofile, 'w') as volinfofile:
         json.dump(volinfo, volinfofile)
 
     # create the file for segment_names
@@ -471,15 +476,18 @@ def uploadmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, l
                   "map": volumenamedict}
     volnamefilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                    'segment_names')
-    if not os.path.exists(volnamefilepath):
-        os.makedirs(volnamefilepath)
+    if makelayerdirs(volnamefilepath):
         print('creating:', volnamefilepath)
     volnamemapfile = os.path.join(volnamefilepath, 'info')
-    with open(volnamemapfile, 'w') as volnamemapfile:
+    with open_layerfile(volnamemapfile, 'w') as volnamemapfile:
         json.dump(volnamemap, volnamemapfile)
 
+    if precompress:
+        precompress_precomputed(os.path.join(cv.basepath, os.path.basename(path)), precompress)
 
-def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name, shardprogress):
+
+def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist, path, layer_name, shardprogress,
+                                precompress=None):
     """Upload sharded multi-res mesh to a local server.
 
     Parameters
@@ -496,6 +504,8 @@ def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist,
         layer name.
     shardprogress:   bool
         progress bar for sharding operation
+    precompress : str | list
+        also write precompressed siblings ('gzip' and/or 'br') of the layer files
 
     Returns
     -------
@@ -530,7 +540,7 @@ def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist,
                                  data_encoding='raw',)
     cv.mesh.meta.info['sharding'] = spec.to_dict()
 
-    cv.mesh.meta.commit_info()
+    commit_cvinfo(cv.mesh.meta, os.path.join(cv.basepath, os.path.basename(path), cv.mesh.meta.mesh_path, 'info'))
 
     files = [os.path.join(cv.mesh.meta.mesh_path, str(vol.segid)) for vol in volumedatasource]
     volumeids = [str(vol.segid) for vol in volumedatasource]
@@ -553,7 +563,7 @@ def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist,
     shardedfilepath = os.path.join(cv.basepath, os.path.basename(path), cv.mesh.meta.mesh_path)
 
     for fname in shardfiles.keys():
-        with open(shardedfilepath + '/' + fname, 'wb') as f:
+        with open_layerfile(shardedfilepath + '/' + fname, 'wb') as f:
             f.write(shardfiles[fname])
 
     # create the file for segment_properties
@@ -566,11 +576,10 @@ def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist,
                           "properties": [allvolproplist]}}
     volfilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                'segment_properties')
-    if not os.path.exists(volfilepath):
-        os.makedirs(volfilepath)
+    if makelayerdirs(volfilepath):
         print('creating:', volfilepath)
     volinfofile = os.path.join(volfilepath, 'info')
-    with open(volinfofile, 'w') as volinfofile:
+    with open_layerfile(volinfofile, 'w') as volinfofile:
         json.dump(volinfo, volinfofile)
 
     # create the file for segment_names
@@ -579,9 +588,11 @@ def uploadshardedmultiresmeshes(volumedatasource, volumeidlist, volumenamelist,
                   "map": volumenamedict}
     volnamefilepath = os.path.join(cv.basepath, os.path.basename(path), os.path.join(cv.mesh.meta.mesh_path),
                                    'segment_names')
-    if not os.path.exists(volnamefilepath):
-        os.makedirs(volnamefilepath)
+    if makelayerdirs(volnamefilepath):
         print('creating:', volnamefilepath)
     volnamemapfile = os.path.join(volnamefilepath, 'info')
-    with open(volnamemapfile, 'w') as volnamemapfile:
+    with open_layerfile(volnamemapfile, 'w') as volnamemapfile:
         json.dump(volnamemap, volnamemapfile)
+
+    if precompress:
+        precompress_precomputed(os.path.join(cv.basepath, os.path.basename(path)), precompress)